@@ -0,0 +1,242 @@
+"""
+Alert deduplication and rate limiting for dangerous readings.
+
+AlertTracker keeps one episode per (patient_id, condition). The first dangerous
+reading of an episode raises an alert; further dangerous readings inside the
+condition's cooldown window only update in-memory counters, unless the heart
+rate has risen by `escalation_delta` BPM since the last alert (escalation).
+After `resolve_after` consecutive clear readings the episode ends and a digest
+is produced for the caregivers.
+
+Episode state lives in memory and is written to the `alert_state` table on every
+transition (onset, alert, resolution), using the caller's cursor so it commits
+with the reading that caused it. Counters updated by suppressed readings are
+persisted with the next transition.
+
+Cooldowns and episode times run on each reading's own timestamp (`now`), so an
+episode a device buffered offline and uploaded in one batch is judged by when
+its readings were taken, not when they arrived. Timestamps may arrive out of
+order; an earlier reading can move an episode's start back, but never moves
+`last_alert_at` back, and an episode never ends before its last alert.
+
+Callers that may roll back pass a `pending` dict to observe(). The changes are
+staged there instead of in memory, and apply(pending) makes them current once
+the transaction has committed. If the transaction fails, the alerts it would
+have queued are not counted as sent.
+"""
+
+import threading
+from datetime import datetime
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Condition keys, in the order they are reported
+CONDITIONS = (
+    'tachycardia',
+    'hypertrophy',
+    'high_cholesterol',
+    'high_heart_rate',
+    'high_blood_pressure',
+    'low_spo2',
+)
+
+# Minimum seconds between repeat alerts for the same ongoing episode
+DEFAULT_COOLDOWNS = {
+    'tachycardia': 15 * 60,
+    'hypertrophy': 60 * 60,
+    'high_cholesterol': 6 * 60 * 60,
+    'high_heart_rate': 15 * 60,
+    'high_blood_pressure': 30 * 60,
+    'low_spo2': 10 * 60,
+}
+
+# Used to pick one reason when several conditions alert on the same reading
+REASON_PRIORITY = {'reminder': 0, 'onset': 1, 'escalation': 2}
+
+
+def detect_conditions(heart_rate, systolic, diastolic, spo2,
+                      tachycardia_pred, hypertrophy_pred, cholesterol_pred):
+    """Return the dangerous conditions present in one reading"""
+    flags = (
+        int(tachycardia_pred) == 1,
+        int(hypertrophy_pred) == 1,
+        int(cholesterol_pred) == 1,
+        heart_rate > 120,
+        systolic > 160 or diastolic > 100,
+        spo2 < 92,
+    )
+    return [condition for condition, flag in zip(CONDITIONS, flags) if flag]
+
+
+class AlertDecision:
+    """What to send for one reading"""
+
+    def __init__(self):
+        self.alert = []  # Conditions to alert on now
+        self.reason = None  # 'onset', 'reminder' or 'escalation'
+        self.digests = []  # Summaries of episodes that just ended
+
+    def __bool__(self):
+        return bool(self.alert or self.digests)
+
+
+class AlertTracker:
+    """In-memory episode tracker backed by the alert_state table"""
+
+    def __init__(self, cooldowns=None, escalation_delta=20, resolve_after=3):
+        self.cooldowns = dict(DEFAULT_COOLDOWNS, **(cooldowns or {}))
+        self.escalation_delta = escalation_delta
+        self.resolve_after = resolve_after
+        # patient_id -> {condition: episode dict}; only active episodes are kept
+        self._episodes = {}
+        self._lock = threading.Lock()
+
+    def load(self, cursor):
+        """Load active episodes persisted by a previous run"""
+        cursor.execute('SELECT * FROM alert_state WHERE active = 1')
+        episodes = {}
+        for row in cursor.fetchall():
+            episode = dict(row)
+            for key in ('episode_started_at', 'last_alert_at'):
+                if episode[key]:
+                    episode[key] = datetime.strptime(episode[key], TIME_FORMAT)
+            episodes.setdefault(episode['patient_id'], {})[episode['condition']] = episode
+        with self._lock:
+            self._episodes = episodes
+
+    def observe(self, cursor, patient_id, conditions, heart_rate, now=None, pending=None):
+        """Record one reading for a patient and decide which alerts to send.
+
+        `now` is when the reading was taken (default: the current time).
+
+        With `pending`, the patient's updated episodes are staged in it
+        (patient_id -> episodes) until apply(pending) is called.
+        """
+        decision = AlertDecision()
+        now = now or datetime.now()
+        staged = pending is not None
+        if pending is None:
+            pending = {}
+
+        if patient_id in pending:
+            episodes = pending[patient_id]
+        else:
+            with self._lock:
+                current = self._episodes.get(patient_id)
+            # Work on copies so nothing changes until the caller commits
+            episodes = {condition: dict(episode) for condition, episode in (current or {}).items()}
+        # Fast path: nothing dangerous and nothing ongoing
+        if not conditions and not episodes:
+            return decision
+        pending[patient_id] = episodes
+
+        changed = []
+        for condition in conditions:
+            episode = episodes.get(condition)
+            if episode is None:
+                episode = episodes[condition] = {
+                    'patient_id': patient_id,
+                    'condition': condition,
+                    'active': 1,
+                    'episode_started_at': now,
+                    'last_alert_at': None,
+                    'last_alert_heart_rate': None,
+                    'alerts_sent': 0,
+                    'dangerous_readings': 0,
+                    'clear_readings': 0,
+                    'peak_heart_rate': heart_rate,
+                }
+                reason = 'onset'
+            else:
+                reason = self._repeat_reason(episode, condition, heart_rate, now)
+                episode['episode_started_at'] = min(episode['episode_started_at'], now)
+
+            episode['dangerous_readings'] += 1
+            episode['clear_readings'] = 0
+            episode['peak_heart_rate'] = max(episode['peak_heart_rate'] or 0, heart_rate)
+
+            if reason:
+                # A late reading may escalate, but never rewinds the cooldown
+                episode['last_alert_at'] = max(episode['last_alert_at'] or now, now)
+                episode['last_alert_heart_rate'] = heart_rate
+                episode['alerts_sent'] += 1
+                decision.alert.append(condition)
+                # Report the most urgent reason when several conditions fire
+                if decision.reason is None or REASON_PRIORITY[reason] > REASON_PRIORITY[decision.reason]:
+                    decision.reason = reason
+                changed.append(episode)
+
+        for condition in [c for c in episodes if c not in conditions]:
+            episode = episodes[condition]
+            episode['clear_readings'] += 1
+            if episode['clear_readings'] >= self.resolve_after:
+                episode['active'] = 0
+                del episodes[condition]
+                decision.digests.append(self._digest(episode, now))
+                changed.append(episode)
+
+        for episode in changed:
+            self._persist(cursor, episode)
+        if not staged:
+            self.apply(pending)
+        return decision
+
+    def apply(self, pending):
+        """Make episodes staged by observe() current, once their transaction has committed"""
+        with self._lock:
+            for patient_id, episodes in pending.items():
+                if episodes:
+                    self._episodes[patient_id] = episodes
+                else:
+                    self._episodes.pop(patient_id, None)
+
+    def _repeat_reason(self, episode, condition, heart_rate, now):
+        """Decide whether an ongoing episode warrants another alert"""
+        last_rate = episode['last_alert_heart_rate']
+        if last_rate is not None and heart_rate >= last_rate + self.escalation_delta:
+            return 'escalation'
+        last_alert = episode['last_alert_at']
+        if last_alert is None or (now - last_alert).total_seconds() >= self.cooldowns.get(condition, 0):
+            return 'reminder'
+        return None
+
+    def _digest(self, episode, now):
+        started = episode['episode_started_at']
+        now = max(now, started, episode['last_alert_at'] or started)
+        return {
+            'condition': episode['condition'],
+            'episode_started_at': started.strftime(TIME_FORMAT),
+            'episode_ended_at': now.strftime(TIME_FORMAT),
+            'duration_minutes': round((now - started).total_seconds() / 60, 1),
+            'dangerous_readings': episode['dangerous_readings'],
+            'alerts_sent': episode['alerts_sent'],
+            'peak_heart_rate': episode['peak_heart_rate'],
+        }
+
+    def _persist(self, cursor, episode):
+        cursor.execute('''
+        INSERT INTO alert_state
+        (patient_id, condition, active, episode_started_at, last_alert_at,
+        last_alert_heart_rate, alerts_sent, dangerous_readings, clear_readings, peak_heart_rate)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (patient_id, condition) DO UPDATE SET
+            active = excluded.active,
+            episode_started_at = excluded.episode_started_at,
+            last_alert_at = excluded.last_alert_at,
+            last_alert_heart_rate = excluded.last_alert_heart_rate,
+            alerts_sent = excluded.alerts_sent,
+            dangerous_readings = excluded.dangerous_readings,
+            clear_readings = excluded.clear_readings,
+            peak_heart_rate = excluded.peak_heart_rate
+        ''', (
+            episode['patient_id'],
+            episode['condition'],
+            episode['active'],
+            episode['episode_started_at'].strftime(TIME_FORMAT),
+            episode['last_alert_at'].strftime(TIME_FORMAT) if episode['last_alert_at'] else None,
+            episode['last_alert_heart_rate'],
+            episode['alerts_sent'],
+            episode['dangerous_readings'],
+            episode['clear_readings'],
+            episode['peak_heart_rate'],
+        ))
@@ -1,27 +1,45 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for, flash
+from flask import Flask, request, jsonify, render_template, redirect, url_for, flash, Response, stream_with_context
 import numpy as np
-import joblib
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
 import json
+import time
 from flask_mail import Mail, Message
 import uuid
-from datetime import datetime, timedelta
 
-# Load the models
-tachycardia_model = joblib.load('model/tachycardia_model.joblib')
-hypertrophy_model = joblib.load('model/hypertrophy_model.joblib')
-cholesterol_model = joblib.load('model/cholesterol_model.joblib')
+from alerts import CONDITIONS as ALERT_CONDITIONS, AlertTracker, detect_conditions
+from db import ConnectionPool
+from devices import DeviceRegistry
+from events import ReadingBroker
+from ingest import IngestQueue, QueueFull
+from migrations import migrate
+from notifications import NotificationWorker, enqueue_alerts
+from registry import ModelRegistry
+from risk import FEATURES as RISK_FEATURES, RiskModel, risk_level
+import rollups
+
+# Load the models once, on first use (MODEL_PRELOAD=1 loads them at import,
+# e.g. before forking workers); the engine scores all three conditions in one
+# pass and precomputes results for every plausible heart rate. The registry
+# swaps in retrained models from model/ without a restart.
+model_registry = ModelRegistry(
+    poll_interval=float(os.environ.get('MODEL_POLL_SECONDS', 5)),
+    lazy=os.environ.get('MODEL_PRELOAD', '0') != '1'
+)
+
+# Heart disease risk model behind /predict, loaded the same way
+risk_model = RiskModel(lazy=os.environ.get('MODEL_PRELOAD', '0') != '1')
 
 # Initialize Flask app
 app = Flask(__name__)
 app.secret_key = os.urandom(24)  # Required for flash messages
 
 # Configure Flask-Mail
-app.config['MAIL_SERVER'] = 'smtp.gmail.com'
-app.config['MAIL_PORT'] = 587
-app.config['MAIL_USE_TLS'] = True
+# MAIL_SERVER/MAIL_PORT can point at a local SMTP stand-in during development
+app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'smtp.gmail.com')
+app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 587))
+app.config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS', '1') == '1'
 app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME')
 app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD')
 app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_DEFAULT_SENDER', 'heart-monitor@example.com')
@@ -31,192 +49,178 @@ mail = Mail(app)
 # Database setup
 DB_PATH = 'heart_monitor.db'
 
+# Long-lived, WAL-mode connections shared by all request threads
+db_pool = ConnectionPool(DB_PATH)
+
+# Cached device credentials, reloaded after DEVICE_CACHE_TTL_SECONDS so changes
+# made by other workers apply; last_seen is flushed to disk in batches
+device_registry = DeviceRegistry(
+    db_pool,
+    flush_interval=float(os.environ.get('DEVICE_LAST_SEEN_FLUSH_SECONDS', 30)),
+    cache_ttl=float(os.environ.get('DEVICE_CACHE_TTL_SECONDS', 30))
+)
+
+# Page sizes for /api/patients/<id>/readings
+READINGS_PAGE_SIZE = int(os.environ.get('READINGS_PAGE_SIZE', 500))
+READINGS_MAX_PAGE_SIZE = int(os.environ.get('READINGS_MAX_PAGE_SIZE', 10000))
+
+# Most (heart_rate, blood_glucose) pairs scored by one /predict request
+PREDICT_MAX_BATCH = int(os.environ.get('PREDICT_MAX_BATCH', 10000))
+
+# Most readings accepted by one /api/iot/readings:batch request
+IOT_MAX_BATCH = int(os.environ.get('IOT_MAX_BATCH', 1000))
+
 def init_db():
-    """Initialize the SQLite database with required tables if they don't exist"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Create table for storing sensor readings and predictions
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS heart_readings (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        timestamp TEXT NOT NULL,
-        patient_id INTEGER NOT NULL,
-        heart_rate INTEGER NOT NULL,
-        hrv REAL NOT NULL,
-        spo2 REAL NOT NULL,
-        systolic INTEGER NOT NULL,
-        diastolic INTEGER NOT NULL,
-        body_temp REAL NOT NULL,
-        tachycardia_pred INTEGER NOT NULL,
-        hypertrophy_pred INTEGER NOT NULL,
-        cholesterol_pred INTEGER NOT NULL,
-        tachycardia_prob REAL,
-        hypertrophy_prob REAL,
-        cholesterol_prob REAL,
-        notification_sent INTEGER DEFAULT 0,
-        device_id TEXT,
-        FOREIGN KEY (patient_id) REFERENCES patients (id),
-        FOREIGN KEY (device_id) REFERENCES devices (device_id)
-    )
-    ''')
+    """Initialize the SQLite database, applying any pending schema migrations"""
+    conn = db_pool.acquire()
     
-    # Create table for patients
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS patients (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        age INTEGER NOT NULL,
-        gender TEXT NOT NULL,
-        medical_history TEXT,
-        created_at TEXT NOT NULL
-    )
-    ''')
+    # Create or upgrade the schema
+    migrate(conn)
     
-    # Create table for caregivers
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS caregivers (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        email TEXT NOT NULL UNIQUE,
-        phone TEXT,
-        created_at TEXT NOT NULL
-    )
-    ''')
-    
-    # Create table for patient-caregiver relationships
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS patient_caregivers (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        patient_id INTEGER NOT NULL,
-        caregiver_id INTEGER NOT NULL,
-        relationship TEXT NOT NULL,
-        created_at TEXT NOT NULL,
-        FOREIGN KEY (patient_id) REFERENCES patients (id),
-        FOREIGN KEY (caregiver_id) REFERENCES caregivers (id),
-        UNIQUE(patient_id, caregiver_id)
-    )
-    ''')
-    
-    # Create table for IoT devices
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS devices (
-        device_id TEXT PRIMARY KEY,
-        device_name TEXT NOT NULL,
-        device_type TEXT NOT NULL,
-        patient_id INTEGER,
-        api_key TEXT NOT NULL,
-        last_seen TEXT,
-        status TEXT DEFAULT 'active',
-        created_at TEXT NOT NULL,
-        FOREIGN KEY (patient_id) REFERENCES patients (id)
-    )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    db_pool.release(conn)
 
 # Function to calculate additional parameters and make ML predictions
-def calculate_health_metrics(heart_rate, patient_id):
-    # Calculate health metrics based on heart rate
-    hrv = max(20, 100 - heart_rate)  # HRV tends to decrease with higher HR
-    spo2 = 98 if heart_rate < 100 else 95  # SpO2 drops slightly with high HR
-    
-    # Simulate more features that the model expects
-    systolic = 110 + (heart_rate // 10)  # Approximation based on HR
-    diastolic = 70 + (heart_rate // 20)  # Approximation based on HR
-    body_temp = 36.6 + (heart_rate - 70) * 0.01  # Slight increase with HR
-    
-    blood_pressure = f"{systolic}/{diastolic}"
-    
-    # Create feature array for ML models
-    # Adjusted to provide 6 features as expected by the model
-    features = np.array([[heart_rate, hrv, spo2, systolic, diastolic, body_temp]])
+def calculate_health_metrics(heart_rate, patient_id, device_id=None, timestamp=None):
+    """Score and store a single reading (see ingest_readings)"""
+    return ingest_readings([(patient_id, device_id, heart_rate, timestamp)])[0]
+
+def ingest_readings(readings):
+    """Store readings through the ingest queue and wait for their results.
     
-    # Make predictions using the ML models
-    tachycardia_pred = tachycardia_model.predict(features)[0]
-    hypertrophy_pred = hypertrophy_model.predict(features)[0]
-    cholesterol_pred = cholesterol_model.predict(features)[0]
+    The queue's writer thread batches them with other requests' readings
+    into one store_readings call. Raises QueueFull when the queue has no room.
+    """
+    return ingest_queue.submit(readings).result()
+
+# Column order of the rows built by store_readings
+READING_COLUMNS = (
+    'timestamp', 'patient_id', 'device_id', 'heart_rate', 'hrv', 'spo2',
+    'systolic', 'diastolic', 'body_temp',
+    'tachycardia_pred', 'hypertrophy_pred', 'cholesterol_pred',
+    'tachycardia_prob', 'hypertrophy_prob', 'cholesterol_prob',
+    'model_version'
+)
+
+def store_readings(readings):
+    """Score and store readings in a single transaction.
     
-    # Get probability scores if models support predict_proba
-    try:
-        tachycardia_prob = tachycardia_model.predict_proba(features)[0][1]
-        hypertrophy_prob = hypertrophy_model.predict_proba(features)[0][1]
-        cholesterol_prob = cholesterol_model.predict_proba(features)[0][1]
-    except:
-        tachycardia_prob = hypertrophy_prob = cholesterol_prob = None
+    Each reading is a (patient_id, device_id, heart_rate, timestamp) tuple and is
+    written by exactly one insert, together with its source device and timestamp
+    (defaults to now). Returns one result dict per reading, in input order.
+    """
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    
+    # One engine for the whole batch, even if a reload happens meanwhile
+    engine = model_registry.engine
+    
+    # Features and predictions for all readings at once; in-domain heart
+    # rates come straight from the engine's precomputed table
+    features, preds, probs = engine.score_heart_rates([reading[2] for reading in readings])
+    heart_rate, hrv, spo2, systolic, diastolic, body_temp = features.T
+    
+    rows = []
+    for i, (patient_id, device_id, _, timestamp) in enumerate(readings):
+        rows.append((
+            timestamp or now, patient_id, device_id,
+            int(heart_rate[i]), int(hrv[i]), int(spo2[i]),
+            int(systolic[i]), int(diastolic[i]), float(body_temp[i]),
+            int(preds[0, i]), int(preds[1, i]), int(preds[2, i]),
+            # Probabilities are NaN for models without predict_proba
+            *(None if np.isnan(p) else float(p) for p in probs[:, i]),
+            engine.version
+        ))
     
-    # Current timestamp
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # Check if any dangerous condition is detected
+    conditions = [detect_conditions(row[3], row[6], row[7], row[5], row[9], row[10], row[11])
+                  for row in rows]
     
-    # Store data in database
-    conn = sqlite3.connect(DB_PATH)
+    # Insert every row in a single transaction. The write lock is held from
+    # BEGIN IMMEDIATE, so AUTOINCREMENT ids are allocated contiguously after
+    # the current sqlite_sequence value.
+    conn = db_pool.acquire()
     cursor = conn.cursor()
-    cursor.execute('''
-    INSERT INTO heart_readings 
-    (timestamp, patient_id, heart_rate, hrv, spo2, systolic, diastolic, body_temp,
-    tachycardia_pred, hypertrophy_pred, cholesterol_pred,
-    tachycardia_prob, hypertrophy_prob, cholesterol_prob)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        timestamp, patient_id, heart_rate, hrv, spo2, systolic, diastolic, body_temp,
-        int(tachycardia_pred), int(hypertrophy_pred), int(cholesterol_pred),
-        tachycardia_prob, hypertrophy_prob, cholesterol_prob
-    ))
-    
-    reading_id = cursor.lastrowid
-    conn.commit()
-    
-    # Check if any dangerous condition is detected
-    is_dangerous = (int(tachycardia_pred) == 1 or 
-                   int(hypertrophy_pred) == 1 or 
-                   int(cholesterol_pred) == 1 or
-                   heart_rate > 120 or 
-                   systolic > 160 or 
-                   diastolic > 100 or
-                   spo2 < 92)
-    
-    # If dangerous condition detected, notify caregivers
-    if is_dangerous:
-        # Get patient details
-        cursor.execute('SELECT name FROM patients WHERE id = ?', (patient_id,))
-        patient_name = cursor.fetchone()[0]
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'heart_readings'")
+        row = cursor.fetchone()
+        first_id = (row[0] if row else 0) + 1
         
-        # Get caregivers for this patient
-        cursor.execute('''
-        SELECT c.name, c.email, pc.relationship 
-        FROM caregivers c
-        JOIN patient_caregivers pc ON c.id = pc.caregiver_id
-        WHERE pc.patient_id = ?
-        ''', (patient_id,))
+        cursor.executemany('''
+        INSERT INTO heart_readings 
+        (timestamp, patient_id, device_id, heart_rate, hrv, spo2, systolic, diastolic, body_temp,
+        tachycardia_pred, hypertrophy_pred, cholesterol_pred,
+        tachycardia_prob, hypertrophy_prob, cholesterol_prob, model_version)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
         
-        caregivers = cursor.fetchall()
+        # Keep the vitals rollups in step with the raw rows
+        rollups.update(cursor, [
+            (row[0], row[1], row[3], row[6], row[7], row[5], bool(conditions[i]))
+            for i, row in enumerate(rows)
+        ])
         
-        # Send notification to each caregiver
-        for caregiver in caregivers:
-            caregiver_name, caregiver_email, relationship = caregiver
-            send_danger_notification(
-                caregiver_email, 
-                caregiver_name,
-                patient_name, 
-                relationship,
-                {
-                    "heart_rate": heart_rate,
-                    "blood_pressure": blood_pressure,
-                    "spo2": spo2,
-                    "body_temp": round(body_temp, 1),
-                    "tachycardia": bool(tachycardia_pred),
-                    "hypertrophy": bool(hypertrophy_pred),
-                    "high_cholesterol": bool(cholesterol_pred)
-                }
-            )
+        # Queue caregiver alerts in the same transaction, in reading order;
+        # delivery happens in the background and repeats within an ongoing
+        # episode are suppressed. Episode changes are only applied to the
+        # tracker once the transaction commits.
+        alerts_queued = 0
+        alert_changes = {}
+        for i, row in enumerate(rows):
+            alerts_queued += queue_alerts(cursor, first_id + i, row[1], conditions[i], {
+                "heart_rate": row[3],
+                "blood_pressure": f"{row[6]}/{row[7]}",
+                "spo2": row[5],
+                "body_temp": round(row[8], 1),
+                "tachycardia": bool(row[9]),
+                "hypertrophy": bool(row[10]),
+                "high_cholesterol": bool(row[11])
+            }, timestamp=datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S"), pending=alert_changes)
         
-        # Mark notification as sent
-        cursor.execute('UPDATE heart_readings SET notification_sent = 1 WHERE id = ?', (reading_id,))
+        # Patient names for live subscribers, read inside the same transaction
+        patient_names = {}
+        if reading_broker.has_subscribers():
+            patient_ids = sorted({row[1] for row in rows})
+            cursor.execute(
+                f'SELECT id, name FROM patients WHERE id IN ({",".join("?" * len(patient_ids))})',
+                patient_ids
+            )
+            patient_names = {patient['id']: patient['name'] for patient in cursor.fetchall()}
         conn.commit()
+    finally:
+        # Releasing rolls back anything left uncommitted by an error
+        db_pool.release(conn)
+    alert_tracker.apply(alert_changes)
+    
+    if alerts_queued:
+        notification_worker.wake()
+    
+    if patient_names:
+        reading_broker.publish([
+            serialize_reading(dict(
+                zip(READING_COLUMNS, row),
+                id=first_id + i,
+                patient_name=patient_names.get(row[1]),
+                notification_sent=0
+            ))
+            for i, row in enumerate(rows)
+        ])
+    
+    results = []
+    for i, row in enumerate(rows):
+        result = format_reading_result(
+            row[0], row[1], row[3], row[4], row[5], f"{row[6]}/{row[7]}", row[8],
+            row[9], row[10], row[11], row[12], row[13], row[14], bool(conditions[i])
+        )
+        result["reading_id"] = first_id + i
+        result["device_id"] = row[2]
+        results.append(result)
     
-    conn.close()
-    
+    return results
+
+def format_reading_result(timestamp, patient_id, heart_rate, hrv, spo2, blood_pressure, body_temp,
+                          tachycardia_pred, hypertrophy_pred, cholesterol_pred,
+                          tachycardia_prob, hypertrophy_prob, cholesterol_prob, is_dangerous):
+    """Build the JSON response body for a stored reading"""
     return {
         "timestamp": timestamp,
         "patient_id": patient_id,
@@ -229,18 +233,39 @@ def calculate_health_metrics(heart_rate, patient_id):
             "High Cholesterol Probability": float(cholesterol_prob) if cholesterol_prob is not None else None
         },
         "Calculated Features": {
-            "Heart Rate (BPM)": heart_rate,
-            "HRV (ms)": hrv,
-            "SpO2 (%)": spo2,
+            "Heart Rate (BPM)": int(heart_rate),
+            "HRV (ms)": int(hrv),
+            "SpO2 (%)": int(spo2),
             "Blood Pressure": blood_pressure,
-            "Body Temperature (°C)": round(body_temp, 1)
+            "Body Temperature (°C)": round(float(body_temp), 1)
         },
-        "is_dangerous": is_dangerous
+        "is_dangerous": bool(is_dangerous)
     }
 
+def queue_alerts(cursor, reading_id, patient_id, conditions, health_data, timestamp=None, pending=None):
+    """Run a reading through the alert tracker and queue whatever it decides to send.
+    
+    Must be called for every reading, dangerous or not, so episodes can end.
+    `timestamp` (a datetime) is when the reading was taken.
+    """
+    decision = alert_tracker.observe(cursor, patient_id, conditions, health_data["heart_rate"],
+                                     now=timestamp, pending=pending)
+    queued = 0
+    
+    if decision.alert:
+        alert_data = dict(health_data, conditions=decision.alert, alert_reason=decision.reason)
+        queued += enqueue_alerts(cursor, reading_id, patient_id, alert_data)
+    
+    for digest in decision.digests:
+        queued += enqueue_alerts(cursor, None, patient_id, dict(digest, kind="digest"))
+    
+    return queued
+
 def send_danger_notification(caregiver_email, caregiver_name, patient_name, relationship, health_data):
     """Send email notification to caregiver about dangerous health condition"""
     subject = f"URGENT: Health Alert for {patient_name}"
+    if health_data.get('alert_reason') == 'escalation':
+        subject = f"URGENT: Worsening Health Alert for {patient_name}"
     
     # Create message body
     body = f"""
@@ -279,68 +304,224 @@ def send_danger_notification(caregiver_email, caregiver_name, patient_name, rela
         print(f"Failed to send email: {str(e)}")
         return False
 
-def get_recent_readings(patient_id=None, limit=10):
-    """Get recent readings from the database"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row  # This enables column access by name
+def send_episode_digest(caregiver_email, caregiver_name, patient_name, relationship, digest):
+    """Send a summary to a caregiver once a dangerous episode has ended"""
+    condition = digest['condition'].replace('_', ' ').title()
+    subject = f"Health Alert Resolved for {patient_name}: {condition}"
+    
+    body = f"""
+    Dear {caregiver_name},
+    
+    The {condition} episode for your {relationship}, {patient_name}, has ended.
+    
+    - Started: {digest['episode_started_at']}
+    - Ended: {digest['episode_ended_at']} ({digest['duration_minutes']} minutes)
+    - Dangerous readings: {digest['dangerous_readings']}
+    - Alerts sent: {digest['alerts_sent']}
+    - Peak Heart Rate: {digest['peak_heart_rate']} BPM
+    
+    This is an automated message. Please do not reply.
+    
+    Heart Monitoring System
+    """
+    
+    try:
+        msg = Message(
+            subject=subject,
+            recipients=[caregiver_email],
+            body=body
+        )
+        mail.send(msg)
+        return True
+    except Exception as e:
+        print(f"Failed to send email: {str(e)}")
+        return False
+
+def deliver_alert(alert):
+    """Send a queued alert; called by the notification worker outside any request"""
+    send = send_danger_notification
+    if alert['health_data'].get('kind') == 'digest':
+        send = send_episode_digest
+    
+    with app.app_context():
+        return send(
+            alert['caregiver_email'],
+            alert['caregiver_name'],
+            alert['patient_name'],
+            alert['relationship'],
+            alert['health_data']
+        )
+
+# Fan-out of newly stored readings to /api/stream clients
+reading_broker = ReadingBroker()
+
+# Background delivery of queued caregiver alerts
+notification_worker = NotificationWorker(db_pool, deliver_alert)
+
+# Readings from all request threads are written by one batching writer
+ingest_queue = IngestQueue(
+    store_readings,
+    max_pending=int(os.environ.get('INGEST_MAX_PENDING', 5000)),
+    max_batch=int(os.environ.get('INGEST_MAX_BATCH', 500)),
+    max_delay=float(os.environ.get('INGEST_MAX_DELAY_MS', 5)) / 1000
+)
+
+# Per-condition cooldowns can be overridden with e.g. ALERT_COOLDOWN_TACHYCARDIA=600
+alert_tracker = AlertTracker(
+    cooldowns={
+        condition: int(os.environ[f'ALERT_COOLDOWN_{condition.upper()}'])
+        for condition in ALERT_CONDITIONS
+        if f'ALERT_COOLDOWN_{condition.upper()}' in os.environ
+    },
+    escalation_delta=int(os.environ.get('ALERT_ESCALATION_DELTA', 20)),
+    resolve_after=int(os.environ.get('ALERT_RESOLVE_AFTER', 3))
+)
+
+def get_recent_readings(patient_id=None, limit=10, since_id=None):
+    """Get recent readings from the database, optionally only those newer than since_id"""
+    conn = db_pool.acquire()
     cursor = conn.cursor()
+    since_id = since_id or 0
     
     if patient_id:
         cursor.execute('''
         SELECT r.*, p.name as patient_name 
         FROM heart_readings r
         JOIN patients p ON r.patient_id = p.id
-        WHERE r.patient_id = ?
+        WHERE r.patient_id = ? AND r.id > ?
         ORDER BY r.id DESC
         LIMIT ?
-        ''', (patient_id, limit))
+        ''', (patient_id, since_id, limit))
     else:
         cursor.execute('''
         SELECT r.*, p.name as patient_name 
         FROM heart_readings r
         JOIN patients p ON r.patient_id = p.id
+        WHERE r.id > ?
         ORDER BY r.id DESC
         LIMIT ?
-        ''', (limit,))
+        ''', (since_id, limit))
     
     rows = cursor.fetchall()
-    conn.close()
+    db_pool.release(conn)
     
     # Convert to list of dicts for JSON serialization
-    result = []
-    for row in rows:
-        result.append({
-            "id": row['id'],
-            "timestamp": row['timestamp'],
-            "patient_id": row['patient_id'],
-            "patient_name": row['patient_name'],
-            "heart_rate": row['heart_rate'],
-            "hrv": row['hrv'],
-            "spo2": row['spo2'],
-            "systolic": row['systolic'],
-            "diastolic": row['diastolic'],
-            "body_temp": row['body_temp'],
-            "blood_pressure": f"{row['systolic']}/{row['diastolic']}",
-            "tachycardia_pred": row['tachycardia_pred'],
-            "hypertrophy_pred": row['hypertrophy_pred'],
-            "cholesterol_pred": row['cholesterol_pred'],
-            "tachycardia_prob": row['tachycardia_prob'],
-            "hypertrophy_prob": row['hypertrophy_prob'],
-            "cholesterol_prob": row['cholesterol_prob'],
-            "notification_sent": row['notification_sent']
-        })
+    return [serialize_reading(row) for row in rows]
+
+def get_latest_reading_id(patient_id=None):
+    """Get the id of the newest reading (for one patient), or 0 if there are none"""
+    conn = db_pool.acquire()
     
-    return result
+    if patient_id:
+        row = conn.execute(
+            'SELECT COALESCE(MAX(id), 0) FROM heart_readings WHERE patient_id = ?', (patient_id,)
+        ).fetchone()
+    else:
+        row = conn.execute('SELECT COALESCE(MAX(id), 0) FROM heart_readings').fetchone()
+    
+    db_pool.release(conn)
+    return row[0]
+
+def parse_timestamp(value):
+    """Normalise an ISO date or datetime to the stored timestamp format"""
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is not None:
+        # Stored timestamps are server local time
+        timestamp = timestamp.astimezone().replace(tzinfo=None)
+    return timestamp.strftime("%Y-%m-%d %H:%M:%S")
+
+def parse_reading_timestamp(value):
+    """Stored timestamp for a device-supplied `timestamp` field, or None if absent; raises ValueError"""
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        raise ValueError("Invalid timestamp: expected an ISO 8601 string")
+    try:
+        return parse_timestamp(value)
+    except ValueError:
+        raise ValueError(f"Invalid timestamp: {value}")
+
+def iter_reading_history(patient_id, patient_name, start=None, end=None, before_id=None, limit=500, chunk_size=200):
+    """Yield one page of a patient's readings as JSON text, newest first.
+    
+    Keyset pagination on (patient_id, id): the page holds readings with
+    id < before_id, and next_cursor is the id to pass as the next before_id
+    (null on the last page). Rows are fetched and encoded `chunk_size` at a
+    time so a large page never sits in memory.
+    """
+    conditions = ['patient_id = ?']
+    params = [patient_name, patient_id]
+    if before_id is not None:
+        conditions.append('id < ?')
+        params.append(before_id)
+    if start is not None:
+        conditions.append('timestamp >= ?')
+        params.append(start)
+    if end is not None:
+        conditions.append('timestamp < ?')
+        params.append(end)
+    # One extra row tells us whether there is another page
+    params.append(limit + 1)
+    
+    with db_pool.connection() as conn:
+        cursor = conn.execute(f'''
+        SELECT *, ? as patient_name
+        FROM heart_readings
+        WHERE {' AND '.join(conditions)}
+        ORDER BY id DESC
+        LIMIT ?
+        ''', params)
+        
+        yield f'{{"patient_id": {patient_id}, "readings": ['
+        count = 0
+        next_cursor = None
+        while next_cursor is None:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            chunk = []
+            for row in rows:
+                if count == limit:
+                    next_cursor = last_id
+                    break
+                chunk.append(json.dumps(serialize_reading(row)))
+                count += 1
+                last_id = row['id']
+            if chunk:
+                yield (', ' if count > len(chunk) else '') + ', '.join(chunk)
+        yield f'], "count": {count}, "next_cursor": {json.dumps(next_cursor)}}}'
+
+def serialize_reading(row):
+    """Convert a heart_readings row (plus patient_name) to the JSON shape used by the dashboard"""
+    return {
+        "id": row['id'],
+        "timestamp": row['timestamp'],
+        "patient_id": row['patient_id'],
+        "patient_name": row['patient_name'],
+        "heart_rate": row['heart_rate'],
+        "hrv": row['hrv'],
+        "spo2": row['spo2'],
+        "systolic": row['systolic'],
+        "diastolic": row['diastolic'],
+        "body_temp": row['body_temp'],
+        "blood_pressure": f"{row['systolic']}/{row['diastolic']}",
+        "tachycardia_pred": row['tachycardia_pred'],
+        "hypertrophy_pred": row['hypertrophy_pred'],
+        "cholesterol_pred": row['cholesterol_pred'],
+        "tachycardia_prob": row['tachycardia_prob'],
+        "hypertrophy_prob": row['hypertrophy_prob'],
+        "cholesterol_prob": row['cholesterol_prob'],
+        "notification_sent": row['notification_sent']
+    }
 
 def get_all_patients():
     """Get all patients from the database"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = db_pool.acquire()
     cursor = conn.cursor()
     
     cursor.execute('SELECT * FROM patients ORDER BY name')
     rows = cursor.fetchall()
-    conn.close()
+    db_pool.release(conn)
     
     result = []
     for row in rows:
@@ -350,8 +531,7 @@ def get_all_patients():
 
 def get_patient(patient_id):
     """Get a specific patient from the database"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = db_pool.acquire()
     cursor = conn.cursor()
     
     cursor.execute('SELECT * FROM patients WHERE id = ?', (patient_id,))
@@ -374,21 +554,20 @@ def get_patient(patient_id):
             caregivers.append(caregiver)
         
         patient['caregivers'] = caregivers
-        conn.close()
+        db_pool.release(conn)
         return patient
     
-    conn.close()
+    db_pool.release(conn)
     return None
 
 def get_all_caregivers():
     """Get all caregivers from the database"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = db_pool.acquire()
     cursor = conn.cursor()
     
     cursor.execute('SELECT * FROM caregivers ORDER BY name')
     rows = cursor.fetchall()
-    conn.close()
+    db_pool.release(conn)
     
     result = []
     for row in rows:
@@ -398,8 +577,10 @@ def get_all_caregivers():
 
 def get_all_devices():
     """Get all devices from the database"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    # Write pending last_seen updates so the page shows them
+    device_registry.flush()
+    
+    conn = db_pool.acquire()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -410,7 +591,7 @@ def get_all_devices():
     ''')
     
     rows = cursor.fetchall()
-    conn.close()
+    db_pool.release(conn)
     
     result = []
     for row in rows:
@@ -420,8 +601,10 @@ def get_all_devices():
 
 def get_device(device_id):
     """Get a specific device from the database"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    # Write pending last_seen updates so the page shows them
+    device_registry.flush()
+    
+    conn = db_pool.acquire()
     cursor = conn.cursor()
     
     cursor.execute('SELECT * FROM devices WHERE device_id = ?', (device_id,))
@@ -429,35 +612,22 @@ def get_device(device_id):
     
     if row:
         device = dict(row)
-        conn.close()
+        db_pool.release(conn)
         return device
     
-    conn.close()
+    db_pool.release(conn)
     return None
 
 def verify_device_api_key(device_id, api_key):
-    """Verify if the provided API key matches the device"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT api_key FROM devices WHERE device_id = ?', (device_id,))
-    row = cursor.fetchone()
-    
-    if row and row[0] == api_key:
-        # Update last_seen timestamp
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        cursor.execute('UPDATE devices SET last_seen = ? WHERE device_id = ?', (now, device_id))
-        conn.commit()
-        conn.close()
-        return True
-    
-    conn.close()
-    return False
+    """Verify if the provided API key matches the device (last_seen is updated lazily)"""
+    return device_registry.authenticate(device_id, api_key) is not None
 
 def get_patient_devices(patient_id):
     """Get all devices assigned to a patient"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    # Write pending last_seen updates so the page shows them
+    device_registry.flush()
+    
+    conn = db_pool.acquire()
     cursor = conn.cursor()
     
     cursor.execute('SELECT * FROM devices WHERE patient_id = ?', (patient_id,))
@@ -467,9 +637,46 @@ def get_patient_devices(patient_id):
     for row in rows:
         result.append(dict(row))
     
-    conn.close()
+    db_pool.release(conn)
     return result
 
+def parse_risk_inputs(data):
+    """(n, 2) array of (heart_rate, blood_glucose) from a /predict JSON body.
+    
+    Accepts one {"heart_rate": ..., "blood_glucose": ...} object or a list of
+    such objects or of [heart_rate, blood_glucose] pairs. Raises ValueError.
+    """
+    items = data if isinstance(data, list) else [data]
+    if not items:
+        raise ValueError("No inputs given")
+    if len(items) > PREDICT_MAX_BATCH:
+        raise ValueError(f"At most {PREDICT_MAX_BATCH} inputs per request")
+    
+    pairs = []
+    for item in items:
+        if isinstance(item, dict):
+            if any(name not in item for name in RISK_FEATURES):
+                raise ValueError(f"Each input needs {' and '.join(RISK_FEATURES)}")
+            item = [item[name] for name in RISK_FEATURES]
+        if not isinstance(item, (list, tuple)) or len(item) != len(RISK_FEATURES):
+            raise ValueError("Inputs must be objects or [heart_rate, blood_glucose] pairs")
+        pairs.append(item)
+    
+    try:
+        X = np.array(pairs, dtype=float)
+    except (TypeError, ValueError):
+        raise ValueError("heart_rate and blood_glucose must be numbers")
+    if not np.isfinite(X).all() or (X <= 0).any():
+        raise ValueError("heart_rate and blood_glucose must be positive numbers")
+    return X
+
+def ingest_busy_response(error):
+    """503 for a request turned away by a full ingest queue"""
+    response = jsonify({"error": str(error)})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
 def generate_api_key():
     """Generate a unique API key for a device"""
     return uuid.uuid4().hex
@@ -496,10 +703,195 @@ def index():
 
 @app.route("/api/data", methods=["GET"])
 def get_data():
-    """API endpoint to get recent readings for real-time updates"""
+    """API endpoint to get recent readings for real-time updates.
+    
+    With since_id only readings newer than that id are returned. The ETag is
+    derived from the newest reading id, so a client sending it back in
+    If-None-Match gets a 304 until a new reading arrives.
+    """
     patient_id = request.args.get('patient_id', type=int)
-    recent_readings = get_recent_readings(patient_id, 10)
-    return jsonify({"readings": recent_readings})
+    since_id = request.args.get('since_id', type=int)
+    
+    latest_id = get_latest_reading_id(patient_id)
+    etag = f"readings-{patient_id or 'all'}-{latest_id}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        # Nothing newer than since_id means no need to touch the readings at all
+        if since_id is not None and since_id >= latest_id:
+            recent_readings = []
+        else:
+            recent_readings = get_recent_readings(patient_id, 10, since_id)
+        if recent_readings and recent_readings[0]['id'] > latest_id:
+            # A reading was stored between the two queries
+            latest_id = recent_readings[0]['id']
+            etag = f"readings-{patient_id or 'all'}-{latest_id}"
+        response = jsonify({"readings": recent_readings, "latest_id": latest_id})
+    
+    response.set_etag(etag)
+    # Let caches store the response but always revalidate it
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route("/api/stream", methods=["GET"])
+def stream_readings():
+    """Server-Sent Events stream of new readings, optionally for one patient"""
+    patient_id = request.args.get('patient_id', type=int)
+    subscription = reading_broker.subscribe(patient_id)
+    
+    def generate():
+        try:
+            # Ask browsers to reconnect after 5s if the connection drops
+            yield "retry: 5000\n\n"
+            while True:
+                reading = subscription.get(timeout=15)
+                if reading is None:
+                    # Comment line keeps proxies from closing an idle connection
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"id: {reading['id']}\nevent: reading\ndata: {json.dumps(reading)}\n\n"
+        finally:
+            reading_broker.unsubscribe(subscription)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.route("/api/patients/<int:patient_id>/readings", methods=["GET"])
+def patient_reading_history(patient_id):
+    """API endpoint to page through a patient's readings.
+    
+    Query parameters: `from` (inclusive) and `to` (exclusive) ISO timestamps,
+    `limit` (page size) and `cursor` (next_cursor from the previous page).
+    """
+    patient = get_patient(patient_id)
+    if not patient:
+        return jsonify({"error": "Patient not found"}), 404
+    
+    try:
+        start = parse_timestamp(request.args['from']) if 'from' in request.args else None
+        end = parse_timestamp(request.args['to']) if 'to' in request.args else None
+    except ValueError:
+        return jsonify({"error": "Invalid from/to timestamp"}), 400
+    
+    limit = request.args.get('limit', READINGS_PAGE_SIZE, type=int)
+    if limit < 1 or limit > READINGS_MAX_PAGE_SIZE:
+        return jsonify({"error": f"limit must be between 1 and {READINGS_MAX_PAGE_SIZE}"}), 400
+    before_id = request.args.get('cursor', type=int)
+    
+    return Response(
+        iter_reading_history(patient_id, patient['name'], start, end, before_id, limit),
+        mimetype="application/json"
+    )
+
+@app.route("/api/patients/<int:patient_id>/vitals", methods=["GET"])
+def patient_vitals(patient_id):
+    """API endpoint for a patient's vitals trend, aggregated into time buckets.
+    
+    Query parameters: `from` (inclusive) and `to` (exclusive) ISO timestamps,
+    defaulting to the last 24 hours, and `resolution` (1m, 1h, 1d or auto).
+    Auto picks the finest resolution that keeps the number of buckets small.
+    """
+    patient = get_patient(patient_id)
+    if not patient:
+        return jsonify({"error": "Patient not found"}), 404
+    
+    try:
+        end = parse_timestamp(request.args['to']) if 'to' in request.args else datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if 'from' in request.args:
+            start = parse_timestamp(request.args['from'])
+        else:
+            start = (datetime.strptime(end, "%Y-%m-%d %H:%M:%S") - timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return jsonify({"error": "Invalid from/to timestamp"}), 400
+    if start >= end:
+        return jsonify({"error": "from must be before to"}), 400
+    
+    resolution = request.args.get('resolution', 'auto')
+    if resolution == 'auto':
+        resolution = rollups.pick_resolution(
+            datetime.strptime(start, "%Y-%m-%d %H:%M:%S"),
+            datetime.strptime(end, "%Y-%m-%d %H:%M:%S")
+        )
+    elif resolution not in rollups.RESOLUTIONS:
+        return jsonify({"error": f"resolution must be auto or one of {', '.join(rollups.RESOLUTIONS)}"}), 400
+    
+    with db_pool.connection() as conn:
+        buckets = rollups.query(conn.cursor(), patient_id, resolution, start, end)
+    
+    return jsonify({
+        "patient_id": patient_id,
+        "resolution": resolution,
+        "from": start,
+        "to": end,
+        "buckets": buckets
+    })
+
+@app.route("/api/models", methods=["GET"])
+def model_status():
+    """API endpoint for the active model version and the versions loaded so far"""
+    return jsonify({
+        "version": model_registry.engine.version,
+        "history": model_registry.history
+    })
+
+@app.route("/predict", methods=["GET", "POST"])
+def predict():
+    """Heart disease risk from heart rate and blood glucose.
+    
+    The form in predict.html gets result.html back. A JSON body (one input or
+    a list of them, see parse_risk_inputs) is scored in a single pass and
+    gets one result per input plus the time the request took.
+    """
+    if request.method == "GET":
+        return render_template("predict.html")
+    
+    start = time.perf_counter()
+    try:
+        if request.is_json:
+            X = parse_risk_inputs(request.get_json())
+        else:
+            X = parse_risk_inputs({name: request.form.get(name) for name in RISK_FEATURES})
+    except ValueError as e:
+        if request.is_json:
+            return jsonify({"error": str(e)}), 400
+        flash(f"Error: {str(e)}", "error")
+        return redirect(url_for('predict'))
+    
+    labels, probabilities = risk_model.predict(X)
+    latency_ms = (time.perf_counter() - start) * 1000
+    
+    if not request.is_json:
+        level, colour = risk_level(probabilities[0])
+        response = Response(render_template(
+            "result.html",
+            heart_rate=f"{X[0, 0]:g}",
+            blood_glucose=f"{X[0, 1]:g}",
+            prediction=round(float(probabilities[0]), 4),
+            risk_level=level,
+            risk_class=colour
+        ))
+    else:
+        results = []
+        for (heart_rate, blood_glucose), label, probability in zip(X.tolist(), labels.tolist(), probabilities.tolist()):
+            results.append({
+                "heart_rate": heart_rate,
+                "blood_glucose": blood_glucose,
+                "prediction": label,
+                "probability": round(probability, 4),
+                "risk_level": risk_level(probability)[0]
+            })
+        response = jsonify({
+            "results": results,
+            "count": len(results),
+            "model_version": risk_model.version,
+            "latency_ms": round(latency_ms, 3)
+        })
+    
+    response.headers['Server-Timing'] = f"predict;dur={latency_ms:.3f}"
+    return response
 
 @app.route("/api/add_reading", methods=["POST"])
 def add_reading():
@@ -518,6 +910,8 @@ def add_reading():
                 
             result = calculate_health_metrics(heart_rate, patient_id)
             return jsonify({"success": True, "data": result})
+        except QueueFull as e:
+            return ingest_busy_response(e)
         except Exception as e:
             return jsonify({"error": str(e)}), 500
 
@@ -536,7 +930,7 @@ def submit_reading():
             result = calculate_health_metrics(heart_rate, patient_id)
             
             if result["is_dangerous"]:
-                flash("Warning: Dangerous health condition detected! Caregivers have been notified.", "warning")
+                flash("Warning: Dangerous health condition detected! Caregivers are being notified.", "warning")
             else:
                 flash("Reading added successfully", "success")
                 
@@ -562,14 +956,13 @@ def add_patient():
             gender = request.form["gender"]
             medical_history = request.form.get("medical_history", "")
             
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute(
-                'INSERT INTO patients (name, age, gender, medical_history, created_at) VALUES (?, ?, ?, ?, ?)',
-                (name, age, gender, medical_history, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-            )
-            conn.commit()
-            conn.close()
+            with db_pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    'INSERT INTO patients (name, age, gender, medical_history, created_at) VALUES (?, ?, ?, ?, ?)',
+                    (name, age, gender, medical_history, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+                )
+                conn.commit()
             
             flash("Patient added successfully", "success")
             return redirect(url_for('list_patients'))
@@ -615,14 +1008,13 @@ def edit_patient(patient_id):
             gender = request.form["gender"]
             medical_history = request.form.get("medical_history", "")
             
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute(
-                'UPDATE patients SET name = ?, age = ?, gender = ?, medical_history = ? WHERE id = ?',
-                (name, age, gender, medical_history, patient_id)
-            )
-            conn.commit()
-            conn.close()
+            with db_pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    'UPDATE patients SET name = ?, age = ?, gender = ?, medical_history = ? WHERE id = ?',
+                    (name, age, gender, medical_history, patient_id)
+                )
+                conn.commit()
             
             flash("Patient updated successfully", "success")
             return redirect(url_for('view_patient', patient_id=patient_id))
@@ -648,14 +1040,13 @@ def add_caregiver():
             email = request.form["email"]
             phone = request.form.get("phone", "")
             
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute(
-                'INSERT INTO caregivers (name, email, phone, created_at) VALUES (?, ?, ?, ?)',
-                (name, email, phone, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-            )
-            conn.commit()
-            conn.close()
+            with db_pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    'INSERT INTO caregivers (name, email, phone, created_at) VALUES (?, ?, ?, ?)',
+                    (name, email, phone, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+                )
+                conn.commit()
             
             flash("Caregiver added successfully", "success")
             return redirect(url_for('list_caregivers'))
@@ -671,15 +1062,14 @@ def add_caregiver():
 @app.route("/caregivers/<int:caregiver_id>/edit", methods=["GET", "POST"])
 def edit_caregiver(caregiver_id):
     """Edit a caregiver"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = db_pool.acquire()
     cursor = conn.cursor()
     
     cursor.execute('SELECT * FROM caregivers WHERE id = ?', (caregiver_id,))
     caregiver = dict(cursor.fetchone() or {})
     
     if not caregiver:
-        conn.close()
+        db_pool.release(conn)
         flash("Caregiver not found", "error")
         return redirect(url_for('list_caregivers'))
     
@@ -694,18 +1084,20 @@ def edit_caregiver(caregiver_id):
                 (name, email, phone, caregiver_id)
             )
             conn.commit()
-            conn.close()
+            db_pool.release(conn)
             
             flash("Caregiver updated successfully", "success")
             return redirect(url_for('list_caregivers'))
         except sqlite3.IntegrityError:
+            db_pool.release(conn)
             flash("A caregiver with this email already exists", "error")
             return redirect(url_for('edit_caregiver', caregiver_id=caregiver_id))
         except Exception as e:
+            db_pool.release(conn)
             flash(f"Error: {str(e)}", "error")
             return redirect(url_for('edit_caregiver', caregiver_id=caregiver_id))
     
-    conn.close()
+    db_pool.release(conn)
     return render_template("edit_caregiver.html", caregiver=caregiver)
 
 # Patient-Caregiver Association Routes
@@ -716,35 +1108,32 @@ def add_patient_caregiver(patient_id):
         caregiver_id = int(request.form["caregiver_id"])
         relationship = request.form["relationship"]
         
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Check if patient exists
-        cursor.execute('SELECT id FROM patients WHERE id = ?', (patient_id,))
-        if not cursor.fetchone():
-            conn.close()
-            flash("Patient not found", "error")
-            return redirect(url_for('list_patients'))
-        
-        # Check if caregiver exists
-        cursor.execute('SELECT id FROM caregivers WHERE id = ?', (caregiver_id,))
-        if not cursor.fetchone():
-            conn.close()
-            flash("Caregiver not found", "error")
-            return redirect(url_for('view_patient', patient_id=patient_id))
-        
-        # Add association
-        try:
-            cursor.execute(
-                'INSERT INTO patient_caregivers (patient_id, caregiver_id, relationship, created_at) VALUES (?, ?, ?, ?)',
-                (patient_id, caregiver_id, relationship, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-            )
-            conn.commit()
-            flash("Caregiver associated with patient successfully", "success")
-        except sqlite3.IntegrityError:
-            flash("This caregiver is already associated with this patient", "error")
-        
-        conn.close()
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            # Check if patient exists
+            cursor.execute('SELECT id FROM patients WHERE id = ?', (patient_id,))
+            if not cursor.fetchone():
+                flash("Patient not found", "error")
+                return redirect(url_for('list_patients'))
+            
+            # Check if caregiver exists
+            cursor.execute('SELECT id FROM caregivers WHERE id = ?', (caregiver_id,))
+            if not cursor.fetchone():
+                flash("Caregiver not found", "error")
+                return redirect(url_for('view_patient', patient_id=patient_id))
+            
+            # Add association
+            try:
+                cursor.execute(
+                    'INSERT INTO patient_caregivers (patient_id, caregiver_id, relationship, created_at) VALUES (?, ?, ?, ?)',
+                    (patient_id, caregiver_id, relationship, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+                )
+                conn.commit()
+                flash("Caregiver associated with patient successfully", "success")
+            except sqlite3.IntegrityError:
+                flash("This caregiver is already associated with this patient", "error")
+            
         return redirect(url_for('view_patient', patient_id=patient_id))
     except Exception as e:
         flash(f"Error: {str(e)}", "error")
@@ -754,15 +1143,14 @@ def add_patient_caregiver(patient_id):
 def remove_patient_caregiver(patient_id, caregiver_id):
     """Remove a caregiver association from a patient"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            'DELETE FROM patient_caregivers WHERE patient_id = ? AND caregiver_id = ?',
-            (patient_id, caregiver_id)
-        )
-        conn.commit()
-        conn.close()
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'DELETE FROM patient_caregivers WHERE patient_id = ? AND caregiver_id = ?',
+                (patient_id, caregiver_id)
+            )
+            conn.commit()
         
         flash("Caregiver removed from patient successfully", "success")
     except Exception as e:
@@ -790,19 +1178,19 @@ def add_device():
             device_id = f"DEV-{uuid.uuid4().hex[:8].upper()}"
             api_key = generate_api_key()
             
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            
-            # Convert empty string to NULL for patient_id
-            if patient_id == "":
-                patient_id = None
-            
-            cursor.execute(
-                'INSERT INTO devices (device_id, device_name, device_type, patient_id, api_key, created_at) VALUES (?, ?, ?, ?, ?, ?)',
-                (device_id, device_name, device_type, patient_id, api_key, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-            )
-            conn.commit()
-            conn.close()
+            with db_pool.connection() as conn:
+                cursor = conn.cursor()
+                
+                # Convert empty string to NULL for patient_id
+                if patient_id == "":
+                    patient_id = None
+                
+                cursor.execute(
+                    'INSERT INTO devices (device_id, device_name, device_type, patient_id, api_key, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                    (device_id, device_name, device_type, patient_id, api_key, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+                )
+                conn.commit()
+            device_registry.invalidate(device_id)
             
             flash(f"Device added successfully. Device ID: {device_id}", "success")
             return redirect(url_for('view_device', device_id=device_id))
@@ -823,8 +1211,7 @@ def view_device(device_id):
         return redirect(url_for('list_devices'))
     
     # Get recent readings from this device
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = db_pool.acquire()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -840,7 +1227,7 @@ def view_device(device_id):
     for row in cursor.fetchall():
         readings.append(dict(row))
     
-    conn.close()
+    db_pool.release(conn)
     
     # Get all patients for reassignment
     patients = get_all_patients()
@@ -867,19 +1254,19 @@ def edit_device(device_id):
         patient_id = request.form.get("patient_id")
         status = request.form["status"]
         
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Convert empty string to NULL for patient_id
-        if patient_id == "":
-            patient_id = None
-        
-        cursor.execute(
-            'UPDATE devices SET device_name = ?, device_type = ?, patient_id = ?, status = ? WHERE device_id = ?',
-            (device_name, device_type, patient_id, status, device_id)
-        )
-        conn.commit()
-        conn.close()
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            # Convert empty string to NULL for patient_id
+            if patient_id == "":
+                patient_id = None
+            
+            cursor.execute(
+                'UPDATE devices SET device_name = ?, device_type = ?, patient_id = ?, status = ? WHERE device_id = ?',
+                (device_name, device_type, patient_id, status, device_id)
+            )
+            conn.commit()
+        device_registry.invalidate(device_id)
         
         flash("Device updated successfully", "success")
     except Exception as e:
@@ -898,11 +1285,11 @@ def regenerate_device_key(device_id):
     try:
         new_api_key = generate_api_key()
         
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('UPDATE devices SET api_key = ? WHERE device_id = ?', (new_api_key, device_id))
-        conn.commit()
-        conn.close()
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE devices SET api_key = ? WHERE device_id = ?', (new_api_key, device_id))
+            conn.commit()
+        device_registry.invalidate(device_id)
         
         flash("API key regenerated successfully", "success")
     except Exception as e:
@@ -910,6 +1297,27 @@ def regenerate_device_key(device_id):
     
     return redirect(url_for('view_device', device_id=device_id))
 
+def authorize_device(device_id, api_key):
+    """Check a device's credentials and assignment.
+    
+    Returns (patient_id, None, None) on success or (None, error, status_code).
+    """
+    # Verify device and API key; the cached entry also carries patient and status
+    device = device_registry.authenticate(device_id, api_key)
+    if device is None:
+        return None, "Invalid device ID or API key", 401
+    
+    patient_id = device['patient_id']
+    status = device['status']
+    
+    if status != 'active':
+        return None, "Device is not active", 403
+    
+    if not patient_id:
+        return None, "Device is not assigned to a patient", 400
+    
+    return patient_id, None, None
+
 # Add IoT device endpoints
 @app.route("/api/iot/reading", methods=["POST"])
 def iot_add_reading():
@@ -927,40 +1335,95 @@ def iot_add_reading():
         api_key = data["api_key"]
         heart_rate = int(data["heart_rate"])
         
-        # Verify device and API key
-        if not verify_device_api_key(device_id, api_key):
-            return jsonify({"error": "Invalid device ID or API key"}), 401
+        try:
+            timestamp = parse_reading_timestamp(data.get("timestamp"))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
-        # Get the patient ID associated with this device
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('SELECT patient_id, status FROM devices WHERE device_id = ?', (device_id,))
-        row = cursor.fetchone()
-        conn.close()
+        patient_id, error, status_code = authorize_device(device_id, api_key)
+        if error:
+            return jsonify({"error": error}), status_code
         
-        if not row:
-            return jsonify({"error": "Device not found"}), 404
+        # Calculate health metrics and store the reading with its source device
+        result = calculate_health_metrics(heart_rate, patient_id, device_id, timestamp)
         
-        patient_id, status = row
+        return jsonify({"success": True, "data": result})
+    except QueueFull as e:
+        return ingest_busy_response(e)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/iot/readings:batch", methods=["POST"])
+def iot_add_readings_batch():
+    """API endpoint for IoT devices to flush many buffered readings at once
+    
+    Accepts {"readings": [{"device_id", "api_key", "heart_rate", "timestamp"?}, ...]}
+    (at most IOT_MAX_BATCH of them) and returns one result per reading, in input order.
+    """
+    try:
+        data = request.json
+        readings = data.get("readings") if isinstance(data, dict) else data
         
-        if status != 'active':
-            return jsonify({"error": "Device is not active"}), 403
+        if not isinstance(readings, list) or not readings:
+            return jsonify({"error": "Expected a non-empty list of readings"}), 400
+        if len(readings) > IOT_MAX_BATCH:
+            return jsonify({"error": f"At most {IOT_MAX_BATCH} readings per request"}), 400
         
-        if not patient_id:
-            return jsonify({"error": "Device is not assigned to a patient"}), 400
+        results = [None] * len(readings)
+        auth_cache = {}
+        accepted = []  # (index, device_id, patient_id, heart_rate, timestamp)
         
-        # Calculate health metrics and store reading
-        result = calculate_health_metrics(heart_rate, patient_id)
+        # Validate readings and authenticate each device only once
+        for index, reading in enumerate(readings):
+            if not isinstance(reading, dict):
+                results[index] = {"success": False, "error": "Reading must be an object", "status": 400}
+                continue
+            
+            missing = [field for field in ("device_id", "api_key", "heart_rate") if field not in reading]
+            if missing:
+                results[index] = {"success": False, "error": f"Missing required field: {missing[0]}", "status": 400}
+                continue
+            
+            try:
+                heart_rate = int(reading["heart_rate"])
+            except (TypeError, ValueError):
+                heart_rate = 0
+            if heart_rate <= 0:
+                results[index] = {"success": False, "error": "Invalid heart rate", "status": 400}
+                continue
+            
+            try:
+                timestamp = parse_reading_timestamp(reading.get("timestamp"))
+            except ValueError as e:
+                results[index] = {"success": False, "error": str(e), "status": 400}
+                continue
+            
+            key = (reading["device_id"], reading["api_key"])
+            if key not in auth_cache:
+                auth_cache[key] = authorize_device(*key)
+            patient_id, error, status_code = auth_cache[key]
+            if error:
+                results[index] = {"success": False, "error": error, "status": status_code}
+                continue
+            
+            accepted.append((index, reading["device_id"], patient_id, heart_rate, timestamp))
         
-        # Update the device_id in the reading
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('UPDATE heart_readings SET device_id = ? WHERE id = (SELECT MAX(id) FROM heart_readings WHERE patient_id = ?)', 
-                      (device_id, patient_id))
-        conn.commit()
-        conn.close()
+        if accepted:
+            stored = ingest_readings([
+                (patient_id, device_id, heart_rate, timestamp)
+                for _, device_id, patient_id, heart_rate, timestamp in accepted
+            ])
+            for (index, *_), result in zip(accepted, stored):
+                results[index] = {"success": True, "data": result}
         
-        return jsonify({"success": True, "data": result})
+        return jsonify({
+            "success": True,
+            "accepted": len(accepted),
+            "rejected": len(readings) - len(accepted),
+            "results": results
+        })
+    except QueueFull as e:
+        return ingest_busy_response(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -980,6 +1443,19 @@ def patient_devices(patient_id):
 # Initialize database before running app
 init_db()
 
+# Resume alert episodes that were ongoing when the app last stopped
+with db_pool.connection() as conn:
+    alert_tracker.load(conn.cursor())
+
+# Deliver any alerts left in the outbox by a previous run
+notification_worker.start()
+
+# Pick up retrained models as they are copied into model/
+model_registry.start()
+
+# Writer for readings submitted by request threads
+ingest_queue.start()
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000, threaded=True)
 
@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the Heart Monitoring System
+
+Each benchmark builds its own scratch data, so it never touches heart_monitor.db.
+
+Usage:
+  python benchmarks.py readings --rows=10000000
+  python benchmarks.py startup --workers=4
+  python benchmarks.py ingest --threads=64
+  python benchmarks.py geoip --ranges=1000000
+  python benchmarks.py locations --rows=1000000
+"""
+
+import argparse
+import ipaddress
+import json
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from migrations import migrate
+
+
+def time_query(conn, sql, params_list):
+    """Run a query once per parameter set and return the latencies in ms"""
+    latencies = []
+    for params in params_list:
+        start = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def report(label, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if len(latencies) >= 20 else latencies[-1]
+    print(f"  {label:<45} median {statistics.median(latencies):9.3f} ms   p95 {p95:9.3f} ms")
+
+
+def populate_readings(conn, rows, patients, devices, chunk_size=100_000):
+    """Fill heart_readings with synthetic rows as fast as SQLite allows"""
+    now = datetime.now()
+    conn.executemany(
+        'INSERT INTO patients (id, name, age, gender, created_at) VALUES (?, ?, ?, ?, ?)',
+        [(i, f"Patient {i}", 50, 'F', now.strftime("%Y-%m-%d %H:%M:%S")) for i in range(1, patients + 1)]
+    )
+    conn.commit()
+
+    rng = random.Random(0)
+    start = now - timedelta(seconds=rows)
+    inserted = 0
+    while inserted < rows:
+        batch = []
+        for i in range(inserted, min(rows, inserted + chunk_size)):
+            device = rng.randrange(devices)
+            heart_rate = rng.randint(50, 160)
+            batch.append((
+                (start + timedelta(seconds=i)).strftime("%Y-%m-%d %H:%M:%S"),
+                device % patients + 1,
+                f"DEV-{device:08X}",
+                heart_rate, max(20, 100 - heart_rate), 98 if heart_rate < 100 else 95,
+                110 + heart_rate // 10, 70 + heart_rate // 20, 36.6 + (heart_rate - 70) * 0.01,
+                0, 1, 0, 0.01, 0.99, 0.01
+            ))
+        conn.executemany('''
+        INSERT INTO heart_readings
+        (timestamp, patient_id, device_id, heart_rate, hrv, spo2, systolic, diastolic, body_temp,
+        tachycardia_pred, hypertrophy_pred, cholesterol_pred,
+        tachycardia_prob, hypertrophy_prob, cholesterol_prob)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', batch)
+        conn.commit()
+        inserted += len(batch)
+        print(f"\r  inserted {inserted:,}/{rows:,} rows", end="", flush=True)
+    print()
+
+
+def bench_readings(args):
+    """Latency of the heart_readings hot queries before and after the index migration"""
+    path = os.path.join(tempfile.mkdtemp(), 'bench_readings.db')
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = OFF')
+
+    print(f"Building {args.rows:,} readings for {args.patients:,} patients in {path}")
+    migrate(conn, target=1)  # Schema as it was before the index migration
+    start = time.perf_counter()
+    populate_readings(conn, args.rows, args.patients, args.devices)
+    print(f"  load took {time.perf_counter() - start:.1f}s")
+
+    rng = random.Random(1)
+    patient_ids = [(rng.randint(1, args.patients),) for _ in range(args.repeat)]
+    device_ids = [(f"DEV-{rng.randrange(args.devices):08X}",) for _ in range(args.repeat)]
+    queries = [
+        ('get_recent_readings(patient_id, 10)', '''
+            SELECT r.*, p.name as patient_name
+            FROM heart_readings r
+            JOIN patients p ON r.patient_id = p.id
+            WHERE r.patient_id = ?
+            ORDER BY r.id DESC
+            LIMIT 10
+        ''', [(p[0],) for p in patient_ids]),
+        ('view_device readings (LIMIT 20)', '''
+            SELECT r.*, p.name as patient_name
+            FROM heart_readings r
+            JOIN patients p ON r.patient_id = p.id
+            WHERE r.device_id = ?
+            ORDER BY r.id DESC
+            LIMIT 20
+        ''', device_ids),
+        ('SELECT MAX(id) ... WHERE patient_id = ?',
+         'SELECT MAX(id) FROM heart_readings WHERE patient_id = ?', patient_ids),
+    ]
+
+    # Full scans are slow at 10M rows, so sample fewer of them
+    scan_repeat = max(3, args.repeat // 20)
+    print("Without indexes:")
+    for label, sql, params in queries:
+        report(label, time_query(conn, sql, params[:scan_repeat]))
+
+    start = time.perf_counter()
+    migrate(conn)
+    print(f"  index migration took {time.perf_counter() - start:.1f}s")
+
+    print("With indexes:")
+    for label, sql, params in queries:
+        report(label, time_query(conn, sql, params))
+
+    conn.close()
+    if not args.keep:
+        os.remove(path)
+
+
+# Runs in a fresh interpreter: import the app, fork workers, and have each one
+# serve its first scored reading and report its memory
+STARTUP_SCRIPT = '''
+import json, os, sys, time
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import app
+imported = time.perf_counter()
+
+def memory():
+    """RSS, PSS and unique (private) memory of this process in MB"""
+    fields = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    except OSError:
+        import resource
+        return {'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    return {'rss': fields.get('Rss'), 'pss': fields.get('Pss'),
+            'uss': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)}
+
+def serve():
+    client = app.app.test_client()
+    begin = time.perf_counter()
+    client.get('/api/data')
+    data = time.perf_counter()
+    response = client.post('/api/add_reading', json={'heart_rate': 80, 'patient_id': 1})
+    assert response.status_code == 200, response.data
+    scored = time.perf_counter()
+    client.post('/api/add_reading', json={'heart_rate': 81, 'patient_id': 1})
+    warm = time.perf_counter()
+    return {'first_data_ms': (data - begin) * 1000, 'first_score_ms': (scored - data) * 1000,
+            'warm_score_ms': (warm - scored) * 1000, 'since_start_ms': (scored - start) * 1000}
+
+children = []
+for _ in range(int(sys.argv[2])):
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        result = serve()
+        result.update(memory())
+        os.write(write, json.dumps(result).encode())
+        os._exit(0)
+    os.close(write)
+    children.append((pid, read))
+
+workers = []
+for pid, read in children:
+    with os.fdopen(read) as f:
+        workers.append(json.loads(f.read()))
+    os.waitpid(pid, 0)
+print(json.dumps({'import_ms': (imported - start) * 1000, 'parent': memory(), 'workers': workers}))
+'''
+
+
+def app_workdir(repo):
+    """Scratch directory with a migrated database and patient 1 for running the app in"""
+    workdir = tempfile.mkdtemp()
+    # The app opens model/ and heart_monitor.db relative to the working directory
+    os.symlink(os.path.join(repo, 'model'), os.path.join(workdir, 'model'))
+    conn = sqlite3.connect(os.path.join(workdir, 'heart_monitor.db'))
+    migrate(conn)
+    conn.execute("INSERT INTO patients (id, name, age, gender, created_at) VALUES (1, 'Bench', 50, 'F', '2024-01-01 00:00:00')")
+    conn.commit()
+    conn.close()
+    return workdir
+
+
+def bench_startup(args):
+    """Import-to-first-response time and per-worker memory, with lazy vs preloaded models"""
+    repo = os.path.dirname(os.path.abspath(__file__))
+    workdir = app_workdir(repo)
+
+    for label, preload in (('lazy models', '0'), ('preloaded models', '1')):
+        env = dict(os.environ, MODEL_PRELOAD=preload, MODEL_POLL_SECONDS='0', PYTHONWARNINGS='ignore')
+        runs = []
+        for _ in range(args.repeat):
+            output = subprocess.run(
+                [sys.executable, '-c', STARTUP_SCRIPT, repo, str(args.workers)],
+                cwd=workdir, env=env, capture_output=True, text=True, check=True
+            ).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+
+        workers = [worker for run in runs for worker in run['workers']]
+        print(f"{label} ({args.workers} forked workers, {args.repeat} runs):")
+        print(f"  import app                  {statistics.median(run['import_ms'] for run in runs):9.1f} ms")
+        print(f"  first /api/data             {statistics.median(w['first_data_ms'] for w in workers):9.1f} ms")
+        print(f"  first scored reading        {statistics.median(w['first_score_ms'] for w in workers):9.1f} ms")
+        print(f"  warm scored reading         {statistics.median(w['warm_score_ms'] for w in workers):9.1f} ms")
+        print(f"  import to first score       {statistics.median(w['since_start_ms'] for w in workers):9.1f} ms")
+        for key in ('rss', 'pss', 'uss'):
+            if workers[0].get(key) is not None:
+                print(f"  worker {key.upper():<20} {statistics.median(w[key] for w in workers):9.1f} MB")
+
+
+# Runs in a fresh interpreter per mode: argv = repo, mode, threads, requests per thread
+INGEST_SCRIPT = r'''
+import json, sys, threading, time
+sys.path.insert(0, sys.argv[1])
+import app
+
+if sys.argv[2] == 'direct':
+    # Every request thread writes and commits its own reading, as before the queue
+    app.ingest_readings = app.store_readings
+threads, per_thread = int(sys.argv[3]), int(sys.argv[4])
+client = app.app.test_client()
+client.post('/api/add_reading', json={'heart_rate': 80, 'patient_id': 1})
+
+latencies = []
+statuses = {}
+lock = threading.Lock()
+barrier = threading.Barrier(threads)
+
+def run(seed):
+    barrier.wait()
+    for i in range(per_thread):
+        start = time.perf_counter()
+        response = client.post('/api/add_reading', json={'heart_rate': 50 + (seed + i) % 120, 'patient_id': 1})
+        elapsed = (time.perf_counter() - start) * 1000
+        with lock:
+            latencies.append(elapsed)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+workers = [threading.Thread(target=run, args=(n,)) for n in range(threads)]
+begin = time.perf_counter()
+for worker in workers:
+    worker.start()
+for worker in workers:
+    worker.join()
+print(json.dumps({'elapsed': time.perf_counter() - begin, 'latencies': latencies, 'statuses': statuses}))
+'''
+
+
+def bench_ingest(args):
+    """Concurrent /api/add_reading latency, with per-request commits vs the batching ingest queue"""
+    repo = os.path.dirname(os.path.abspath(__file__))
+    for label, mode in (('per-request commits', 'direct'), ('ingest queue', 'queued')):
+        env = dict(os.environ, MODEL_PRELOAD='1', MODEL_POLL_SECONDS='0', PYTHONWARNINGS='ignore')
+        output = subprocess.run(
+            [sys.executable, '-c', INGEST_SCRIPT, repo, mode, str(args.threads), str(args.requests)],
+            cwd=app_workdir(repo), env=env, capture_output=True, text=True, check=True
+        ).stdout
+        run = json.loads(output.strip().splitlines()[-1])
+        latencies = sorted(run['latencies'])
+        total = len(latencies)
+        ok = run['statuses'].get('200', 0)
+        print(f"{label} ({args.threads} threads x {args.requests} requests):")
+        print(f"  throughput {total / run['elapsed']:9.0f} req/s   errors {total - ok} "
+              f"({(total - ok) / total:.1%}, by status {run['statuses']})")
+        print(f"  p50 {latencies[total // 2]:9.2f} ms   p99 {latencies[int(total * 0.99) - 1]:9.2f} ms   "
+              f"max {latencies[-1]:9.2f} ms")
+
+
+def bench_geoip(args):
+    """Lookups per second from a local IP-range database, raw and behind the LRU cache"""
+    from geoip import CachedResolver, IPRangeDatabase, LocalResolver
+
+    rng = random.Random(0)
+    # Contiguous IPv4 ranges of random size covering most of the address space
+    bounds = sorted(rng.sample(range(1, 2 ** 32 - 1), args.ranges - 1))
+    starts = [0] + bounds
+    ends = [bound - 1 for bound in bounds] + [2 ** 32 - 1]
+    locations = [
+        {'latitude': rng.uniform(-90, 90), 'longitude': rng.uniform(-180, 180),
+         'city': f"City {i}", 'region': f"Region {i % 100}", 'country': f"Country {i % 50}"}
+        for i in range(args.locations)
+    ]
+
+    start = time.perf_counter()
+    database = IPRangeDatabase(
+        (first, last, locations[rng.randrange(args.locations)]) for first, last in zip(starts, ends)
+    )
+    print(f"Loaded {len(database):,} ranges ({len(database.locations):,} locations) "
+          f"in {time.perf_counter() - start:.1f}s")
+
+    addresses = [str(ipaddress.IPv4Address(rng.getrandbits(32))) for _ in range(args.lookups)]
+    # Devices report from a limited set of addresses, so most lookups repeat
+    devices = [str(ipaddress.IPv4Address(rng.getrandbits(32))) for _ in range(args.devices)]
+    repeated = [rng.choice(devices) for _ in range(args.lookups)]
+
+    resolver = LocalResolver(database)
+    cached = CachedResolver(resolver, maxsize=args.devices * 2)
+    for label, lookup, sample in (
+        ('binary search, random addresses', database.lookup, addresses),
+        ('local resolver, random addresses', resolver.resolve, addresses),
+        (f'cached resolver, {args.devices:,} device addresses', cached.resolve, repeated),
+    ):
+        start = time.perf_counter()
+        for address in sample:
+            lookup(address)
+        elapsed = time.perf_counter() - start
+        print(f"  {label:<45} {len(sample) / elapsed:12,.0f} lookups/s   "
+              f"{elapsed / len(sample) * 1e6:7.2f} us each")
+    print(f"  cache hit rate {cached.hits / (cached.hits + cached.misses):.1%}")
+
+
+def bench_locations(args):
+    """Near/bounding-box queries over device locations: full scan vs the spatial index"""
+    workdir = tempfile.mkdtemp()
+    os.environ.setdefault('GEOIP_HTTP_FALLBACK', '0')
+    # geo.py opens iot_geolocation.db in the working directory when imported
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import geo
+
+    rng = random.Random(0)
+    # Devices cluster around a few cities, the rest are spread out
+    cities = [(rng.uniform(-50, 60), rng.uniform(-180, 180)) for _ in range(50)]
+
+    def position():
+        if rng.random() < 0.8:
+            lat, lon = rng.choice(cities)
+            return max(-90, min(90, rng.gauss(lat, 0.5))), (rng.gauss(lon, 0.5) + 180) % 360 - 180
+        return rng.uniform(-60, 70), rng.uniform(-180, 180)
+
+    conn = geo.get_db_connection()
+    start = datetime.now() - timedelta(seconds=args.rows)
+    for offset in range(0, args.rows, 100_000):
+        batch = []
+        for i in range(offset, min(args.rows, offset + 100_000)):
+            lat, lon = position()
+            batch.append((f"DEV-{rng.randrange(args.devices):06d}", lat, lon, 'City', 'Region', 'Country', '10.0.0.1',
+                          (start + timedelta(seconds=i)).isoformat()))
+        conn.executemany('''
+        INSERT INTO device_locations
+        (device_serial, latitude, longitude, city, region, country, ip_address, timestamp)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', batch)
+    conn.commit()
+    print(f"Generated {args.rows:,} locations for {args.devices:,} devices")
+
+    begin = time.perf_counter()
+    conn.execute('DELETE FROM device_latest_location')
+    conn.commit()
+    geo.init_db()
+    print(f"Built latest-location table and spatial index in {time.perf_counter() - begin:.1f}s "
+          f"(R*Tree: {geo.rtree_enabled})")
+
+    def scan_near(lat, lon, radius_km):
+        # What finding nearby devices took before: latest per device from the
+        # whole history, then a distance check on each
+        latest = {}
+        for row in conn.execute('SELECT device_serial, latitude, longitude FROM device_locations ORDER BY timestamp DESC'):
+            if row['device_serial'] not in latest:
+                latest[row['device_serial']] = row
+        return [row for row in latest.values()
+                if geo.haversine_km(lat, lon, row['latitude'], row['longitude']) <= radius_km]
+
+    cursor = conn.cursor()
+    points = [rng.choice(cities) for _ in range(args.repeat)]
+    for radius_km in (5, 50):
+        scanned = index_results = 0
+        scan_latencies = []
+        for lat, lon in points[:3]:
+            begin = time.perf_counter()
+            scanned = len(scan_near(lat, lon, radius_km))
+            scan_latencies.append((time.perf_counter() - begin) * 1000)
+            index_results = len(geo.query_near(cursor, lat, lon, radius_km))
+            assert scanned == index_results, (scanned, index_results)
+        report(f"near {radius_km} km, full scan ({scanned} devices)", scan_latencies)
+
+        latencies = []
+        for lat, lon in points:
+            begin = time.perf_counter()
+            geo.query_near(cursor, lat, lon, radius_km)
+            latencies.append((time.perf_counter() - begin) * 1000)
+        report(f"near {radius_km} km, spatial index", latencies)
+
+    latencies = []
+    for lat, lon in points:
+        begin = time.perf_counter()
+        geo.query_bbox(cursor, lat - 0.5, lat + 0.5, lon - 0.5, lon + 0.5, geo.MAX_SPATIAL_RESULTS)
+        latencies.append((time.perf_counter() - begin) * 1000)
+    report("1 x 1 degree bounding box, spatial index", latencies)
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Heart Monitor benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    readings = subparsers.add_parser('readings', help=bench_readings.__doc__)
+    readings.add_argument('--rows', type=int, default=10_000_000, help='Number of readings to generate')
+    readings.add_argument('--patients', type=int, default=1000, help='Number of patients')
+    readings.add_argument('--devices', type=int, default=2000, help='Number of devices')
+    readings.add_argument('--repeat', type=int, default=200, help='Queries per measurement')
+    readings.add_argument('--keep', action='store_true', help='Keep the generated database')
+    readings.set_defaults(func=bench_readings)
+
+    startup = subparsers.add_parser('startup', help=bench_startup.__doc__)
+    startup.add_argument('--workers', type=int, default=4, help='Workers forked after importing the app')
+    startup.add_argument('--repeat', type=int, default=3, help='Fresh interpreters per mode')
+    startup.set_defaults(func=bench_startup)
+
+    ingest = subparsers.add_parser('ingest', help=bench_ingest.__doc__)
+    ingest.add_argument('--threads', type=int, default=64, help='Concurrent request threads')
+    ingest.add_argument('--requests', type=int, default=50, help='Readings posted per thread')
+    ingest.set_defaults(func=bench_ingest)
+
+    geoip = subparsers.add_parser('geoip', help=bench_geoip.__doc__)
+    geoip.add_argument('--ranges', type=int, default=1_000_000, help='IPv4 ranges in the database')
+    geoip.add_argument('--locations', type=int, default=50_000, help='Distinct locations')
+    geoip.add_argument('--lookups', type=int, default=200_000, help='Lookups per measurement')
+    geoip.add_argument('--devices', type=int, default=5000, help='Distinct addresses in the cached run')
+    geoip.set_defaults(func=bench_geoip)
+
+    locations = subparsers.add_parser('locations', help=bench_locations.__doc__)
+    locations.add_argument('--rows', type=int, default=1_000_000, help='Stored locations')
+    locations.add_argument('--devices', type=int, default=100_000, help='Number of devices')
+    locations.add_argument('--repeat', type=int, default=200, help='Queries per measurement')
+    locations.set_defaults(func=bench_locations)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
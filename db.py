@@ -0,0 +1,131 @@
+"""
+SQLite connection pool for the heart monitor app.
+
+Connections are opened once, tuned with the pragmas below and then handed out
+to request threads and returned afterwards, so neither the threaded dev server
+nor a WSGI server pays the connect/pragma cost on every call. Each connection
+keeps its own prepared statement cache (sqlite3 `cached_statements`), which is
+only useful because the connections live for the lifetime of the process.
+
+SQLite connections must not be used across fork(), and a fork taken while
+another thread is inside SQLite can leave the child stuck on SQLite's internal
+locks. So before a fork the pool stops handing out connections and waits (up
+to FORK_WAIT seconds) for the ones in use to come back, and the child (e.g. a
+pre-forking WSGI worker) starts with an empty pool of its own.
+"""
+
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Applied to every new connection. journal_mode is persistent in the database
+# file, the others are per connection.
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',  # Safe with WAL, avoids an fsync per commit
+    'PRAGMA cache_size = -16000',  # ~16 MB page cache
+    'PRAGMA temp_store = MEMORY',
+)
+
+# Number of prepared statements kept per connection
+STATEMENT_CACHE_SIZE = 256
+
+# Longest a fork waits for connections in use by other threads
+FORK_WAIT = 5.0
+
+
+class ConnectionPool:
+    """A small pool of long-lived SQLite connections to one database file"""
+
+    def __init__(self, path, max_idle=16, timeout=30.0):
+        self.path = path
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._idle = []
+        self._in_use = 0
+        self._forking = False
+        self._lock = threading.Lock()
+        self._returned = threading.Condition(self._lock)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(
+                before=self._before_fork,
+                after_in_parent=self._after_fork_in_parent,
+                after_in_child=self._after_fork_in_child
+            )
+
+    def _before_fork(self):
+        # Held until the fork is done, so nobody starts using SQLite meanwhile
+        self._lock.acquire()
+        self._forking = True
+        self._returned.wait_for(lambda: self._in_use == 0, timeout=FORK_WAIT)
+
+    def _after_fork_in_parent(self):
+        self._forking = False
+        self._returned.notify_all()
+        self._lock.release()
+
+    def _after_fork_in_child(self):
+        # The parent's connections are left open rather than closed: closing
+        # them here could interfere with the parent's use of the same file
+        self._idle = []
+        self._in_use = 0
+        self._forking = False
+        self._lock = threading.Lock()
+        self._returned = threading.Condition(self._lock)
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.timeout,
+            check_same_thread=False,  # Connections move between threads via the pool
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        """Take a connection from the pool, opening a new one if none are idle"""
+        with self._lock:
+            self._returned.wait_for(lambda: not self._forking)
+            self._in_use += 1
+            if self._idle:
+                return self._idle.pop()
+        try:
+            return self._connect()
+        except Exception:
+            with self._lock:
+                self._in_use -= 1
+                self._returned.notify_all()
+            raise
+
+    def release(self, conn):
+        """Return a connection to the pool"""
+        # Never hand a half-finished transaction to the next caller
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+            else:
+                conn.close()
+            self._in_use -= 1
+            self._returned.notify_all()
+
+    @contextmanager
+    def connection(self):
+        """Context manager wrapping acquire()/release()"""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self):
+        """Close all idle connections, e.g. before forking or in tests"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
@@ -0,0 +1,136 @@
+"""
+In-memory registry of IoT device credentials and status.
+
+Authenticating a reading used to cost two SELECTs and an UPDATE with a commit.
+DeviceRegistry caches each device's api_key hash, patient_id and status after
+the first lookup, and only records `last_seen` in memory. Pending `last_seen`
+values are written in one batched UPDATE every `flush_interval` seconds, or
+whenever flush() is called.
+
+Call invalidate() after any change to a device row (add, edit, key rotation).
+That only reaches this process, so entries are also reloaded `cache_ttl`
+seconds after they were cached; changes made by another worker take effect
+within that time.
+"""
+
+import atexit
+import hashlib
+import hmac
+import os
+import threading
+import time
+from datetime import datetime
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def hash_api_key(api_key):
+    return hashlib.sha256(str(api_key).encode('utf-8')).hexdigest()
+
+
+class DeviceRegistry:
+    """Cache of device credentials with coalesced last_seen updates"""
+
+    def __init__(self, pool, flush_interval=30.0, cache_ttl=30.0):
+        self.pool = pool
+        self.flush_interval = flush_interval
+        self.cache_ttl = cache_ttl
+        self._devices = {}  # device_id -> (expires_at, {api_key_hash, patient_id, status})
+        self._last_seen = {}  # device_id -> timestamp not yet written to disk
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        atexit.register(self.flush)
+
+    def get(self, device_id):
+        """Return the cached entry for a device, loading it on a miss"""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._devices.get(device_id)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                'SELECT api_key, patient_id, status FROM devices WHERE device_id = ?',
+                (device_id,)
+            ).fetchone()
+        if row is None:
+            with self._lock:
+                self._devices.pop(device_id, None)
+            return None
+
+        entry = {
+            'api_key_hash': hash_api_key(row['api_key']),
+            'patient_id': row['patient_id'],
+            'status': row['status'],
+        }
+        with self._lock:
+            self._devices[device_id] = (now + self.cache_ttl, entry)
+        return entry
+
+    def authenticate(self, device_id, api_key):
+        """Check a device's API key; returns its cached entry or None.
+
+        On success the device's last_seen is updated in memory only.
+        """
+        entry = self.get(device_id)
+        if entry is None or not hmac.compare_digest(entry['api_key_hash'], hash_api_key(api_key)):
+            return None
+
+        with self._lock:
+            self._last_seen[device_id] = datetime.now().strftime(TIME_FORMAT)
+        self._ensure_flusher()
+        return entry
+
+    def invalidate(self, device_id=None):
+        """Drop one device (or all of them) from the cache"""
+        with self._lock:
+            if device_id is None:
+                self._devices.clear()
+            else:
+                self._devices.pop(device_id, None)
+
+    def flush(self):
+        """Write all pending last_seen timestamps in one batched UPDATE"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._last_seen = self._last_seen, {}
+            if not pending:
+                return 0
+            try:
+                with self.pool.connection() as conn:
+                    conn.executemany(
+                        'UPDATE devices SET last_seen = ? WHERE device_id = ?',
+                        [(last_seen, device_id) for device_id, last_seen in pending.items()]
+                    )
+                    conn.commit()
+            except Exception as e:
+                # Put them back, unless the device has been seen again since
+                with self._lock:
+                    for device_id, last_seen in pending.items():
+                        self._last_seen.setdefault(device_id, last_seen)
+                print(f"Failed to flush device last_seen: {str(e)}")
+                return 0
+            return len(pending)
+
+    def _ensure_flusher(self):
+        # Restart the thread in forked worker processes
+        if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="device-last-seen", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
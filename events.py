@@ -0,0 +1,72 @@
+"""
+In-process publish/subscribe for new readings.
+
+store_readings publishes every committed reading to a ReadingBroker, and each
+open /api/stream connection holds a Subscription, optionally filtered to one
+patient. Subscriptions have a bounded queue: a client that stops reading loses
+its oldest undelivered events instead of growing memory without limit.
+
+This only fans out within one process. With several worker processes each one
+streams the readings it ingested itself.
+"""
+
+import queue
+import threading
+
+
+class Subscription:
+    """Queue of readings for one stream client"""
+
+    def __init__(self, patient_id=None, max_queue=100):
+        self.patient_id = patient_id
+        self._queue = queue.Queue(maxsize=max_queue)
+
+    def put(self, reading):
+        while True:
+            try:
+                self._queue.put_nowait(reading)
+                return
+            except queue.Full:
+                # Slow client: drop the oldest event to make room
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        """Next reading, or None if nothing arrived within `timeout` seconds"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class ReadingBroker:
+    """Fans published readings out to matching subscriptions"""
+
+    def __init__(self, max_queue=100):
+        self.max_queue = max_queue
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, patient_id=None):
+        subscription = Subscription(patient_id, self.max_queue)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def has_subscribers(self):
+        return bool(self._subscriptions)
+
+    def publish(self, readings):
+        """Deliver readings (dicts with a patient_id key) to every matching subscriber"""
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            for reading in readings:
+                if subscription.patient_id is None or subscription.patient_id == reading['patient_id']:
+                    subscription.put(reading)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Columnar bulk export of heart_readings.
+
+Readings for a patient, a device and/or a time range are read straight from
+the SQLite file (read-only, so the live app is never blocked) in large
+fetchmany() chunks. Each chunk is transposed into one typed NumPy array per
+column without building a dict per row.
+
+Output formats:
+  .npz      compressed NumPy archive, one array per column (always available)
+  .parquet  one row group per chunk, streamed to disk (needs pyarrow)
+
+With --archives, the monthly archives written by retention.py are read too,
+so history that has left the main database is included.
+
+Usage:
+  python export.py readings.npz --patient 3 --from 2024-01-01 --to 2024-02-01
+  python export.py device.parquet --device DEV-1A2B3C4D --archives
+"""
+
+import argparse
+import glob
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Exported columns and their array types, in output order
+COLUMNS = (
+    ('id', np.int64),
+    ('timestamp', 'datetime64[s]'),
+    ('patient_id', np.int64),
+    ('device_id', str),
+    ('heart_rate', np.int64),
+    ('hrv', np.float64),
+    ('spo2', np.float64),
+    ('systolic', np.int64),
+    ('diastolic', np.int64),
+    ('body_temp', np.float64),
+    ('tachycardia_pred', np.int8),
+    ('hypertrophy_pred', np.int8),
+    ('cholesterol_pred', np.int8),
+    ('tachycardia_prob', np.float64),  # NaN where the model gave no probability
+    ('hypertrophy_prob', np.float64),
+    ('cholesterol_prob', np.float64),
+    ('notification_sent', np.int8),
+)
+
+
+def to_arrays(rows):
+    """Transpose a chunk of row tuples into one typed array per column"""
+    arrays = {}
+    for (name, dtype), values in zip(COLUMNS, zip(*rows)):
+        if dtype is str:
+            # Readings submitted without a device have no device_id
+            values = ['' if value is None else value for value in values]
+        arrays[name] = np.array(values, dtype=dtype)
+    return arrays
+
+
+def iter_chunks(path, patient_id=None, device_id=None, start=None, end=None, chunk_size=50_000):
+    """Yield dicts of column arrays for the matching readings in one database file"""
+    conditions = []
+    params = []
+    if patient_id is not None:
+        conditions.append('patient_id = ?')
+        params.append(patient_id)
+    if device_id is not None:
+        conditions.append('device_id = ?')
+        params.append(device_id)
+    if start is not None:
+        conditions.append('timestamp >= ?')
+        params.append(start)
+    if end is not None:
+        conditions.append('timestamp < ?')
+        params.append(end)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        cursor = conn.execute(
+            f'SELECT {", ".join(name for name, _ in COLUMNS)} FROM heart_readings {where} ORDER BY id',
+            params
+        )
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield to_arrays(rows)
+    finally:
+        conn.close()
+
+
+def archive_paths(archive_dir, start=None, end=None):
+    """Monthly archive files that can hold readings in start..end"""
+    paths = []
+    for path in sorted(glob.glob(os.path.join(archive_dir, 'heart_readings_*.db'))):
+        month = os.path.basename(path)[len('heart_readings_'):-len('.db')]
+        if start is not None and month < start[:7]:
+            continue
+        if end is not None and month > end[:7]:
+            continue
+        paths.append(path)
+    return paths
+
+
+class NpzWriter:
+    """Collects typed chunks and writes them as one compressed .npz"""
+
+    def __init__(self, path):
+        self.path = path
+        self.chunks = {name: [] for name, _ in COLUMNS}
+
+    def write(self, arrays):
+        for name, array in arrays.items():
+            self.chunks[name].append(array)
+
+    def close(self):
+        arrays = {}
+        for name, dtype in COLUMNS:
+            chunks = self.chunks[name]
+            arrays[name] = np.concatenate(chunks) if chunks else np.array([], dtype=dtype)
+        np.savez_compressed(self.path, **arrays)
+
+
+class ParquetWriter:
+    """Streams each chunk to a Parquet file as its own row group"""
+
+    def __init__(self, path):
+        if pq is None:
+            raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+        self.path = path
+        self.writer = None
+
+    def write(self, arrays):
+        table = pa.table({name: pa.array(array) for name, array in arrays.items()})
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema, compression='zstd')
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+WRITERS = {'.npz': NpzWriter, '.parquet': ParquetWriter}
+
+
+def export(output, db_path='heart_monitor.db', archive_dir=None, patient_id=None, device_id=None,
+           start=None, end=None, chunk_size=50_000):
+    """Export matching readings to `output`; the format follows its extension. Returns the row count."""
+    extension = os.path.splitext(output)[1].lower()
+    if extension not in WRITERS:
+        raise ValueError(f"Unsupported export format {extension!r}; use {' or '.join(WRITERS)}")
+
+    paths = archive_paths(archive_dir, start, end) if archive_dir else []
+    paths.append(db_path)
+
+    writer = WRITERS[extension](output)
+    count = 0
+    try:
+        for path in paths:
+            for arrays in iter_chunks(path, patient_id, device_id, start, end, chunk_size):
+                writer.write(arrays)
+                count += len(arrays['id'])
+    finally:
+        writer.close()
+    return count
+
+
+def parse_timestamp(value):
+    return datetime.fromisoformat(value).strftime(TIME_FORMAT)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export heart readings to a columnar file')
+    parser.add_argument('output', help='Output file (.npz or .parquet)')
+    parser.add_argument('--db', default='heart_monitor.db', help='Database to read')
+    parser.add_argument('--patient', type=int, help='Only this patient')
+    parser.add_argument('--device', help='Only this device')
+    parser.add_argument('--from', dest='start', type=parse_timestamp, help='Start timestamp (inclusive)')
+    parser.add_argument('--to', dest='end', type=parse_timestamp, help='End timestamp (exclusive)')
+    parser.add_argument('--archives', nargs='?', const='archive', metavar='DIR',
+                        help='Also read the monthly archives in DIR (default: archive)')
+    parser.add_argument('--chunk-size', type=int, default=50_000, help='Rows fetched per chunk')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        count = export(args.output, args.db, args.archives, args.patient, args.device,
+                       args.start, args.end, args.chunk_size)
+    except (ValueError, RuntimeError) as e:
+        parser.error(str(e))
+    elapsed = time.perf_counter() - start
+    print(f"Exported {count:,} readings to {args.output} in {elapsed:.1f}s "
+          f"({count / elapsed if elapsed else 0:,.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    main()
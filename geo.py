@@ -1,12 +1,23 @@
 from flask import Flask, request, jsonify, render_template, redirect, url_for, flash
 import sqlite3
-import requests
 import os
+import math
 from datetime import datetime
 
+from geoip import build_resolver
+
 app = Flask(__name__)
 app.secret_key = os.urandom(24)  # For flash messages
 
+# Addresses are looked up in a local IP-range file (GEOIP_DATABASE) first; the
+# online lookup is only a fallback and can be switched off. Answers are cached.
+geo_resolver = build_resolver(
+    database_path=os.environ.get('GEOIP_DATABASE') or None,
+    http_fallback=os.environ.get('GEOIP_HTTP_FALLBACK', '1') == '1',
+    cache_size=int(os.environ.get('GEOIP_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('GEOIP_CACHE_TTL', 3600))
+)
+
 # Database setup
 def init_db():
     conn = sqlite3.connect('iot_geolocation.db')
@@ -21,11 +32,109 @@ def init_db():
         region TEXT,
         country TEXT,
         ip_address TEXT,
-        timestamp TEXT NOT NULL
+        timestamp TEXT NOT NULL,
+        last_confirmed TEXT
+    )
+    ''')
+    
+    # last_confirmed came with location dedup; add it to older databases
+    # (to both tables, so their columns stay in the same order)
+    for table in ('device_locations', 'device_latest_location'):
+        cursor.execute(f'PRAGMA table_info({table})')
+        columns = [row[1] for row in cursor.fetchall()]
+        if columns and 'last_confirmed' not in columns:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN last_confirmed TEXT')
+    
+    # History queries are per device, newest first
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_device_locations_serial_timestamp
+    ON device_locations (device_serial, timestamp)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_device_locations_timestamp
+    ON device_locations (timestamp)
+    ''')
+    
+    # Newest location of every device, kept up to date by insert_location so
+    # the map and /latest read one row per device instead of the history
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS device_latest_location (
+        id INTEGER NOT NULL,
+        device_serial TEXT PRIMARY KEY,
+        latitude REAL NOT NULL,
+        longitude REAL NOT NULL,
+        city TEXT,
+        region TEXT,
+        country TEXT,
+        ip_address TEXT,
+        timestamp TEXT NOT NULL,
+        last_confirmed TEXT
+    )
+    ''')
+    cursor.execute('''
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_device_latest_location_id
+    ON device_latest_location (id)
+    ''')
+    
+    # Spatial index over the latest fixes for the near/bbox queries: an R*Tree
+    # keyed by location id, kept in step with device_latest_location by
+    # triggers. Without the rtree module, fall back to a plain lat/lon index.
+    try:
+        cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS device_latest_location_rtree
+        USING rtree(id, min_lat, max_lat, min_lon, max_lon)
+        ''')
+        rtree = True
+    except sqlite3.OperationalError as e:
+        print(f"R*Tree not available, using a B-tree index for spatial queries: {e}")
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_device_latest_location_lat_lon
+        ON device_latest_location (latitude, longitude)
+        ''')
+        rtree = False
+    
+    if rtree:
+        cursor.executescript('''
+        CREATE TRIGGER IF NOT EXISTS device_latest_location_rtree_insert
+        AFTER INSERT ON device_latest_location BEGIN
+            INSERT INTO device_latest_location_rtree
+            VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+        END;
+        CREATE TRIGGER IF NOT EXISTS device_latest_location_rtree_update
+        AFTER UPDATE OF id, latitude, longitude ON device_latest_location BEGIN
+            DELETE FROM device_latest_location_rtree WHERE id = old.id;
+            INSERT INTO device_latest_location_rtree
+            VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+        END;
+        CREATE TRIGGER IF NOT EXISTS device_latest_location_rtree_delete
+        AFTER DELETE ON device_latest_location BEGIN
+            DELETE FROM device_latest_location_rtree WHERE id = old.id;
+        END;
+        ''')
+    
+    # Fill it from the history for devices it doesn't have yet, e.g. on the
+    # first start after upgrading
+    cursor.execute('''
+    INSERT OR IGNORE INTO device_latest_location
+    SELECT * FROM device_locations d
+    WHERE d.device_serial NOT IN (SELECT device_serial FROM device_latest_location)
+    AND d.id = (
+        SELECT id FROM device_locations
+        WHERE device_serial = d.device_serial
+        ORDER BY timestamp DESC, id DESC
+        LIMIT 1
     )
     ''')
+    if rtree:
+        # Latest fixes stored before the R*Tree existed
+        cursor.execute('''
+        INSERT INTO device_latest_location_rtree
+        SELECT id, latitude, latitude, longitude, longitude FROM device_latest_location
+        WHERE id NOT IN (SELECT id FROM device_latest_location_rtree)
+        ''')
     conn.commit()
     conn.close()
+    return rtree
 
 # Helper function to get database connection
 def get_db_connection():
@@ -33,39 +142,164 @@ def get_db_connection():
     conn.row_factory = sqlite3.Row
     return conn
 
+# Helper function to store a location and keep the device's latest location current
+def insert_location(cursor, device_serial, geo_data, timestamp=None):
+    """Add a location to the history and, if it is the newest, device_latest_location. Returns its id."""
+    timestamp = timestamp or datetime.now().isoformat()
+    row = (
+        device_serial,
+        geo_data['latitude'],
+        geo_data['longitude'],
+        geo_data['city'],
+        geo_data['region'],
+        geo_data['country'],
+        geo_data['ip'],
+        timestamp,
+        timestamp
+    )
+    cursor.execute('''
+    INSERT INTO device_locations
+    (device_serial, latitude, longitude, city, region, country, ip_address, timestamp, last_confirmed)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', row)
+    location_id = cursor.lastrowid
+    
+    cursor.execute('''
+    INSERT INTO device_latest_location
+    (id, device_serial, latitude, longitude, city, region, country, ip_address, timestamp, last_confirmed)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (device_serial) DO UPDATE SET
+        id = excluded.id,
+        latitude = excluded.latitude,
+        longitude = excluded.longitude,
+        city = excluded.city,
+        region = excluded.region,
+        country = excluded.country,
+        ip_address = excluded.ip_address,
+        timestamp = excluded.timestamp,
+        last_confirmed = excluded.last_confirmed
+    WHERE excluded.timestamp >= device_latest_location.timestamp
+    ''', (location_id, *row))
+    return location_id
+
+# A report with the same IP and coordinates as the device's latest location,
+# at most this many seconds after that location was last confirmed, only
+# extends its last_confirmed instead of adding a row (0 turns dedup off)
+LOCATION_DEDUP_SECONDS = float(os.environ.get('LOCATION_DEDUP_SECONDS', 3600))
+
+# Helper function to store a location unless it repeats the device's latest one
+def record_location(cursor, device_serial, geo_data, timestamp=None):
+    """Store a location, or merge it into an unchanged latest location. Returns (location_id, merged)."""
+    timestamp = timestamp or datetime.now().isoformat()
+    if LOCATION_DEDUP_SECONDS > 0:
+        cursor.execute('''
+        SELECT id, latitude, longitude, ip_address, timestamp, last_confirmed
+        FROM device_latest_location
+        WHERE device_serial = ?
+        ''', (device_serial,))
+        latest = cursor.fetchone()
+    
+        # Reports older than the latest location go into the history as they are
+        if (latest and timestamp >= latest[4] and latest[3] == geo_data['ip'] and
+                (latest[1], latest[2]) == (geo_data['latitude'], geo_data['longitude'])):
+            confirmed = latest[5] or latest[4]
+            gap = (datetime.fromisoformat(timestamp) - datetime.fromisoformat(confirmed)).total_seconds()
+            if gap <= LOCATION_DEDUP_SECONDS:
+                confirmed = max(confirmed, timestamp)
+                cursor.execute('UPDATE device_locations SET last_confirmed = ? WHERE id = ?',
+                               (confirmed, latest[0]))
+                cursor.execute('UPDATE device_latest_location SET last_confirmed = ? WHERE device_serial = ?',
+                               (confirmed, device_serial))
+                return latest[0], True
+    
+    return insert_location(cursor, device_serial, geo_data, timestamp), False
+
 # Helper function to get geolocation data
 def get_geolocation(ip_address=None):
-    try:
-        if not ip_address:
-            # Get the public IP address
-            ip_response = requests.get('https://api.ipify.org?format=json')
-            ip_data = ip_response.json()
-            ip_address = ip_data['ip']
-        
-        # Use the IP address to get geolocation data
-        geo_response = requests.get(f'https://ipapi.co/{ip_address}/json/')
-        geo_data = geo_response.json()
-        
-        # Format latitude and longitude to 6 decimal places
-        latitude = float(f"{geo_data.get('latitude', 0):.6f}")
-        longitude = float(f"{geo_data.get('longitude', 0):.6f}")
-        
-        return {
-            'ip': geo_data.get('ip', 'N/A'),
-            'latitude': latitude,
-            'longitude': longitude,
-            'city': geo_data.get('city', 'N/A'),
-            'region': geo_data.get('region', 'N/A'),
-            'country': geo_data.get('country_name', 'N/A')
-        }
-    except Exception as e:
-        print(f"Error getting geolocation data: {e}")
-        return None
+    """Location of an IP address (our own public address if None), or None"""
+    return geo_resolver.resolve(ip_address)
 
-# Initialize database before first request
-@app.before_first_request
-def before_first_request():
-    init_db()
+# Most reports accepted by one /api/location/batch request
+MAX_BATCH_LOCATIONS = int(os.environ.get('MAX_BATCH_LOCATIONS', 5000))
+
+def parse_timestamp(value):
+    """Naive local ISO timestamp for a reported one; raises TypeError or ValueError"""
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is not None:
+        # Stored timestamps are server local time
+        timestamp = timestamp.astimezone().replace(tzinfo=None)
+    return timestamp.isoformat()
+
+# Spatial queries over the latest location of every device
+EARTH_RADIUS_KM = 6371.0088
+MAX_SPATIAL_RESULTS = 5000
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points in km"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def longitude_ranges(min_lon, max_lon):
+    """Split a longitude span that crosses the antimeridian (min_lon > max_lon) in two"""
+    if min_lon <= max_lon:
+        return [(min_lon, max_lon)]
+    return [(min_lon, 180.0), (-180.0, max_lon)]
+
+def query_bbox(cursor, min_lat, max_lat, min_lon, max_lon, limit=None):
+    """Latest fixes of the devices inside a bounding box, at most `limit` of them"""
+    rows = []
+    for low, high in longitude_ranges(min_lon, max_lon):
+        # LIMIT -1 means no limit
+        remaining = -1 if limit is None else limit - len(rows)
+        if rtree_enabled:
+            # The R*Tree stores 32-bit floats, so recheck the exact coordinates
+            cursor.execute('''
+            SELECT l.* FROM device_latest_location_rtree r
+            JOIN device_latest_location l ON l.id = r.id
+            WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ?
+            AND l.latitude BETWEEN ? AND ? AND l.longitude BETWEEN ? AND ?
+            LIMIT ?
+            ''', (min_lat, max_lat, low, high, min_lat, max_lat, low, high, remaining))
+        else:
+            cursor.execute('''
+            SELECT * FROM device_latest_location
+            WHERE latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?
+            LIMIT ?
+            ''', (min_lat, max_lat, low, high, remaining))
+        rows.extend(dict(row) for row in cursor.fetchall())
+        if limit is not None and len(rows) >= limit:
+            break
+    return rows
+
+def query_near(cursor, lat, lon, radius_km, limit=None):
+    """Latest fixes within radius_km of a point, nearest first, with distance_km"""
+    # Bounding box of the circle, then the exact distance check
+    lat_delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+    min_lat, max_lat = max(-90.0, lat - lat_delta), min(90.0, lat + lat_delta)
+    if min_lat == -90.0 or max_lat == 90.0 or radius_km >= math.pi * EARTH_RADIUS_KM / 2:
+        # The circle covers a pole: every longitude is in range
+        min_lon, max_lon = -180.0, 180.0
+    else:
+        lon_delta = math.degrees(math.asin(min(1.0, math.sin(radius_km / EARTH_RADIUS_KM) / math.cos(math.radians(lat)))))
+        min_lon, max_lon = lon - lon_delta, lon + lon_delta
+        if min_lon < -180.0:
+            min_lon += 360.0
+        if max_lon > 180.0:
+            max_lon -= 360.0
+    
+    matches = []
+    # The box holds more than the circle, so it can't be capped at `limit`
+    for row in query_bbox(cursor, min_lat, max_lat, min_lon, max_lon):
+        distance = haversine_km(lat, lon, row['latitude'], row['longitude'])
+        if distance <= radius_km:
+            row['distance_km'] = round(distance, 3)
+            matches.append(row)
+    matches.sort(key=lambda row: row['distance_km'])
+    return matches[:limit]
+
+# Initialize database at startup (before_first_request was removed in Flask 2.3)
+rtree_enabled = init_db()
 
 # Web Routes
 @app.route('/')
@@ -74,7 +308,7 @@ def index():
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('''
-    SELECT DISTINCT device_serial FROM device_locations
+    SELECT device_serial FROM device_latest_location
     ''')
     devices = [row['device_serial'] for row in cursor.fetchall()]
     
@@ -111,10 +345,8 @@ def device_detail(device_serial):
     
     # Get latest location for map
     cursor.execute('''
-    SELECT * FROM device_locations
+    SELECT * FROM device_latest_location
     WHERE device_serial = ?
-    ORDER BY timestamp DESC
-    LIMIT 1
     ''', (device_serial,))
     latest = cursor.fetchone()
     
@@ -130,29 +362,17 @@ def map_view():
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    # Get all device locations for the map
+    # Latest location of every device for the map
     cursor.execute('''
     SELECT device_serial, latitude, longitude, city, timestamp
-    FROM device_locations
+    FROM device_latest_location
     ORDER BY timestamp DESC
     ''')
-    all_locations = cursor.fetchall()
-    
-    # Group by device (get latest for each)
-    devices = {}
-    for loc in all_locations:
-        if loc['device_serial'] not in devices:
-            devices[loc['device_serial']] = {
-                'device_serial': loc['device_serial'],
-                'latitude': loc['latitude'],
-                'longitude': loc['longitude'],
-                'city': loc['city'],
-                'timestamp': loc['timestamp']
-            }
+    devices = [dict(row) for row in cursor.fetchall()]
     
     conn.close()
     
-    return render_template('map.html', devices=list(devices.values()))
+    return render_template('map.html', devices=devices)
 
 @app.route('/add-location', methods=['GET', 'POST'])
 def add_location():
@@ -173,20 +393,7 @@ def add_location():
         # Store in database
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute('''
-        INSERT INTO device_locations 
-        (device_serial, latitude, longitude, city, region, country, ip_address, timestamp)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            device_serial,
-            geo_data['latitude'],
-            geo_data['longitude'],
-            geo_data['city'],
-            geo_data['region'],
-            geo_data['country'],
-            geo_data['ip'],
-            datetime.now().isoformat()
-        ))
+        record_location(cursor, device_serial, geo_data)
         conn.commit()
         conn.close()
         
@@ -218,31 +425,132 @@ def store_location():
     # Store in database
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute('''
-    INSERT INTO device_locations 
-    (device_serial, latitude, longitude, city, region, country, ip_address, timestamp)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        device_serial,
-        geo_data['latitude'],
-        geo_data['longitude'],
-        geo_data['city'],
-        geo_data['region'],
-        geo_data['country'],
-        geo_data['ip'],
-        datetime.now().isoformat()
-    ))
+    location_id, merged = record_location(cursor, device_serial, geo_data)
     conn.commit()
-    location_id = cursor.lastrowid
     conn.close()
     
     return jsonify({
         'success': True,
         'location_id': location_id,
+        'merged': merged,
         'message': f'Location data for device {device_serial} stored successfully',
         'data': geo_data
     })
 
+@app.route('/api/location/batch', methods=['POST'])
+def store_locations_batch():
+    """Store many location reports in one transaction.
+    
+    Accepts {"locations": [{"device_serial", "ip_address"?, "timestamp"?}, ...]}
+    and returns one result per report, in input order. Reports are applied in
+    timestamp order, and unchanged ones are merged like single reports.
+    """
+    data = request.get_json(silent=True)
+    reports = data.get('locations') if isinstance(data, dict) else data
+    
+    if not isinstance(reports, list) or not reports:
+        return jsonify({'error': 'Expected a non-empty list of locations'}), 400
+    if len(reports) > MAX_BATCH_LOCATIONS:
+        return jsonify({'error': f'At most {MAX_BATCH_LOCATIONS} locations per batch'}), 400
+    
+    now = datetime.now().isoformat()
+    results = [None] * len(reports)
+    accepted = []  # (timestamp, index, device_serial, geo_data)
+    for index, report in enumerate(reports):
+        if not isinstance(report, dict) or not report.get('device_serial'):
+            results[index] = {'success': False, 'error': 'Device serial number is required'}
+            continue
+        
+        try:
+            timestamp = parse_timestamp(report['timestamp']) if report.get('timestamp') else now
+        except (TypeError, ValueError):
+            results[index] = {'success': False, 'error': 'Invalid timestamp'}
+            continue
+        
+        # Repeated addresses are answered by the resolver's cache
+        geo_data = get_geolocation(report.get('ip_address', request.remote_addr))
+        if not geo_data:
+            results[index] = {'success': False, 'error': 'Failed to get geolocation data'}
+            continue
+        accepted.append((timestamp, index, report['device_serial'], geo_data))
+    
+    accepted.sort(key=lambda item: item[:2])
+    merged_count = 0
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        for timestamp, index, device_serial, geo_data in accepted:
+            location_id, merged = record_location(cursor, device_serial, geo_data, timestamp)
+            merged_count += merged
+            results[index] = {'success': True, 'location_id': location_id, 'merged': merged}
+        conn.commit()
+    finally:
+        conn.close()
+    
+    return jsonify({
+        'success': True,
+        'stored': len(accepted) - merged_count,
+        'merged': merged_count,
+        'rejected': len(reports) - len(accepted),
+        'results': results
+    })
+
+def spatial_limit():
+    """`limit` query parameter for the spatial endpoints, or None if invalid"""
+    limit = request.args.get('limit', 500, type=int)
+    return limit if limit and 1 <= limit <= MAX_SPATIAL_RESULTS else None
+
+@app.route('/api/location/near', methods=['GET'])
+def get_locations_near():
+    """Devices whose latest location is within radius_km of lat/lon, nearest first"""
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    radius_km = request.args.get('radius_km', type=float)
+    limit = spatial_limit()
+    
+    if lat is None or lon is None or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return jsonify({'error': 'lat must be in [-90, 90] and lon in [-180, 180]'}), 400
+    if radius_km is None or not 0 < radius_km <= math.pi * EARTH_RADIUS_KM:
+        return jsonify({'error': 'radius_km must be a positive distance'}), 400
+    if limit is None:
+        return jsonify({'error': f'limit must be between 1 and {MAX_SPATIAL_RESULTS}'}), 400
+    
+    conn = get_db_connection()
+    devices = query_near(conn.cursor(), lat, lon, radius_km, limit)
+    conn.close()
+    
+    return jsonify({
+        'lat': lat,
+        'lon': lon,
+        'radius_km': radius_km,
+        'device_count': len(devices),
+        'devices': devices
+    })
+
+@app.route('/api/location/bbox', methods=['GET'])
+def get_locations_in_bbox():
+    """Devices whose latest location is inside a bounding box.
+    
+    min_lon > max_lon selects a box that crosses the antimeridian.
+    """
+    bounds = {name: request.args.get(name, type=float) for name in ('min_lat', 'min_lon', 'max_lat', 'max_lon')}
+    limit = spatial_limit()
+    
+    if None in bounds.values():
+        return jsonify({'error': 'min_lat, min_lon, max_lat and max_lon are required numbers'}), 400
+    if not (-90 <= bounds['min_lat'] <= bounds['max_lat'] <= 90 and
+            -180 <= bounds['min_lon'] <= 180 and -180 <= bounds['max_lon'] <= 180):
+        return jsonify({'error': 'Invalid bounding box'}), 400
+    if limit is None:
+        return jsonify({'error': f'limit must be between 1 and {MAX_SPATIAL_RESULTS}'}), 400
+    
+    conn = get_db_connection()
+    devices = query_bbox(conn.cursor(), bounds['min_lat'], bounds['max_lat'],
+                         bounds['min_lon'], bounds['max_lon'], limit)
+    conn.close()
+    
+    return jsonify(dict(bounds, device_count=len(devices), devices=devices))
+
 @app.route('/api/location/<device_serial>', methods=['GET'])
 def get_location_history(device_serial):
     conn = get_db_connection()
@@ -272,10 +580,8 @@ def get_latest_location(device_serial):
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('''
-    SELECT * FROM device_locations
+    SELECT * FROM device_latest_location
     WHERE device_serial = ?
-    ORDER BY timestamp DESC
-    LIMIT 1
     ''', (device_serial,))
     
     row = cursor.fetchone()
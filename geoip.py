@@ -0,0 +1,264 @@
+"""
+IP geolocation for geo.py without a network round trip per request.
+
+IPRangeDatabase loads a local IP-range file into sorted arrays of range starts
+and ends (one set for IPv4, one for IPv6), and a lookup is a binary search
+over them. Identical locations are stored once and shared by all their ranges.
+The file is a CSV with a header row and these columns:
+
+  ip_start, ip_end             first and last address of the range, as dotted
+                               or colon notation or as integers
+  (or) network                 a CIDR block instead of ip_start/ip_end
+  latitude, longitude          required
+  city, region, country        optional
+
+Free "IP to city" CSV exports (e.g. DB-IP Lite or IP2Location LITE) have this
+shape once their columns are renamed. Gzipped files (.csv.gz) are read
+directly.
+
+Resolvers share one interface: `resolve(ip)` returns a location dict (ip,
+latitude, longitude, city, region, country) or None.
+  LocalResolver    looks the address up in an IPRangeDatabase
+  HTTPResolver     asks ipapi.co (and api.ipify.org for our own public IP);
+                   needs `requests`
+  ChainResolver    tries resolvers in order
+  CachedResolver   LRU cache with a TTL, keyed by IP, in front of any resolver
+
+build_resolver() puts these together as geo.py configures them.
+"""
+
+import bisect
+import csv
+import gzip
+import ipaddress
+import socket
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+LOCATION_FIELDS = ('latitude', 'longitude', 'city', 'region', 'country')
+
+
+class IPRangeDatabase:
+    """Non-overlapping IP ranges, sorted by start address, with their locations"""
+
+    def __init__(self, ranges=()):
+        """`ranges` is an iterable of (first, last, location) with integer or string addresses"""
+        self.locations = []
+        # IP version -> (starts, ends, location indexes), sorted by start
+        self.tables = {}
+        self._build(ranges)
+
+    @classmethod
+    def from_csv(cls, path):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', newline='', encoding='utf-8') as f:
+            return cls(_csv_ranges(csv.DictReader(f)))
+
+    def _build(self, ranges):
+        index = {}
+        rows = {4: [], 6: []}
+        for first, last, location in ranges:
+            (version, first), (last_version, last) = _address(first), _address(last)
+            if version != last_version or first > last:
+                raise ValueError(f"Invalid range {first} - {last}")
+            key = tuple(location.get(field) for field in LOCATION_FIELDS)
+            if key not in index:
+                index[key] = len(self.locations)
+                self.locations.append(dict(zip(LOCATION_FIELDS, key)))
+            rows[version].append((first, last, index[key]))
+
+        for version, version_rows in rows.items():
+            version_rows.sort()
+            # IPv4 addresses fit compact unsigned arrays; IPv6 needs Python ints
+            if version == 4:
+                starts, ends = array('I'), array('I')
+            else:
+                starts, ends = [], []
+            indexes = array('I')
+            for first, last, location_index in version_rows:
+                if ends and first <= ends[-1]:
+                    raise ValueError(f"Overlapping ranges at {ipaddress.ip_address(first)}")
+                starts.append(first)
+                ends.append(last)
+                indexes.append(location_index)
+            self.tables[version] = (starts, ends, indexes)
+
+    def __len__(self):
+        return sum(len(starts) for starts, _, _ in self.tables.values())
+
+    def lookup(self, ip):
+        """Location dict for an address, or None if no range covers it"""
+        try:
+            version, value = _address(ip)
+        except ValueError:
+            return None
+        if version == 6 and value >> 32 == 0xFFFF:
+            # IPv4-mapped IPv6 address (::ffff:a.b.c.d)
+            version, value = 4, value & 0xFFFFFFFF
+        starts, ends, indexes = self.tables[version]
+        i = bisect.bisect_right(starts, value) - 1
+        if i < 0 or value > ends[i]:
+            return None
+        return self.locations[indexes[i]]
+
+
+def _address(value):
+    """(IP version, integer value) of an address given as a string, integer or ipaddress object"""
+    if isinstance(value, str):
+        if value.isdigit():
+            value = int(value)
+        else:
+            # inet_pton parses far faster than ipaddress and is just as strict
+            family, version = (socket.AF_INET6, 6) if ':' in value else (socket.AF_INET, 4)
+            try:
+                return version, int.from_bytes(socket.inet_pton(family, value), 'big')
+            except OSError:
+                raise ValueError(f"{value!r} is not a valid IP address")
+    if isinstance(value, int) and 0 <= value < 2 ** 32:
+        return 4, value
+    address = ipaddress.ip_address(value)
+    return address.version, int(address)
+
+
+def _csv_ranges(reader):
+    for row in reader:
+        if row.get('network'):
+            network = ipaddress.ip_network(row['network'], strict=False)
+            first, last = network.network_address, network.broadcast_address
+        else:
+            first, last = row['ip_start'], row['ip_end']
+        yield first, last, {
+            'latitude': round(float(row['latitude']), 6),
+            'longitude': round(float(row['longitude']), 6),
+            'city': row.get('city') or 'N/A',
+            'region': row.get('region') or 'N/A',
+            'country': row.get('country') or 'N/A',
+        }
+
+
+class LocalResolver:
+    """Resolves addresses from an IPRangeDatabase"""
+
+    def __init__(self, database):
+        self.database = database
+
+    def resolve(self, ip):
+        if not ip:
+            # Our own public address can only be found out over the network
+            return None
+        location = self.database.lookup(ip)
+        return dict(location, ip=ip) if location else None
+
+
+class HTTPResolver:
+    """Online lookup through ipapi.co, as geo.py originally did for every request"""
+
+    def __init__(self, timeout=3.0):
+        if requests is None:
+            raise RuntimeError("The HTTP geolocation fallback needs requests (pip install requests)")
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def resolve(self, ip):
+        try:
+            if not ip:
+                # Get the public IP address
+                ip = self.session.get('https://api.ipify.org?format=json', timeout=self.timeout).json()['ip']
+
+            geo_data = self.session.get(f'https://ipapi.co/{ip}/json/', timeout=self.timeout).json()
+            if geo_data.get('error') or geo_data.get('latitude') is None:
+                return None
+
+            # Format latitude and longitude to 6 decimal places
+            return {
+                'ip': geo_data.get('ip', ip),
+                'latitude': round(float(geo_data['latitude']), 6),
+                'longitude': round(float(geo_data['longitude']), 6),
+                'city': geo_data.get('city') or 'N/A',
+                'region': geo_data.get('region') or 'N/A',
+                'country': geo_data.get('country_name') or 'N/A'
+            }
+        except Exception as e:
+            print(f"Error getting geolocation data: {e}")
+            return None
+
+
+class ChainResolver:
+    """Tries each resolver in turn and returns the first answer"""
+
+    def __init__(self, resolvers):
+        self.resolvers = list(resolvers)
+
+    def resolve(self, ip):
+        for resolver in self.resolvers:
+            location = resolver.resolve(ip)
+            if location:
+                return location
+        return None
+
+
+class CachedResolver:
+    """LRU cache of up to `maxsize` answers, each kept for `ttl` seconds.
+
+    Misses are cached for `negative_ttl` seconds so an unknown address doesn't
+    hit the fallback on every request.
+    """
+
+    def __init__(self, resolver, maxsize=10000, ttl=3600.0, negative_ttl=300.0):
+        self.resolver = resolver
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()  # ip -> (expires_at, location)
+        self._lock = threading.Lock()
+
+    def resolve(self, ip):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(ip)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(ip)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        # Resolve outside the lock; a concurrent miss for the same address
+        # costs one extra lookup at worst
+        location = self.resolver.resolve(ip)
+        if not ip:
+            # "Our own address" may resolve differently once we know it
+            return location
+        expires_at = now + (self.ttl if location else self.negative_ttl)
+        with self._lock:
+            self._entries[ip] = (expires_at, location)
+            self._entries.move_to_end(ip)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return location
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def build_resolver(database_path=None, http_fallback=True, cache_size=10000, ttl=3600.0):
+    """Local database (if given) then, optionally, the HTTP lookup, behind a cache"""
+    resolvers = []
+    if database_path:
+        database = IPRangeDatabase.from_csv(database_path)
+        print(f"Loaded {len(database):,} IP ranges from {database_path}")
+        resolvers.append(LocalResolver(database))
+    if http_fallback:
+        if requests is None:
+            print("requests is not installed, HTTP geolocation fallback disabled")
+        else:
+            resolvers.append(HTTPResolver())
+    return CachedResolver(ChainResolver(resolvers), maxsize=cache_size, ttl=ttl)
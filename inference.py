@@ -0,0 +1,288 @@
+"""
+Fused inference engine for the heart condition models.
+
+The three joblib models (tachycardia, hypertrophy, cholesterol) are loaded once
+and scored together. Linear models are reduced to a stacked weight matrix so all
+of them are evaluated with a single matrix product, and decision trees are
+flattened into plain NumPy node arrays. Anything else falls back to a single
+predict_proba call per model. Labels are always derived from the same pass that
+produces the probabilities.
+
+Because every model feature is derived from the integer heart rate alone, the
+engine also precomputes features, labels and probabilities for every heart rate
+in HEART_RATE_DOMAIN when the models are loaded. score_heart_rates() serves
+in-domain readings from that table and only runs live inference outside it.
+
+Model files are opened with joblib's mmap_mode='r', so their NumPy arrays are
+backed by the page cache and shared between worker processes instead of being
+copied into each one. scikit-learn itself is only imported when models are
+first loaded, which keeps it off the import path of the app.
+
+Run `python inference.py` to check parity against the sklearn outputs.
+"""
+
+import hashlib
+
+import numpy as np
+import joblib
+from scipy.special import expit
+
+# Order matters: rows of every prediction array follow this order
+CONDITIONS = ('tachycardia', 'hypertrophy', 'cholesterol')
+
+# Inclusive range of heart rates covered by the lookup table
+HEART_RATE_DOMAIN = (1, 300)
+
+MODEL_PATHS = {
+    'tachycardia': 'model/tachycardia_model.joblib',
+    'hypertrophy': 'model/hypertrophy_model.joblib',
+    'cholesterol': 'model/cholesterol_model.joblib',
+}
+
+
+def load_models(paths=MODEL_PATHS):
+    """Load every condition model, memory-mapping its arrays"""
+    return {name: joblib.load(paths[name], mmap_mode='r') for name in CONDITIONS}
+
+
+def models_version(paths=MODEL_PATHS):
+    """Short content hash of the model files"""
+    digest = hashlib.sha256()
+    for name in CONDITIONS:
+        with open(paths[name], 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+def derive_features(heart_rates):
+    """Calculate the model features for an array of heart rates"""
+    heart_rate = np.asarray(heart_rates, dtype=np.int64)
+    hrv = np.maximum(20, 100 - heart_rate)  # HRV tends to decrease with higher HR
+    spo2 = np.where(heart_rate < 100, 98, 95)  # SpO2 drops slightly with high HR
+
+    # Simulate more features that the model expects
+    systolic = 110 + (heart_rate // 10)  # Approximation based on HR
+    diastolic = 70 + (heart_rate // 20)  # Approximation based on HR
+    body_temp = 36.6 + (heart_rate - 70) * 0.01  # Slight increase with HR
+
+    # 6 features per reading, as expected by the models
+    return np.column_stack([heart_rate, hrv, spo2, systolic, diastolic, body_temp]).astype(float)
+
+
+def _is_binary_logistic(model):
+    from sklearn.linear_model import LogisticRegression
+    return (isinstance(model, LogisticRegression) and
+            len(model.classes_) == 2 and
+            model.coef_.shape[0] == 1)
+
+
+def _flatten_trees(model):
+    """Extract the node arrays of a tree or tree ensemble, or None if unsupported"""
+    from sklearn.tree import DecisionTreeClassifier
+    from sklearn.ensemble import RandomForestClassifier, ExtraTreesClassifier
+
+    if isinstance(model, DecisionTreeClassifier):
+        estimators = [model]
+    elif isinstance(model, (RandomForestClassifier, ExtraTreesClassifier)):
+        estimators = model.estimators_
+    else:
+        return None
+
+    if len(model.classes_) != 2:
+        return None
+
+    trees = []
+    for estimator in estimators:
+        tree = estimator.tree_
+        # Normalise leaf values to class probabilities like predict_proba does
+        value = tree.value[:, 0, :]
+        totals = value.sum(axis=1, keepdims=True)
+        totals[totals == 0] = 1.0
+        trees.append((
+            tree.children_left.copy(),
+            tree.children_right.copy(),
+            tree.feature.copy(),
+            tree.threshold.copy(),
+            (value / totals)[:, 1].copy()
+        ))
+    return trees
+
+
+def _score_trees(trees, X):
+    """Vectorised traversal of flattened trees; returns P(class 1) per row"""
+    proba = np.zeros(X.shape[0])
+    rows = np.arange(X.shape[0])
+    for left, right, feature, threshold, value in trees:
+        node = np.zeros(X.shape[0], dtype=np.intp)
+        active = left[node] != -1
+        while active.any():
+            idx = rows[active]
+            current = node[idx]
+            go_left = X[idx, feature[current]] <= threshold[current]
+            node[idx] = np.where(go_left, left[current], right[current])
+            active = left[node] != -1
+        proba += value[node]
+    return proba / len(trees)
+
+
+class InferenceEngine:
+    """Loads the condition models once and scores all of them in one pass"""
+
+    def __init__(self, models=None, paths=MODEL_PATHS, heart_rate_domain=HEART_RATE_DOMAIN):
+        self.paths = paths
+        self.heart_rate_domain = heart_rate_domain
+        self._load(models)
+
+    def reload(self, models=None):
+        """Reload the models from disk and rebuild the compiled arrays and lookup table"""
+        self._load(models)
+
+    def _load(self, models):
+        # Identifies this set of models, e.g. in heart_readings.model_version
+        if models is None:
+            self.version = models_version(self.paths)
+            models = load_models(self.paths)
+        else:
+            self.version = joblib.hash([models[name] for name in CONDITIONS])[:12]
+        self.models = models
+        self._compile()
+        self._build_lookup()
+
+    def _compile(self):
+        """Pull model parameters into plain NumPy arrays where possible"""
+        self.classes = np.array([self.models[name].classes_ for name in CONDITIONS])
+        self.linear = []
+        self.trees = {}
+        self.fallback = []
+        for i, name in enumerate(CONDITIONS):
+            model = self.models[name]
+            if _is_binary_logistic(model):
+                self.linear.append(i)
+                continue
+            trees = _flatten_trees(model)
+            if trees is not None:
+                self.trees[i] = trees
+            else:
+                self.fallback.append(i)
+
+        if self.linear:
+            self.coef = np.vstack([self.models[CONDITIONS[i]].coef_ for i in self.linear])
+            self.intercept = np.concatenate([self.models[CONDITIONS[i]].intercept_ for i in self.linear])
+
+    def _build_lookup(self):
+        """Precompute features and predictions for every heart rate in the domain"""
+        low, high = self.heart_rate_domain
+        features = derive_features(np.arange(low, high + 1))
+        preds, probs = self.predict(features)
+        # Replaced as one tuple so readers never see a half-built table
+        self._lookup = (features, preds, probs)
+
+    def score_heart_rates(self, heart_rates):
+        """Features, labels and probabilities for integer heart rates.
+
+        Returns (features, preds, probs) with shapes (n, 6), (3, n) and (3, n).
+        Heart rates inside the domain are served from the lookup table; the
+        rest go through live inference.
+        """
+        heart_rate = np.asarray(heart_rates, dtype=np.int64)
+        lookup_features, lookup_preds, lookup_probs = self._lookup
+        low, high = self.heart_rate_domain
+        inside = (heart_rate >= low) & (heart_rate <= high)
+
+        index = heart_rate[inside] - low
+        if inside.all():
+            return lookup_features[index], lookup_preds[:, index], lookup_probs[:, index]
+
+        features = derive_features(heart_rate)
+        preds = np.empty((len(CONDITIONS), len(heart_rate)), dtype=np.int64)
+        probs = np.empty((len(CONDITIONS), len(heart_rate)))
+        preds[:, inside] = lookup_preds[:, index]
+        probs[:, inside] = lookup_probs[:, index]
+        preds[:, ~inside], probs[:, ~inside] = self.predict(features[~inside])
+        return features, preds, probs
+
+    def predict(self, features):
+        """Score a feature matrix for every condition.
+
+        Returns (preds, probs), both of shape (3, n) in CONDITIONS order.
+        probs is NaN for a model that has no predict_proba.
+        """
+        X = np.asarray(features, dtype=float)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+
+        probs = np.empty((len(CONDITIONS), X.shape[0]))
+        # Class index (0 or 1) per condition and row
+        labels = np.zeros((len(CONDITIONS), X.shape[0]), dtype=np.intp)
+
+        if self.linear:
+            # One matrix product scores every linear model
+            scores = (X @ self.coef.T + self.intercept).T
+            probs[self.linear] = expit(scores)
+            labels[self.linear] = scores > 0
+
+        for i, trees in self.trees.items():
+            probs[i] = _score_trees(trees, X)
+            labels[i] = probs[i] > 0.5
+
+        for i in self.fallback:
+            model = self.models[CONDITIONS[i]]
+            if hasattr(model, 'predict_proba'):
+                proba = model.predict_proba(X)
+                probs[i] = proba[:, 1]
+                labels[i] = proba.argmax(axis=1)
+            else:
+                probs[i] = np.nan
+                labels[i] = np.searchsorted(model.classes_, model.predict(X))
+
+        preds = np.take_along_axis(self.classes, labels, axis=1)
+        return preds.astype(np.int64), probs
+
+
+def check_parity(engine, n=5000, seed=0):
+    """Compare the engine against the sklearn predict/predict_proba outputs"""
+    rng = np.random.default_rng(seed)
+    heart_rate = np.concatenate([np.arange(1, 301), rng.integers(1, 301, n)])
+    features = derive_features(heart_rate)
+    # Add some noise so we don't only test the derived-feature manifold
+    noisy = features + rng.normal(0, 5, features.shape)
+
+    ok = True
+    for X in (features, noisy):
+        preds, probs = engine.predict(X)
+        for i, name in enumerate(CONDITIONS):
+            model = engine.models[name]
+            expected_pred = model.predict(X)
+            if not np.array_equal(preds[i], expected_pred):
+                print(f"{name}: {np.sum(preds[i] != expected_pred)} label mismatches")
+                ok = False
+            if hasattr(model, 'predict_proba'):
+                expected_prob = model.predict_proba(X)[:, 1]
+                if not np.allclose(probs[i], expected_prob, rtol=1e-9, atol=1e-12):
+                    print(f"{name}: max probability error {np.max(np.abs(probs[i] - expected_prob))}")
+                    ok = False
+
+    # The lookup table (and its live fallback outside the domain) must agree
+    # with live inference
+    low, high = engine.heart_rate_domain
+    heart_rates = np.concatenate([heart_rate, [low - 1, high + 1, high + 50]])
+    features, preds, probs = engine.score_heart_rates(heart_rates)
+    live_preds, live_probs = engine.predict(derive_features(heart_rates))
+    if not (np.array_equal(features, derive_features(heart_rates)) and
+            np.array_equal(preds, live_preds) and
+            np.allclose(probs, live_probs, rtol=1e-12, atol=0, equal_nan=True)):
+        print("Lookup table disagrees with live inference")
+        ok = False
+    return ok
+
+
+if __name__ == '__main__':
+    engine = InferenceEngine()
+    print(f"Model version: {engine.version}")
+    print(f"Linear models: {[CONDITIONS[i] for i in engine.linear]}")
+    print(f"Tree models: {[CONDITIONS[i] for i in engine.trees]}")
+    print(f"Fallback models: {[CONDITIONS[i] for i in engine.fallback]}")
+    if check_parity(engine):
+        print("Parity check passed")
+    else:
+        raise SystemExit("Parity check failed")
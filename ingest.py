@@ -0,0 +1,165 @@
+"""
+Bounded ingest queue with a single micro-batching writer.
+
+Request threads don't write readings themselves. They submit already
+validated readings to an IngestQueue and wait on the Future it returns. One
+writer thread drains the queue. It takes everything that arrived, up to
+`max_batch` readings, waiting at most `max_delay` seconds for a batch to fill.
+It stores the batch with one `store` call (one transaction), then resolves
+each request's Future with its own slice of the results. SQLite's write lock
+therefore only ever has one taker in this process, and a burst of requests
+costs one commit per batch instead of one per reading.
+
+The queue holds at most `max_pending` readings. When it is full, submit()
+raises QueueFull straight away so the caller can answer 503 with Retry-After
+instead of piling up threads. If a batch fails, its requests are retried one
+by one, so a bad request only fails itself.
+"""
+
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+
+class QueueFull(Exception):
+    """The ingest queue has no room; retry after `retry_after` seconds"""
+
+    def __init__(self, retry_after):
+        super().__init__("Ingest queue is full, try again later")
+        self.retry_after = retry_after
+
+
+class IngestQueue:
+    """Queue of pending readings drained by one batching writer thread.
+
+    `store` takes a list of readings and returns one result per reading, in
+    order (app.store_readings).
+    """
+
+    def __init__(self, store, max_pending=5000, max_batch=500, max_delay=0.005):
+        self.store = store
+        self.max_pending = max_pending
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._requests = deque()  # (readings, future)
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread = None
+        self._pid = None
+        # Recent write throughput in readings/s, for Retry-After
+        self._rate = None
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork_in_child)
+
+    def _after_fork_in_child(self):
+        # Requests queued before the fork belong to the parent, and the
+        # condition may still list the parent's writer as a waiter
+        self._requests = deque()
+        self._pending = 0
+        self._cond = threading.Condition()
+
+    def submit(self, readings):
+        """Queue readings for the writer; returns a Future of their results.
+
+        Raises QueueFull if they don't fit. A request larger than the whole
+        queue is still accepted once the queue is empty.
+        """
+        readings = list(readings)
+        future = Future()
+        if not readings:
+            future.set_result([])
+            return future
+        self.start()
+        with self._cond:
+            if self._pending and self._pending + len(readings) > self.max_pending:
+                raise QueueFull(self.retry_after())
+            self._requests.append((readings, future))
+            self._pending += len(readings)
+            self._cond.notify()
+        return future
+
+    def retry_after(self):
+        """Seconds until the current backlog should have been written"""
+        if not self._rate:
+            return 1
+        return max(1, math.ceil(self._pending / self._rate))
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def start(self):
+        """Start the writer thread (idempotent, and restarts after a fork)"""
+        with self._cond:
+            if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop = False
+            self._thread = threading.Thread(target=self._run, name="ingest-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """Write what is already queued, then stop the writer"""
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _next_batch(self):
+        """Wait for requests and take up to max_batch readings' worth; None once stopped"""
+        with self._cond:
+            while not self._requests and not self._stop:
+                self._cond.wait()
+            if not self._requests:
+                return None
+
+            # Give concurrent requests a moment to join the batch
+            deadline = time.monotonic() + self.max_delay
+            while self._pending < self.max_batch and not self._stop:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch = []
+            size = 0
+            while self._requests and (not batch or size + len(self._requests[0][0]) <= self.max_batch):
+                readings, future = self._requests.popleft()
+                batch.append((readings, future))
+                size += len(readings)
+            self._pending -= size
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            start = time.perf_counter()
+            self._write(batch)
+            elapsed = time.perf_counter() - start
+            if elapsed > 0:
+                rate = sum(len(readings) for readings, _ in batch) / elapsed
+                self._rate = rate if self._rate is None else 0.8 * self._rate + 0.2 * rate
+
+    def _write(self, batch):
+        try:
+            results = self.store([reading for readings, _ in batch for reading in readings])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            print(f"Ingest batch of {len(batch)} requests failed, retrying one by one: {str(e)}")
+            for request in batch:
+                self._write([request])
+            return
+
+        offset = 0
+        for readings, future in batch:
+            future.set_result(results[offset:offset + len(readings)])
+            offset += len(readings)
@@ -2,24 +2,69 @@
 """
 IoT Device Simulator for Heart Monitoring System
 
-This script simulates an IoT heart monitoring device sending data to the server.
+This script simulates IoT heart monitoring devices sending data to the server.
 It can be used for testing the system without actual hardware.
 
+With --device_id it drives a single device and prints every reading it sends.
+
+With --devices=N it becomes a load generator. N simulated devices share one
+asyncio event loop and a pool of keep-alive connections. Each device sends
+readings at random (Poisson) intervals that average --interval seconds, or
+the whole fleet sends --rate readings per second. A reading goes out when it
+is due, whether or not earlier ones have been answered. Latencies are
+measured from that due time, so they include any wait for a free connection.
+
+  --emergency_ratio   share of readings with a dangerous heart rate (120-180)
+  --batch_size        readings a device buffers before flushing them to
+                      /api/iot/readings:batch (1 posts each one to /api/iot/reading);
+                      partly filled buffers are flushed at the end of the test
+  --read_rate         dashboard requests per second to /api/patients/<id>/vitals
+  --connections       size of the connection pool
+  --test_client       run app.py in this process through Flask's test client
+                      instead of sending to --server
+
+The load-test devices (LOAD-000001, ...) live in the database given by --db,
+with one patient each. Any that don't exist yet are created there, so run
+against a local server or a scratch copy of its database. The report lists
+throughput, latency percentiles and error rates per endpoint.
+
 Usage:
   python iot_device_simulator.py --device_id=DEV-12345678 --api_key=your_api_key --server=http://localhost:5000
+  python iot_device_simulator.py --devices=5000 --interval=5 --duration=60 --batch_size=10
+  python iot_device_simulator.py --devices=2000 --rate=500 --emergency_ratio=0.05 --test_client
 """
 
 import argparse
-import requests
-import time
-import random
+import asyncio
 import json
+import os
+import random
+import sqlite3
+import ssl
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import urlsplit
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+LOAD_DEVICE_PREFIX = 'LOAD-'
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 def simulate_heart_rate(base_rate=70, variation=10):
     """Simulate a heart rate with some random variation"""
     return max(40, min(200, base_rate + random.randint(-variation, variation)))
 
+def simulate_emergency_heart_rate():
+    """Simulate a dangerous heart rate"""
+    return random.randint(120, 180)
+
 def send_reading(device_id, api_key, heart_rate, server_url):
     """Send a reading to the server"""
     endpoint = f"{server_url}/api/iot/reading"
@@ -53,22 +98,378 @@ def send_reading(device_id, api_key, heart_rate, server_url):
         print(f"Connection error: {str(e)}")
         return False
 
+class HTTPConnectionPool:
+    """Keep-alive HTTP/1.1 connections to one server, at most `size` in use at a time"""
+    
+    def __init__(self, server_url, size=100, timeout=30.0):
+        url = urlsplit(server_url)
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == 'https' else 80)
+        self.ssl = ssl.create_default_context() if url.scheme == 'https' else None
+        self.prefix = url.path.rstrip('/')
+        self.timeout = timeout
+        self._idle = []  # (reader, writer)
+        self._slots = asyncio.Semaphore(size)
+    
+    async def request(self, method, path, payload=None):
+        """(status, body) of one request with an optional JSON payload"""
+        async with self._slots:
+            for attempt in range(2):
+                reused = bool(self._idle)
+                if reused:
+                    reader, writer = self._idle.pop()
+                else:
+                    reader, writer = await asyncio.wait_for(
+                        asyncio.open_connection(self.host, self.port, ssl=self.ssl), self.timeout
+                    )
+                try:
+                    status, headers, body = await asyncio.wait_for(
+                        self._exchange(reader, writer, method, path, payload), self.timeout
+                    )
+                except asyncio.IncompleteReadError:
+                    writer.close()
+                    # The server may have closed the connection while it sat idle
+                    if reused and attempt == 0:
+                        continue
+                    raise ConnectionError("Server closed the connection")
+                except BaseException:
+                    writer.close()
+                    raise
+                    
+                if headers.get('connection', '').lower() == 'close':
+                    writer.close()
+                else:
+                    self._idle.append((reader, writer))
+                return status, body
+    
+    async def _exchange(self, reader, writer, method, path, payload):
+        head = f"{method} {self.prefix}{path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+        body = b''
+        if payload is not None:
+            body = json.dumps(payload).encode('utf-8')
+            head += f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+        writer.write(head.encode('latin-1') + b"\r\n" + body)
+        await writer.drain()
+        
+        status = int((await reader.readuntil(b"\r\n")).split()[1])
+        headers = {}
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+            
+        if 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b';')[0], 16)
+                chunk = await reader.readexactly(size + 2)
+                if not size:
+                    break
+                chunks.append(chunk[:-2])
+            body = b''.join(chunks)
+        else:
+            # No length given: the body runs until the server closes the connection
+            body = await reader.read()
+            headers['connection'] = 'close'
+        return status, headers, body
+    
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+
+class FlaskClientPool:
+    """Requests to app.py in this process through Flask's test client, `size` at a time"""
+    
+    def __init__(self, flask_app, size=100):
+        self.flask_app = flask_app
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='test-client')
+    
+    def _request(self, method, path, payload):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.flask_app.test_client()
+        response = client.open(path, method=method, json=payload)
+        return response.status_code, response.get_data()
+    
+    async def request(self, method, path, payload=None):
+        """(status, body) of one request with an optional JSON payload"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._request, method, path, payload)
+    
+    async def close(self):
+        self._executor.shutdown(wait=True)
+
+def provision_devices(db_path, count):
+    """(device_id, api_key, patient_id) of `count` load-test devices, creating any that don't exist"""
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        existing = {
+            row[0]: row for row in conn.execute(
+                'SELECT device_id, api_key, patient_id FROM devices WHERE device_id LIKE ?',
+                (LOAD_DEVICE_PREFIX + '%',)
+            )
+        }
+        now = datetime.now().strftime(TIME_FORMAT)
+        devices = []
+        for number in range(1, count + 1):
+            device_id = f"{LOAD_DEVICE_PREFIX}{number:06d}"
+            device = existing.get(device_id)
+            if device is None or device[2] is None:
+                patient_id = conn.execute(
+                    'INSERT INTO patients (name, age, gender, created_at) VALUES (?, ?, ?, ?)',
+                    (f"Load Test {number}", random.randint(30, 80), random.choice('MF'), now)
+                ).lastrowid
+                api_key = device[1] if device else uuid.uuid4().hex
+                conn.execute(
+                    'INSERT OR REPLACE INTO devices (device_id, device_name, device_type, patient_id, api_key, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                    (device_id, f"Load Test {number}", 'heart_monitor', patient_id, api_key, now)
+                )
+                device = (device_id, api_key, patient_id)
+            devices.append(device)
+        conn.commit()
+        return devices
+    finally:
+        conn.close()
+
+class EndpointStats:
+    """Latencies and response statuses for one endpoint"""
+    
+    def __init__(self):
+        self.latencies = []  # ms, from when each request was due
+        self.statuses = Counter()  # HTTP status or exception name -> count
+        self.accepted = 0  # readings stored
+        self.rejected = 0  # readings refused inside successful batches
+    
+    def record(self, status, latency, readings=0, rejected=0):
+        self.statuses[status] += 1
+        if status == 200:
+            self.accepted += readings - rejected
+            self.rejected += rejected
+        if latency is not None:
+            self.latencies.append(latency)
+    
+    @property
+    def requests(self):
+        return sum(self.statuses.values())
+    
+    @property
+    def errors(self):
+        return sum(count for status, count in self.statuses.items() if not isinstance(status, int) or status >= 400)
+    
+    def percentile(self, p):
+        if not self.latencies:
+            return float('nan')
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+class LoadGenerator:
+    """Simulated fleet of devices (and dashboards) sending requests on a Poisson schedule"""
+    
+    def __init__(self, devices, rate, duration, batch_size=1, emergency_ratio=0.0, read_rate=0.0,
+                 base_rate=70, variation=10, max_in_flight=10000):
+        self.devices = devices
+        self.rate = rate
+        self.duration = duration
+        self.batch_size = batch_size
+        self.emergency_ratio = emergency_ratio
+        self.read_rate = read_rate
+        self.base_rate = base_rate
+        self.variation = variation
+        self.max_in_flight = max_in_flight
+        self.stats = defaultdict(EndpointStats)  # "METHOD /path" -> EndpointStats
+        self.max_lag = 0.0
+        self.elapsed = None
+        self._in_flight = set()
+    
+    async def run(self, transport):
+        """Send requests through `transport` for `duration` seconds, then wait for the stragglers"""
+        self.transport = transport
+        self.started = time.perf_counter()
+        self.deadline = self.started + self.duration
+        tasks = [asyncio.create_task(self._device(*device)) for device in self.devices]
+        if self.read_rate:
+            tasks.append(asyncio.create_task(self._dashboards()))
+        progress = asyncio.create_task(self._progress())
+        try:
+            await asyncio.gather(*tasks)
+            if self._in_flight:
+                await asyncio.wait(set(self._in_flight))
+        finally:
+            progress.cancel()
+        self.elapsed = time.perf_counter() - self.started
+    
+    async def _device(self, device_id, api_key, patient_id):
+        interval = len(self.devices) / self.rate
+        buffer = []
+        due = self.started + random.expovariate(1 / interval)
+        while due < self.deadline:
+            await asyncio.sleep(due - time.perf_counter())
+            if random.random() < self.emergency_ratio:
+                heart_rate = simulate_emergency_heart_rate()
+            else:
+                heart_rate = simulate_heart_rate(self.base_rate, self.variation)
+            reading = {"device_id": device_id, "api_key": api_key, "heart_rate": heart_rate}
+            
+            if self.batch_size == 1:
+                self._send('POST', '/api/iot/reading', reading, due, readings=1)
+            else:
+                # Buffered readings keep the time they were taken
+                reading["timestamp"] = datetime.now().strftime(TIME_FORMAT)
+                buffer.append(reading)
+                if len(buffer) >= self.batch_size:
+                    self._send('POST', '/api/iot/readings:batch', {"readings": buffer}, due, readings=len(buffer))
+                    buffer = []
+            due += random.expovariate(1 / interval)
+        
+        # Flush what is still buffered as the device shuts down at the deadline
+        if buffer:
+            await asyncio.sleep(self.deadline - time.perf_counter())
+            self._send('POST', '/api/iot/readings:batch', {"readings": buffer}, self.deadline, readings=len(buffer))
+    
+    async def _dashboards(self):
+        due = self.started
+        while True:
+            due += random.expovariate(self.read_rate)
+            if due >= self.deadline:
+                return
+            await asyncio.sleep(due - time.perf_counter())
+            patient_id = random.choice(self.devices)[2]
+            self._send('GET', f'/api/patients/{patient_id}/vitals', None, due,
+                       endpoint='GET /api/patients/<id>/vitals')
+    
+    def _send(self, method, path, payload, due, readings=0, endpoint=None):
+        endpoint = endpoint or f"{method} {path}"
+        self.max_lag = max(self.max_lag, time.perf_counter() - due)
+        if len(self._in_flight) >= self.max_in_flight:
+            self.stats[endpoint].record('not sent (too many in flight)', None, readings)
+            return
+        task = asyncio.create_task(self._request(endpoint, method, path, payload, due, readings))
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+    
+    async def _request(self, endpoint, method, path, payload, due, readings):
+        rejected = 0
+        try:
+            status, body = await self.transport.request(method, path, payload)
+            if status == 200 and readings > 1:
+                rejected = json.loads(body).get('rejected', 0)
+        except Exception as e:
+            status = type(e).__name__
+        latency = (time.perf_counter() - due) * 1000
+        self.stats[endpoint].record(status, latency, readings, rejected)
+    
+    async def _progress(self, every=10):
+        while True:
+            await asyncio.sleep(every)
+            done = sum(stats.requests for stats in self.stats.values())
+            errors = sum(stats.errors for stats in self.stats.values())
+            print(f"  [{time.perf_counter() - self.started:5.0f}s] {done:,} responses, {errors:,} errors, "
+                  f"{len(self._in_flight):,} in flight")
+    
+    def report(self):
+        print(f"{'endpoint':<32} {'requests':>9} {'req/s':>8} {'readings/s':>10} {'p50 ms':>8} "
+              f"{'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'errors':>7}")
+        for endpoint, stats in sorted(self.stats.items()):
+            print(f"{endpoint:<32} {stats.requests:>9,} {stats.requests / self.elapsed:>8.1f} "
+                  f"{stats.accepted / self.elapsed:>10.1f} {stats.percentile(0.5):>8.1f} {stats.percentile(0.95):>8.1f} "
+                  f"{stats.percentile(0.99):>8.1f} {max(stats.latencies, default=float('nan')):>8.1f} "
+                  f"{stats.errors / stats.requests:>7.1%}")
+            print("    " + "  ".join(f"{status}: {count:,}" for status, count in sorted(stats.statuses.items(), key=str)))
+            if stats.rejected:
+                print(f"    {stats.rejected:,} readings rejected inside successful batches")
+        if self.max_lag > 0.1:
+            print(f"Requests went out up to {self.max_lag * 1000:.0f} ms late; the generator itself is saturated")
+
+def run_load_test(args):
+    """Provision the load-test fleet, run it and print the report"""
+    if args.test_client:
+        # Imports app.py, which opens (and migrates) heart_monitor.db in the working directory
+        import app as heart_app
+        db_path = heart_app.DB_PATH
+    else:
+        db_path = args.db
+        if not os.path.exists(db_path):
+            raise SystemExit(f"{db_path} not found; run from the server's directory or pass --db")
+            
+    devices = provision_devices(db_path, args.devices)
+    rate = args.rate or args.devices / args.interval
+    target = 'Flask test client' if args.test_client else args.server
+    print(f"IoT Heart Monitor Load Test")
+    print(f"Target: {target} ({args.connections} connections)")
+    print(f"{args.devices:,} devices sending {rate:,.1f} readings/s for {args.duration:g}s, "
+          f"batch size {args.batch_size}, {args.emergency_ratio:.0%} emergencies")
+    if args.batch_size * args.devices / rate > args.duration:
+        print(f"Warning: devices take {args.batch_size * args.devices / rate:g}s on average to fill a batch; "
+              f"most readings will only be sent in the final flush")
+    if args.read_rate:
+        print(f"Dashboards requesting {args.read_rate:,.1f} vitals/s")
+    print("-" * 50)
+    
+    generator = LoadGenerator(
+        devices, rate, args.duration, batch_size=args.batch_size, emergency_ratio=args.emergency_ratio,
+        read_rate=args.read_rate, base_rate=args.base_rate, variation=args.variation,
+        max_in_flight=args.max_in_flight
+    )
+    
+    async def load():
+        if args.test_client:
+            transport = FlaskClientPool(heart_app.app, size=args.connections)
+        else:
+            transport = HTTPConnectionPool(args.server, size=args.connections, timeout=args.timeout)
+        try:
+            await generator.run(transport)
+        finally:
+            await transport.close()
+            
+    asyncio.run(load())
+    print("-" * 50)
+    generator.report()
+
 def main():
     parser = argparse.ArgumentParser(description='IoT Heart Monitor Simulator')
-    parser.add_argument('--device_id', required=True, help='Device ID')
-    parser.add_argument('--api_key', required=True, help='API Key')
+    parser.add_argument('--device_id', help='Device ID')
+    parser.add_argument('--api_key', help='API Key')
     parser.add_argument('--server', default='http://localhost:5000', help='Server URL')
-    parser.add_argument('--interval', type=int, default=30, help='Interval between readings in seconds')
+    parser.add_argument('--interval', type=float, default=30, help='Interval between readings in seconds')
     parser.add_argument('--base_rate', type=int, default=70, help='Base heart rate')
     parser.add_argument('--variation', type=int, default=10, help='Heart rate variation')
     parser.add_argument('--simulate_emergency', action='store_true', help='Simulate emergency condition')
     
+    load = parser.add_argument_group('load testing')
+    load.add_argument('--devices', type=int, help='Simulate this many devices concurrently')
+    load.add_argument('--rate', type=float, help='Readings per second across all devices (default: devices / interval)')
+    load.add_argument('--duration', type=float, default=60, help='Length of the test in seconds')
+    load.add_argument('--batch_size', type=int, default=1, help='Readings each device buffers per request')
+    load.add_argument('--emergency_ratio', type=float, default=0.0, help='Share of readings with a dangerous heart rate')
+    load.add_argument('--read_rate', type=float, default=0.0, help='Dashboard vitals requests per second')
+    load.add_argument('--connections', type=int, default=100, help='Connection pool size')
+    load.add_argument('--timeout', type=float, default=30, help='Request timeout in seconds')
+    load.add_argument('--max_in_flight', type=int, default=10000, help='Requests outstanding before new ones are dropped')
+    load.add_argument('--test_client', action='store_true', help='Use the Flask test client instead of --server')
+    load.add_argument('--db', default='heart_monitor.db', help='Database to create the load-test devices in')
+    
     args = parser.parse_args()
     
+    if args.devices:
+        if args.batch_size < 1 or args.connections < 1 or not 0 <= args.emergency_ratio <= 1:
+            parser.error("--batch_size and --connections must be positive and --emergency_ratio within [0, 1]")
+        run_load_test(args)
+        return
+    if not args.device_id or not args.api_key:
+        parser.error("--device_id and --api_key are required unless --devices is given")
+    if requests is None:
+        parser.error("Single-device mode needs requests (pip install requests)")
+        
     print(f"IoT Heart Monitor Simulator")
     print(f"Device ID: {args.device_id}")
     print(f"Server: {args.server}")
-    print(f"Sending readings every {args.interval} seconds...")
+    print(f"Sending readings every {args.interval:g} seconds...")
     print("Press Ctrl+C to stop")
     print("-" * 50)
     
@@ -76,7 +477,7 @@ def main():
         while True:
             if args.simulate_emergency and random.random() < 0.2:  # 20% chance of emergency
                 # Simulate dangerous heart rate
-                heart_rate = random.randint(120, 180)
+                heart_rate = simulate_emergency_heart_rate()
                 print("⚠️ Simulating emergency condition!")
             else:
                 heart_rate = simulate_heart_rate(args.base_rate, args.variation)
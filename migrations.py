@@ -0,0 +1,309 @@
+"""
+Versioned schema migrations for the heart monitor database.
+
+The schema version is stored in SQLite's `PRAGMA user_version`. Each migration
+runs in its own transaction together with the version bump, so a failed
+migration leaves the database at the previous version. Add new migrations to
+the end of MIGRATIONS; never edit one that has already shipped.
+
+Run `python migrations.py [db_path]` to apply pending migrations by hand.
+"""
+
+import sqlite3
+import sys
+
+
+def _initial_schema(cursor):
+    """Tables that init_db used to create ad hoc (IF NOT EXISTS keeps old databases working)"""
+    # Create table for storing sensor readings and predictions
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS heart_readings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp TEXT NOT NULL,
+        patient_id INTEGER NOT NULL,
+        heart_rate INTEGER NOT NULL,
+        hrv REAL NOT NULL,
+        spo2 REAL NOT NULL,
+        systolic INTEGER NOT NULL,
+        diastolic INTEGER NOT NULL,
+        body_temp REAL NOT NULL,
+        tachycardia_pred INTEGER NOT NULL,
+        hypertrophy_pred INTEGER NOT NULL,
+        cholesterol_pred INTEGER NOT NULL,
+        tachycardia_prob REAL,
+        hypertrophy_prob REAL,
+        cholesterol_prob REAL,
+        notification_sent INTEGER DEFAULT 0,
+        device_id TEXT,
+        FOREIGN KEY (patient_id) REFERENCES patients (id),
+        FOREIGN KEY (device_id) REFERENCES devices (device_id)
+    )
+    ''')
+
+    # Create table for patients
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS patients (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        age INTEGER NOT NULL,
+        gender TEXT NOT NULL,
+        medical_history TEXT,
+        created_at TEXT NOT NULL
+    )
+    ''')
+
+    # Create table for caregivers
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS caregivers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        email TEXT NOT NULL UNIQUE,
+        phone TEXT,
+        created_at TEXT NOT NULL
+    )
+    ''')
+
+    # Create table for patient-caregiver relationships
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS patient_caregivers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        patient_id INTEGER NOT NULL,
+        caregiver_id INTEGER NOT NULL,
+        relationship TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        FOREIGN KEY (patient_id) REFERENCES patients (id),
+        FOREIGN KEY (caregiver_id) REFERENCES caregivers (id),
+        UNIQUE(patient_id, caregiver_id)
+    )
+    ''')
+
+    # Create table for IoT devices
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS devices (
+        device_id TEXT PRIMARY KEY,
+        device_name TEXT NOT NULL,
+        device_type TEXT NOT NULL,
+        patient_id INTEGER,
+        api_key TEXT NOT NULL,
+        last_seen TEXT,
+        status TEXT DEFAULT 'active',
+        created_at TEXT NOT NULL,
+        FOREIGN KEY (patient_id) REFERENCES patients (id)
+    )
+    ''')
+
+    # Create table for queued caregiver alerts
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS notification_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        reading_id INTEGER,
+        patient_id INTEGER NOT NULL,
+        caregiver_email TEXT NOT NULL,
+        caregiver_name TEXT NOT NULL,
+        patient_name TEXT NOT NULL,
+        relationship TEXT,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at TEXT NOT NULL,
+        last_error TEXT,
+        created_at TEXT NOT NULL,
+        sent_at TEXT,
+        FOREIGN KEY (reading_id) REFERENCES heart_readings (id),
+        FOREIGN KEY (patient_id) REFERENCES patients (id)
+    )
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_outbox_due
+    ON notification_outbox (status, next_attempt_at)
+    ''')
+
+    # Create table for per-patient alert episodes
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS alert_state (
+        patient_id INTEGER NOT NULL,
+        condition TEXT NOT NULL,
+        active INTEGER NOT NULL DEFAULT 0,
+        episode_started_at TEXT,
+        last_alert_at TEXT,
+        last_alert_heart_rate INTEGER,
+        alerts_sent INTEGER NOT NULL DEFAULT 0,
+        dangerous_readings INTEGER NOT NULL DEFAULT 0,
+        clear_readings INTEGER NOT NULL DEFAULT 0,
+        peak_heart_rate INTEGER,
+        PRIMARY KEY (patient_id, condition),
+        FOREIGN KEY (patient_id) REFERENCES patients (id)
+    )
+    ''')
+
+
+def _reading_indexes(cursor):
+    """Indexes matching the heart_readings and devices query patterns"""
+    # get_recent_readings(patient_id) and MAX(id) per patient
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_readings_patient_id
+    ON heart_readings (patient_id, id DESC)
+    ''')
+    # view_device: latest readings from one device
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_readings_device_id
+    ON heart_readings (device_id, id DESC)
+    ''')
+    # get_patient_devices
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_devices_patient
+    ON devices (patient_id)
+    ''')
+    # Outstanding-alert check when a delivery succeeds
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_outbox_reading
+    ON notification_outbox (reading_id, status)
+    ''')
+
+
+def _reading_history_index(cursor):
+    """Carry the timestamp in the per-patient index for time-range queries"""
+    # /api/patients/<id>/readings walks a patient's readings in id order and
+    # filters on timestamp; with the timestamp in the index, rows outside the
+    # range are skipped without touching the table. The (patient_id, id DESC)
+    # prefix is unchanged, so the existing queries keep using it.
+    cursor.execute('DROP INDEX IF EXISTS idx_readings_patient_id')
+    cursor.execute('''
+    CREATE INDEX idx_readings_patient_id
+    ON heart_readings (patient_id, id DESC, timestamp)
+    ''')
+
+
+def _vitals_rollups(cursor):
+    """Per-patient 1-minute, 1-hour and 1-day vitals rollups, backfilled from heart_readings"""
+    # Bucket start as a timestamp string: truncate and pad the stored timestamp
+    buckets = {
+        '1m': "substr(replace(timestamp, 'T', ' '), 1, 16) || ':00'",
+        '1h': "substr(replace(timestamp, 'T', ' '), 1, 13) || ':00:00'",
+        '1d': "substr(replace(timestamp, 'T', ' '), 1, 10) || ' 00:00:00'",
+    }
+    for resolution, bucket in buckets.items():
+        # Sums rather than averages so buckets can be updated incrementally
+        cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS vitals_rollup_{resolution} (
+            patient_id INTEGER NOT NULL,
+            bucket_start TEXT NOT NULL,
+            readings INTEGER NOT NULL,
+            dangerous_readings INTEGER NOT NULL,
+            heart_rate_min INTEGER NOT NULL,
+            heart_rate_max INTEGER NOT NULL,
+            heart_rate_sum INTEGER NOT NULL,
+            systolic_min INTEGER NOT NULL,
+            systolic_max INTEGER NOT NULL,
+            systolic_sum INTEGER NOT NULL,
+            diastolic_min INTEGER NOT NULL,
+            diastolic_max INTEGER NOT NULL,
+            diastolic_sum INTEGER NOT NULL,
+            spo2_min REAL NOT NULL,
+            spo2_max REAL NOT NULL,
+            spo2_sum REAL NOT NULL,
+            PRIMARY KEY (patient_id, bucket_start)
+        ) WITHOUT ROWID
+        ''')
+        # A reading is dangerous under the same rules as alerts.detect_conditions
+        cursor.execute(f'''
+        INSERT INTO vitals_rollup_{resolution}
+        SELECT patient_id, {bucket}, COUNT(*),
+            SUM(tachycardia_pred = 1 OR hypertrophy_pred = 1 OR cholesterol_pred = 1 OR
+                heart_rate > 120 OR systolic > 160 OR diastolic > 100 OR spo2 < 92),
+            MIN(heart_rate), MAX(heart_rate), SUM(heart_rate),
+            MIN(systolic), MAX(systolic), SUM(systolic),
+            MIN(diastolic), MAX(diastolic), SUM(diastolic),
+            MIN(spo2), MAX(spo2), SUM(spo2)
+        FROM heart_readings
+        GROUP BY 1, 2
+        ''')
+
+
+def _model_version(cursor):
+    """Record which models scored each reading, and re-scoring progress"""
+    # NULL for readings scored before versions were recorded
+    cursor.execute('ALTER TABLE heart_readings ADD COLUMN model_version TEXT')
+    # One row per model version that rescore.py has run for
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS rescore_progress (
+        model_version TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL,
+        rows_rescored INTEGER NOT NULL DEFAULT 0,
+        started_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    )
+    ''')
+
+
+def _outbox_claims(cursor):
+    """When each outbox alert was claimed for delivery"""
+    # Claims older than the worker's lease are handed back out; NULL for
+    # alerts claimed before this column existed
+    cursor.execute('ALTER TABLE notification_outbox ADD COLUMN claimed_at TEXT')
+
+
+def _readings_timestamp_index(cursor):
+    """Index readings by timestamp for retention"""
+    # Batch uploads keep device timestamps, so id order doesn't follow time
+    # order and retention has to find expired readings by timestamp
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_readings_timestamp
+    ON heart_readings (timestamp)
+    ''')
+
+
+# (version, description, function(cursor)) in the order they are applied
+MIGRATIONS = [
+    (1, 'Initial schema', _initial_schema),
+    (2, 'Indexes for heart_readings query patterns', _reading_indexes),
+    (3, 'Timestamp in the per-patient readings index', _reading_history_index),
+    (4, 'Vitals rollup tables', _vitals_rollups),
+    (5, 'Model version per reading', _model_version),
+    (6, 'Claim time for outbox alerts', _outbox_claims),
+    (7, 'Timestamp index for retention', _readings_timestamp_index),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn, target=None):
+    """Apply every pending migration up to `target` (default: latest).
+
+    Returns the list of versions that were applied.
+    """
+    target = LATEST_VERSION if target is None else target
+    version = current_version(conn)
+    applied = []
+
+    for migration_version, description, apply in MIGRATIONS:
+        if migration_version <= version or migration_version > target:
+            continue
+
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            apply(cursor)
+            # PRAGMA doesn't accept bound parameters; the version is always an int
+            cursor.execute(f'PRAGMA user_version = {int(migration_version)}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Applied migration {migration_version}: {description}")
+        applied.append(migration_version)
+
+    return applied
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else 'heart_monitor.db'
+    conn = sqlite3.connect(path)
+    print(f"{path}: schema version {current_version(conn)}")
+    if not migrate(conn):
+        print("Already up to date")
+    conn.close()
@@ -0,0 +1,241 @@
+"""
+Durable, asynchronous delivery of caregiver alerts.
+
+The ingest path only writes rows to the `notification_outbox` table, inside the
+same transaction as the reading itself. A background NotificationWorker picks up
+due rows, delivers them concurrently through a pluggable sender and retries
+failures with exponential backoff. A reading's `notification_sent` flag is only
+set once every alert queued for it has been delivered.
+
+Claimed alerts are marked 'sending' with the time of the claim. Several worker
+processes can share the outbox. A claim older than `claim_timeout` seconds is
+taken to belong to a process that died mid-delivery, and the alert goes back to
+'pending'. Newer claims are left alone, so an alert another process is still
+delivering is not sent twice.
+"""
+
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def enqueue_alerts(cursor, reading_id, patient_id, health_data):
+    """Queue one alert per caregiver of the patient. Returns the number queued.
+
+    Runs on the caller's cursor so the alerts commit atomically with the reading.
+    """
+    cursor.execute('SELECT name FROM patients WHERE id = ?', (patient_id,))
+    row = cursor.fetchone()
+    if not row:
+        return 0
+    patient_name = row[0]
+
+    cursor.execute('''
+    SELECT c.name, c.email, pc.relationship
+    FROM caregivers c
+    JOIN patient_caregivers pc ON c.id = pc.caregiver_id
+    WHERE pc.patient_id = ?
+    ''', (patient_id,))
+    caregivers = cursor.fetchall()
+
+    now = datetime.now().strftime(TIME_FORMAT)
+    payload = json.dumps(health_data)
+    cursor.executemany('''
+    INSERT INTO notification_outbox
+    (reading_id, patient_id, caregiver_email, caregiver_name, patient_name,
+    relationship, payload, next_attempt_at, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [
+        (reading_id, patient_id, email, name, patient_name, relationship, payload, now, now)
+        for name, email, relationship in caregivers
+    ])
+    return len(caregivers)
+
+
+class RecordingSender:
+    """Local stand-in for SMTP delivery, for tests and offline development.
+
+    Records every alert it is given. `fail_times` makes the first N deliveries
+    raise, to exercise the retry path.
+    """
+
+    def __init__(self, fail_times=0):
+        self.sent = []
+        self.fail_times = fail_times
+        self._lock = threading.Lock()
+
+    def __call__(self, alert):
+        with self._lock:
+            if self.fail_times > 0:
+                self.fail_times -= 1
+                raise ConnectionError("Simulated SMTP failure")
+            self.sent.append(alert)
+        return True
+
+
+class NotificationWorker:
+    """Background thread that drains the notification outbox.
+
+    `sender` is called with an alert dict (caregiver_email, caregiver_name,
+    patient_name, relationship, health_data) and must return True on success;
+    returning False or raising schedules a retry.
+    """
+
+    def __init__(self, pool, sender, concurrency=4, poll_interval=5.0,
+                 max_attempts=6, base_delay=2.0, max_delay=600.0, batch_size=50, claim_timeout=300.0):
+        self.pool = pool
+        self.sender = sender
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self.claim_timeout = claim_timeout
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the worker thread (idempotent, and restarts after a fork)"""
+        with self._lock:
+            if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._recover()
+            self._thread = threading.Thread(target=self._run, name="notification-worker", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def wake(self):
+        """Ask the worker to look for due alerts now instead of at the next poll"""
+        self.start()
+        self._wake.set()
+
+    def _recover(self):
+        # Alerts claimed by a process that died mid-delivery go back in the
+        # queue once their claim has expired
+        expired = (datetime.now() - timedelta(seconds=self.claim_timeout)).strftime(TIME_FORMAT)
+        with self.pool.connection() as conn:
+            conn.execute('''
+            UPDATE notification_outbox SET status = 'pending'
+            WHERE status = 'sending' AND (claimed_at IS NULL OR claimed_at < ?)
+            ''', (expired,))
+            conn.commit()
+
+    def _run(self):
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="notification") as executor:
+            while not self._stop.is_set():
+                try:
+                    alerts = self._claim_due()
+                except Exception as e:
+                    print(f"Notification worker failed to read outbox: {str(e)}")
+                    alerts = []
+
+                if alerts:
+                    # Deliver concurrently, then go straight back for more
+                    list(executor.map(self._deliver, alerts))
+                    continue
+
+                try:
+                    self._recover()
+                except Exception as e:
+                    print(f"Notification worker failed to recover expired claims: {str(e)}")
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def _claim_due(self):
+        """Mark a batch of due alerts as 'sending' and return them"""
+        now = datetime.now().strftime(TIME_FORMAT)
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+            SELECT * FROM notification_outbox
+            WHERE status = 'pending' AND next_attempt_at <= ?
+            ORDER BY id
+            LIMIT ?
+            ''', (now, self.batch_size))
+            rows = [dict(row) for row in cursor.fetchall()]
+            cursor.executemany(
+                "UPDATE notification_outbox SET status = 'sending', claimed_at = ? WHERE id = ?",
+                [(now, row['id']) for row in rows]
+            )
+            conn.commit()
+        return rows
+
+    def process_pending(self):
+        """Synchronously deliver everything that is due. Returns the number attempted.
+
+        Useful in tests and scripts that don't run the background thread.
+        """
+        attempted = 0
+        while True:
+            alerts = self._claim_due()
+            if not alerts:
+                return attempted
+            for alert in alerts:
+                self._deliver(alert)
+            attempted += len(alerts)
+
+    def _deliver(self, row):
+        alert = {
+            "caregiver_email": row['caregiver_email'],
+            "caregiver_name": row['caregiver_name'],
+            "patient_name": row['patient_name'],
+            "relationship": row['relationship'],
+            "health_data": json.loads(row['payload']),
+        }
+        try:
+            delivered = self.sender(alert)
+            error = None if delivered else "Sender reported failure"
+        except Exception as e:
+            delivered = False
+            error = str(e)
+
+        now = datetime.now()
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            if delivered:
+                cursor.execute('''
+                UPDATE notification_outbox
+                SET status = 'sent', attempts = attempts + 1, sent_at = ?, last_error = NULL
+                WHERE id = ?
+                ''', (now.strftime(TIME_FORMAT), row['id']))
+
+                # Flag the reading once nothing else is outstanding for it
+                if row['reading_id'] is not None:
+                    cursor.execute('''
+                    UPDATE heart_readings SET notification_sent = 1
+                    WHERE id = ? AND NOT EXISTS (
+                        SELECT 1 FROM notification_outbox
+                        WHERE reading_id = ? AND status != 'sent'
+                    )
+                    ''', (row['reading_id'], row['reading_id']))
+            else:
+                attempts = row['attempts'] + 1
+                if attempts >= self.max_attempts:
+                    status = 'failed'
+                    print(f"Giving up on alert {row['id']} to {row['caregiver_email']}: {error}")
+                else:
+                    status = 'pending'
+                delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+                cursor.execute('''
+                UPDATE notification_outbox
+                SET status = ?, attempts = ?, last_error = ?, next_attempt_at = ?
+                WHERE id = ?
+                ''', (status, attempts, error, (now + timedelta(seconds=delay)).strftime(TIME_FORMAT), row['id']))
+            conn.commit()
+        return delivered
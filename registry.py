@@ -0,0 +1,150 @@
+"""
+Hot-reloading registry for the condition models.
+
+ModelRegistry owns the active InferenceEngine. A background thread polls the
+model files every `poll_interval` seconds. Once their size and mtime have
+changed and stayed stable for one more poll (so a deploy copying three files is
+picked up as one set), it builds a new engine off the request path, checks it
+with a warm-up prediction and swaps it in with a single assignment. Requests
+keep using whichever engine they picked up, so nothing is dropped mid-upload.
+A set that fails to load or validate is logged and skipped until the files
+change again.
+
+Every engine carries a `version` (a hash of the model files), which
+store_readings records on each reading.
+
+With lazy=True (the default) nothing is loaded until the engine is first used,
+so importing the app stays cheap and every worker only pays for models it
+actually needs. Use lazy=False to load before forking workers.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from inference import CONDITIONS, HEART_RATE_DOMAIN, MODEL_PATHS, InferenceEngine
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def validate(engine):
+    """Warm-up prediction over in-domain and out-of-domain heart rates; raises ValueError"""
+    low, high = HEART_RATE_DOMAIN
+    heart_rates = np.array([low, 60, 100, 140, 200, high, high + 1])
+    features, preds, probs = engine.score_heart_rates(heart_rates)
+    if preds.shape != (len(CONDITIONS), len(heart_rates)) or features.shape != (len(heart_rates), 6):
+        raise ValueError(f"Unexpected output shapes {preds.shape} / {features.shape}")
+    if not np.isin(preds, (0, 1)).all():
+        raise ValueError(f"Models predict labels other than 0/1: {np.unique(preds)}")
+    finite = probs[~np.isnan(probs)]
+    if ((finite < 0) | (finite > 1)).any():
+        raise ValueError("Probabilities outside [0, 1]")
+
+
+class ModelRegistry:
+    """Holds the active InferenceEngine and swaps in new model files as they appear"""
+
+    def __init__(self, paths=MODEL_PATHS, poll_interval=5.0, lazy=True):
+        self.paths = paths
+        self.poll_interval = poll_interval
+        self.history = []
+        self._signature = None
+        self._engine = None
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        if not lazy:
+            self.engine
+
+    @property
+    def engine(self):
+        """The active engine; take it once per batch so scoring and version match"""
+        # Forked workers need their own watcher thread
+        self.start()
+        engine = self._engine
+        if engine is None:
+            with self._reload_lock:
+                if self._engine is None:
+                    self._signature = self._stat()
+                    self._activate(InferenceEngine(paths=self.paths))
+                engine = self._engine
+        return engine
+
+    def _activate(self, engine):
+        self._engine = engine
+        self.history.append({"version": engine.version, "loaded_at": datetime.now().strftime(TIME_FORMAT)})
+
+    def _stat(self):
+        """(size, mtime) of every model file, or None for missing ones"""
+        signature = []
+        for name in CONDITIONS:
+            try:
+                stat = os.stat(self.paths[name])
+                signature.append((stat.st_size, stat.st_mtime_ns))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def reload(self):
+        """Load, validate and activate the model files now; returns True if a new version went live"""
+        with self._reload_lock:
+            return self._reload()
+
+    def _reload(self):
+        signature = self._stat()
+        try:
+            engine = InferenceEngine(paths=self.paths)
+            validate(engine)
+        except Exception as e:
+            print(f"Failed to load new models: {str(e)}")
+            return False
+        finally:
+            # Don't retry a broken set until the files change again
+            self._signature = signature
+
+        previous = self._engine
+        if previous is not None and engine.version == previous.version:
+            return False
+        self._activate(engine)
+        print(f"Activated models {engine.version}" + (f" (was {previous.version})" if previous else ""))
+        return True
+
+    def start(self):
+        """Start watching the model files (idempotent, and restarts after a fork)"""
+        if not self.poll_interval:
+            return
+        if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="model-registry", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        pending = None
+        while not self._stop.wait(self.poll_interval):
+            if self._engine is None:
+                # Not loaded yet; first use will read whatever is on disk
+                continue
+            signature = self._stat()
+            if signature == self._signature or None in signature:
+                pending = None
+            elif signature != pending:
+                # Changed since the last poll; wait until the copy settles
+                pending = signature
+            else:
+                pending = None
+                start = time.perf_counter()
+                if self.reload():
+                    print(f"Model reload took {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Re-score stored readings with the current models.
+
+After the files in model/ change, the predictions stored in heart_readings were
+made by the old models. RescoreJob walks the table in id order, `chunk_size`
+rows at a time: it builds the 6-column feature matrix from the stored vitals,
+scores every model once per chunk with the InferenceEngine, and writes labels,
+probabilities and model_version back with one executemany per chunk. Rows
+already tagged with the current version are skipped.
+
+Progress is committed with each chunk in rescore_progress, keyed by model
+version, so an interrupted run resumes where it stopped and a later run only
+picks up readings stored since. Dangerous-reading counts in the vitals rollups
+are corrected for readings whose verdict changed. Caregiver alerts are not
+re-sent.
+
+Run `python rescore.py [--db heart_monitor.db]` after updating the models.
+"""
+
+import argparse
+import time
+from datetime import datetime
+
+import numpy as np
+
+import rollups
+from db import ConnectionPool
+from inference import CONDITIONS, InferenceEngine
+from migrations import migrate
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+FEATURE_COLUMNS = ('heart_rate', 'hrv', 'spo2', 'systolic', 'diastolic', 'body_temp')
+PRED_COLUMNS = tuple(f'{name}_pred' for name in CONDITIONS)
+PROB_COLUMNS = tuple(f'{name}_prob' for name in CONDITIONS)
+
+
+def dangerous(features, preds):
+    """Vectorised version of the rules in alerts.detect_conditions"""
+    heart_rate, _, spo2, systolic, diastolic, _ = features.T
+    return ((preds == 1).any(axis=0) | (heart_rate > 120) |
+            (systolic > 160) | (diastolic > 100) | (spo2 < 92))
+
+
+class RescoreJob:
+    """Resumable, chunked re-scoring of heart_readings"""
+
+    def __init__(self, pool, engine, chunk_size=20_000):
+        self.pool = pool
+        self.engine = engine
+        self.chunk_size = chunk_size
+
+    def progress(self):
+        """(last_id, rows_rescored) for the engine's model version"""
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                'SELECT last_id, rows_rescored FROM rescore_progress WHERE model_version = ?',
+                (self.engine.version,)
+            ).fetchone()
+        return (row['last_id'], row['rows_rescored']) if row else (0, 0)
+
+    def reset(self):
+        with self.pool.connection() as conn:
+            conn.execute('DELETE FROM rescore_progress WHERE model_version = ?', (self.engine.version,))
+            conn.commit()
+
+    def run(self, report=print):
+        """Re-score every reading after the saved position; returns the number of rows updated"""
+        version = self.engine.version
+        last_id, done = self.progress()
+        with self.pool.connection() as conn:
+            remaining = conn.execute('SELECT COUNT(*) FROM heart_readings WHERE id > ?', (last_id,)).fetchone()[0]
+        report(f"Model version {version}: {remaining:,} readings after id {last_id:,} to check")
+
+        columns = ('id', 'timestamp', 'patient_id', 'model_version') + FEATURE_COLUMNS + PRED_COLUMNS
+        start = time.perf_counter()
+        checked = updated = 0
+        while True:
+            with self.pool.connection() as conn:
+                cursor = conn.execute(
+                    f'SELECT {", ".join(columns)} FROM heart_readings WHERE id > ? ORDER BY id LIMIT ?',
+                    (last_id, self.chunk_size)
+                )
+                cursor.row_factory = None
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                checked += len(rows)
+                last_id = rows[-1][0]
+
+                stale = [row for row in rows if row[3] != version]
+                if stale:
+                    features = np.array([row[4:10] for row in stale], dtype=float)
+                    old_preds = np.array([row[10:13] for row in stale], dtype=np.int64).T
+                    preds, probs = self.engine.predict(features)
+                    probs = np.where(np.isnan(probs), None, probs.astype(object))
+
+                    params = [
+                        (*map(int, preds[:, i]), *probs[:, i], version, row[0])
+                        for i, row in enumerate(stale)
+                    ]
+                    delta = dangerous(features, preds).astype(int) - dangerous(features, old_preds).astype(int)
+                    changes = [(stale[i][1], stale[i][2], int(delta[i])) for i in np.flatnonzero(delta)]
+
+                try:
+                    conn.execute('BEGIN IMMEDIATE')
+                    if stale:
+                        conn.executemany(f'''
+                        UPDATE heart_readings
+                        SET {", ".join(f"{column} = ?" for column in PRED_COLUMNS + PROB_COLUMNS)},
+                            model_version = ?
+                        WHERE id = ?
+                        ''', params)
+                        rollups.adjust_dangerous(conn, changes)
+                    now = datetime.now().strftime(TIME_FORMAT)
+                    conn.execute('''
+                    INSERT INTO rescore_progress (model_version, last_id, rows_rescored, started_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (model_version) DO UPDATE SET
+                        last_id = excluded.last_id,
+                        rows_rescored = rows_rescored + excluded.rows_rescored,
+                        updated_at = excluded.updated_at
+                    ''', (version, last_id, len(stale), now, now))
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                updated += len(stale)
+
+            elapsed = time.perf_counter() - start
+            rate = checked / elapsed if elapsed else 0
+            eta = (remaining - checked) / rate if rate else 0
+            report(f"  {checked:,}/{remaining:,} checked, {updated:,} re-scored, "
+                   f"{rate:,.0f} rows/s, ETA {max(eta, 0):,.0f}s")
+
+        report(f"Done: {updated:,} readings re-scored in {time.perf_counter() - start:.1f}s "
+               f"({done + updated:,} in total for this version)")
+        return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-score stored readings with the current models')
+    parser.add_argument('--db', default='heart_monitor.db', help='Database to update')
+    parser.add_argument('--chunk-size', type=int, default=20_000, help='Readings per chunk')
+    parser.add_argument('--restart', action='store_true', help='Ignore saved progress and start from the first reading')
+    args = parser.parse_args()
+
+    pool = ConnectionPool(args.db)
+    with pool.connection() as conn:
+        migrate(conn)
+    job = RescoreJob(pool, InferenceEngine(), args.chunk_size)
+    if args.restart:
+        job.reset()
+    job.run()
+    pool.close_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Retention for heart_readings and the vitals rollups.
+
+Raw readings are kept in the main database for `raw_days`. Older readings are
+already summarised in the vitals rollups (they are maintained on insert), so
+the job moves them into one SQLite file per month under `archive_dir`
+(heart_readings_YYYY-MM.db, same table layout) and deletes them from the main
+database. Rollup tiers have their own retention: by default 1-minute buckets are
+kept for 90 days and 1-hour buckets for two years, while 1-day buckets are kept
+forever.
+
+Work is done in chunks of `chunk_size` rows, each in its own short transaction,
+with a pause between chunks so ingest never waits long for the write lock. Each
+chunk is committed to the archive before it is deleted from the main database,
+so an interrupted run only leaves rows that the next run archives again
+(INSERT OR IGNORE on the reading id). Readings with undelivered notifications are
+left in place until their outbox rows are settled.
+
+Run `python retention.py [--db heart_monitor.db]`, e.g. nightly from cron.
+"""
+
+import argparse
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from db import ConnectionPool
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Days of rollup buckets to keep per resolution; missing means forever
+DEFAULT_ROLLUP_DAYS = {'1m': 90, '1h': 730}
+
+
+class RetentionJob:
+    """Archives old raw readings and trims the rollup tiers"""
+
+    def __init__(self, pool, archive_dir='archive', raw_days=30, rollup_days=None,
+                 chunk_size=5000, pause=0.05):
+        self.pool = pool
+        self.archive_dir = archive_dir
+        self.raw_days = raw_days
+        self.rollup_days = DEFAULT_ROLLUP_DAYS if rollup_days is None else rollup_days
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self._archives = {}  # month -> open archive connection
+
+    def run(self, now=None):
+        """Apply every policy once; returns counts of what was moved or removed"""
+        now = now or datetime.now()
+        stats = {'archived': 0, 'held_for_notifications': 0}
+        try:
+            cutoff = (now - timedelta(days=self.raw_days)).strftime(TIME_FORMAT)
+            stats['archived'], stats['held_for_notifications'] = self.archive_readings(cutoff)
+        finally:
+            self._close_archives()
+
+        for resolution, days in self.rollup_days.items():
+            cutoff = (now - timedelta(days=days)).strftime(TIME_FORMAT)
+            stats[f'rollup_{resolution}_deleted'] = self.trim_rollups(resolution, cutoff)
+        return stats
+
+    def archive_readings(self, cutoff):
+        """Move readings older than `cutoff` to the monthly archives.
+
+        Expired readings are walked in (timestamp, id) order along the
+        timestamp index, a chunk at a time. Id order can't be used because it
+        doesn't follow time order: batch uploads keep the time a device took
+        each reading, so a late upload adds old readings after recent ones.
+        """
+        archived = held = 0
+        last = ('', 0)  # (timestamp, id) of the last reading seen
+        while True:
+            with self.pool.connection() as conn:
+                expired = conn.execute('''
+                SELECT * FROM heart_readings INDEXED BY idx_readings_timestamp
+                WHERE timestamp < ? AND (timestamp, id) > (?, ?)
+                ORDER BY timestamp, id
+                LIMIT ?
+                ''', (cutoff, *last, self.chunk_size)).fetchall()
+                if not expired:
+                    break
+                last = (expired[-1]['timestamp'], expired[-1]['id'])
+
+                # Keep readings whose notifications are still being delivered
+                ids = [row['id'] for row in expired]
+                pending = {
+                    row[0] for row in conn.execute(f'''
+                    SELECT DISTINCT reading_id FROM notification_outbox
+                    WHERE reading_id IN ({",".join("?" * len(ids))}) AND status IN ('pending', 'sending')
+                    ''', ids)
+                }
+                expired = [row for row in expired if row['id'] not in pending]
+                held += len(pending)
+
+                by_month = {}
+                for row in expired:
+                    by_month.setdefault(row['timestamp'][:7], []).append(row)
+                for month, month_rows in by_month.items():
+                    self._write_archive(month, month_rows)
+
+                # Only now that the archive has them, remove them here
+                ids = [(row['id'],) for row in expired]
+                try:
+                    conn.execute('BEGIN IMMEDIATE')
+                    conn.executemany('DELETE FROM notification_outbox WHERE reading_id = ?', ids)
+                    conn.executemany('DELETE FROM heart_readings WHERE id = ?', ids)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                archived += len(ids)
+
+            if self.pause:
+                time.sleep(self.pause)
+        return archived, held
+
+    def trim_rollups(self, resolution, cutoff):
+        """Delete rollup buckets that start before `cutoff`, a chunk at a time"""
+        deleted = 0
+        while True:
+            with self.pool.connection() as conn:
+                cursor = conn.execute(f'''
+                DELETE FROM vitals_rollup_{resolution}
+                WHERE (patient_id, bucket_start) IN (
+                    SELECT patient_id, bucket_start FROM vitals_rollup_{resolution}
+                    WHERE bucket_start < ?
+                    LIMIT ?
+                )
+                ''', (cutoff, self.chunk_size))
+                conn.commit()
+            deleted += cursor.rowcount
+            if cursor.rowcount < self.chunk_size:
+                return deleted
+            if self.pause:
+                time.sleep(self.pause)
+
+    def _write_archive(self, month, rows):
+        conn = self._archives.get(month)
+        if conn is None:
+            os.makedirs(self.archive_dir, exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self.archive_dir, f'heart_readings_{month}.db'))
+            self._archives[month] = conn
+        columns = rows[0].keys()
+        self._ensure_archive_table(conn, columns)
+
+        conn.executemany(
+            f'INSERT OR IGNORE INTO heart_readings ({", ".join(columns)}) '
+            f'VALUES ({", ".join("?" * len(columns))})',
+            [tuple(row) for row in rows]
+        )
+        conn.commit()
+
+    def _ensure_archive_table(self, conn, columns):
+        """Create the archive table, or add columns the main table has gained since"""
+        existing = [row[1] for row in conn.execute('PRAGMA table_info(heart_readings)')]
+        if not existing:
+            with self.pool.connection() as main:
+                sql = main.execute(
+                    "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'heart_readings'"
+                ).fetchone()[0]
+            conn.execute(sql)
+            return
+        for column in columns:
+            if column not in existing:
+                conn.execute(f'ALTER TABLE heart_readings ADD COLUMN {column}')
+
+    def _close_archives(self):
+        for conn in self._archives.values():
+            conn.close()
+        self._archives = {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Archive old heart readings and trim rollups')
+    parser.add_argument('--db', default='heart_monitor.db', help='Database to clean up')
+    parser.add_argument('--archive-dir', default='archive', help='Directory for the monthly archives')
+    parser.add_argument('--raw-days', type=int, default=30, help='Days of raw readings to keep')
+    parser.add_argument('--rollup-1m-days', type=int, default=DEFAULT_ROLLUP_DAYS['1m'],
+                        help='Days of 1-minute rollups to keep')
+    parser.add_argument('--rollup-1h-days', type=int, default=DEFAULT_ROLLUP_DAYS['1h'],
+                        help='Days of 1-hour rollups to keep')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='Rows per transaction')
+    args = parser.parse_args()
+
+    pool = ConnectionPool(args.db)
+    job = RetentionJob(
+        pool,
+        archive_dir=args.archive_dir,
+        raw_days=args.raw_days,
+        rollup_days={'1m': args.rollup_1m_days, '1h': args.rollup_1h_days},
+        chunk_size=args.chunk_size
+    )
+    start = time.perf_counter()
+    stats = job.run()
+    pool.close_all()
+    for name, count in stats.items():
+        print(f"{name}: {count:,}")
+    print(f"Finished in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
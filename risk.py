@@ -0,0 +1,149 @@
+"""
+Heart disease risk model behind /predict.
+
+model/model.pkl is a classifier over (heart_rate, blood_glucose) trained on
+inputs standardised by model/scaler.pkl. For a binary MLPClassifier the
+scaler is folded into the first layer's weights and the forward pass runs in
+plain NumPy, so any number of pairs is scored with one matrix product per
+layer. Other models fall back to scaler.transform + predict_proba.
+
+Both files are opened with joblib's mmap_mode='r' the first time a prediction
+is made, and the loaded model is shared by every request afterwards.
+
+Run `python risk.py` to check parity against the sklearn outputs.
+"""
+
+import hashlib
+import threading
+
+import joblib
+import numpy as np
+from scipy.special import expit
+
+RISK_MODEL_PATHS = {
+    'model': 'model/model.pkl',
+    'scaler': 'model/scaler.pkl',
+}
+
+# Input columns, in the order the scaler and model expect them
+FEATURES = ('heart_rate', 'blood_glucose')
+
+# (upper probability bound, level, Bootstrap colour) for result.html
+RISK_LEVELS = (
+    (0.3, 'Low', 'success'),
+    (0.7, 'Moderate', 'warning'),
+    (1.0, 'High', 'danger'),
+)
+
+ACTIVATIONS = {
+    'identity': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'tanh': np.tanh,
+    'logistic': expit,
+}
+
+
+def risk_level(probability):
+    """(level, colour) for a risk probability"""
+    for bound, level, colour in RISK_LEVELS:
+        if probability < bound:
+            return level, colour
+    return RISK_LEVELS[-1][1:]
+
+
+def _fold_scaler(model, scaler):
+    """Layer weights of a binary MLP with the scaler folded into the first layer, or None"""
+    from sklearn.neural_network import MLPClassifier
+
+    if not isinstance(model, MLPClassifier) or len(model.classes_) != 2:
+        return None
+    if model.out_activation_ != 'logistic' or model.activation not in ACTIVATIONS:
+        return None
+
+    mean = scaler.mean_ if scaler.with_mean else np.zeros(len(FEATURES))
+    scale = scaler.scale_ if scaler.with_std else np.ones(len(FEATURES))
+    # (X - mean) / scale @ W + b == X @ (W / scale) + (b - (mean / scale) @ W)
+    first = np.asarray(model.coefs_[0])
+    coefs = [first / scale[:, None]] + [np.asarray(coef) for coef in model.coefs_[1:]]
+    intercepts = [np.asarray(model.intercepts_[0]) - (mean / scale) @ first]
+    intercepts += [np.asarray(intercept) for intercept in model.intercepts_[1:]]
+    return coefs, intercepts
+
+
+class RiskModel:
+    """The /predict model and its scaler, loaded once on first use"""
+
+    def __init__(self, paths=RISK_MODEL_PATHS, lazy=True):
+        self.paths = paths
+        self._loaded = None
+        self._lock = threading.Lock()
+        if not lazy:
+            self._load()
+
+    def _load(self):
+        loaded = self._loaded
+        if loaded is None:
+            with self._lock:
+                if self._loaded is None:
+                    digest = hashlib.sha256()
+                    for name in ('model', 'scaler'):
+                        with open(self.paths[name], 'rb') as f:
+                            digest.update(f.read())
+                    model = joblib.load(self.paths['model'], mmap_mode='r')
+                    scaler = joblib.load(self.paths['scaler'], mmap_mode='r')
+                    # Replaced as one tuple so readers never see a half-loaded model
+                    self._loaded = (model, scaler, _fold_scaler(model, scaler), digest.hexdigest()[:12])
+                loaded = self._loaded
+        return loaded
+
+    @property
+    def version(self):
+        return self._load()[3]
+
+    def predict_proba(self, X):
+        """Probability of the positive class for an (n, 2) array of (heart_rate, blood_glucose)"""
+        model, scaler, layers, _ = self._load()
+        X = np.asarray(X, dtype=float).reshape(-1, len(FEATURES))
+        if layers is None:
+            return model.predict_proba(scaler.transform(X))[:, 1]
+
+        coefs, intercepts = layers
+        activation = ACTIVATIONS[model.activation]
+        out = X
+        for coef, intercept in zip(coefs[:-1], intercepts[:-1]):
+            out = activation(out @ coef + intercept)
+        return expit(out @ coefs[-1] + intercepts[-1])[:, 0]
+
+    def predict(self, X):
+        """(labels, probabilities) for an (n, 2) array; labels follow model.classes_"""
+        model = self._load()[0]
+        proba = self.predict_proba(X)
+        return model.classes_[(proba > 0.5).astype(np.intp)], proba
+
+
+def check_parity(risk_model, n=5000, seed=0):
+    """Compare the folded pipeline against scaler.transform + predict/predict_proba"""
+    model, scaler, _, _ = risk_model._load()
+    rng = np.random.default_rng(seed)
+    X = np.column_stack([rng.uniform(30, 220, n), rng.uniform(50, 400, n)])
+    labels, proba = risk_model.predict(X)
+    scaled = scaler.transform(X)
+    ok = True
+    if not np.array_equal(labels, model.predict(scaled)):
+        print(f"{np.sum(labels != model.predict(scaled))} label mismatches")
+        ok = False
+    expected = model.predict_proba(scaled)[:, 1]
+    if not np.allclose(proba, expected, rtol=1e-9, atol=1e-12):
+        print(f"Max probability error {np.max(np.abs(proba - expected))}")
+        ok = False
+    return ok
+
+
+if __name__ == '__main__':
+    risk_model = RiskModel()
+    print(f"Model version: {risk_model.version}")
+    print(f"Folded pipeline: {risk_model._load()[2] is not None}")
+    if check_parity(risk_model):
+        print("Parity check passed")
+    else:
+        raise SystemExit("Parity check failed")
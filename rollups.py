@@ -0,0 +1,124 @@
+"""
+Per-patient vitals rollups at 1-minute, 1-hour and 1-day resolution.
+
+Each vitals_rollup_<resolution> table holds one row per (patient_id, bucket)
+with the reading count, the number of dangerous readings and min/max/sum of
+heart rate, systolic, diastolic and SpO2. store_readings calls update() in its
+insert transaction, so the rollups are always in step with heart_readings, and
+trend charts read a few hundred buckets instead of aggregating raw rows.
+
+Buckets are keyed by their start as a "%Y-%m-%d %H:%M:%S" string, which is just
+the reading's timestamp truncated and padded.
+"""
+
+# resolution -> (bucket length in seconds, timestamp prefix length, padding)
+RESOLUTIONS = {
+    '1m': (60, 16, ':00'),
+    '1h': (3600, 13, ':00:00'),
+    '1d': (86400, 10, ' 00:00:00'),
+}
+
+# Vitals kept in the rollups, in column order
+VITALS = ('heart_rate', 'systolic', 'diastolic', 'spo2')
+
+# Automatic resolution picks the finest one with at most this many buckets
+MAX_POINTS = 1000
+
+
+def bucket_start(timestamp, resolution):
+    """Start of the bucket a "%Y-%m-%d %H:%M:%S" timestamp falls in"""
+    _, length, padding = RESOLUTIONS[resolution]
+    return str(timestamp).replace('T', ' ', 1)[:length] + padding
+
+
+def update(cursor, readings):
+    """Fold newly inserted readings into every rollup table.
+
+    Each reading is a (timestamp, patient_id, heart_rate, systolic, diastolic,
+    spo2, is_dangerous) tuple. Readings are aggregated in memory first, so a
+    batch costs one upsert per touched bucket.
+    """
+    for resolution in RESOLUTIONS:
+        buckets = {}
+        for timestamp, patient_id, *vitals, is_dangerous in readings:
+            key = (patient_id, bucket_start(timestamp, resolution))
+            bucket = buckets.get(key)
+            if bucket is None:
+                # [readings, dangerous, then min/max/sum per vital]
+                bucket = buckets[key] = [0, 0]
+                for value in vitals:
+                    bucket += [value, value, 0]
+            bucket[0] += 1
+            bucket[1] += int(bool(is_dangerous))
+            for i, value in enumerate(vitals):
+                offset = 2 + 3 * i
+                bucket[offset] = min(bucket[offset], value)
+                bucket[offset + 1] = max(bucket[offset + 1], value)
+                bucket[offset + 2] += value
+
+        updates = ',\n'.join(
+            f'{vital}_min = MIN({vital}_min, excluded.{vital}_min), '
+            f'{vital}_max = MAX({vital}_max, excluded.{vital}_max), '
+            f'{vital}_sum = {vital}_sum + excluded.{vital}_sum'
+            for vital in VITALS
+        )
+        cursor.executemany(f'''
+        INSERT INTO vitals_rollup_{resolution} VALUES ({", ".join("?" * (4 + 3 * len(VITALS)))})
+        ON CONFLICT (patient_id, bucket_start) DO UPDATE SET
+            readings = readings + excluded.readings,
+            dangerous_readings = dangerous_readings + excluded.dangerous_readings,
+            {updates}
+        ''', [key + tuple(bucket) for key, bucket in buckets.items()])
+
+
+def adjust_dangerous(cursor, changes):
+    """Apply changes in dangerous-reading counts, e.g. after re-scoring.
+
+    Each change is a (timestamp, patient_id, delta) tuple. Buckets that have
+    already been trimmed by retention are skipped.
+    """
+    for resolution in RESOLUTIONS:
+        deltas = {}
+        for timestamp, patient_id, delta in changes:
+            key = (patient_id, bucket_start(timestamp, resolution))
+            deltas[key] = deltas.get(key, 0) + delta
+        cursor.executemany(f'''
+        UPDATE vitals_rollup_{resolution}
+        SET dangerous_readings = dangerous_readings + ?
+        WHERE patient_id = ? AND bucket_start = ?
+        ''', [(delta,) + key for key, delta in deltas.items() if delta])
+
+
+def pick_resolution(start, end, max_points=MAX_POINTS):
+    """Finest resolution that covers start..end (datetimes) in at most max_points buckets"""
+    span = (end - start).total_seconds()
+    for resolution, (seconds, _, _) in RESOLUTIONS.items():
+        if span / seconds <= max_points:
+            return resolution
+    return '1d'
+
+
+def query(cursor, patient_id, resolution, start, end):
+    """Buckets for one patient with start <= bucket_start < end, oldest first"""
+    cursor.execute(f'''
+    SELECT * FROM vitals_rollup_{resolution}
+    WHERE patient_id = ? AND bucket_start >= ? AND bucket_start < ?
+    ORDER BY bucket_start
+    ''', (patient_id, bucket_start(start, resolution), end))
+
+    buckets = []
+    for row in cursor.fetchall():
+        bucket = {
+            "bucket_start": row['bucket_start'],
+            "readings": row['readings'],
+            "dangerous_readings": row['dangerous_readings'],
+        }
+        for vital in VITALS:
+            bucket[vital] = {
+                "min": row[f'{vital}_min'],
+                "max": row[f'{vital}_max'],
+                "avg": round(row[f'{vital}_sum'] / row['readings'], 1),
+            }
+        buckets.append(bucket)
+    return buckets
+